@@ -1,9 +1,12 @@
 from flask import Flask
-from blueprints import index_bp, signal_checker_bp, spectrum_checker_bp, cfc_checker_bp, \
-    signal_bkapp, spectrum_bkapp, cfc_bkapp
+from blueprints import index_bp, signal_checker_bp, spectrum_checker_bp, cfc_checker_bp, spectrogram_checker_bp, \
+    metrics_bp, signal_bkapp, spectrum_bkapp, cfc_bkapp, spectrogram_bkapp, MetricsHandler
+from blueprints.source_utils import metrics, spectral, RawDF, EdfCache
 from bokeh.server.server import Server
 from threading import Thread
 from tornado.ioloop import IOLoop
+import multiprocessing
+import atexit
 import yaml
 import argparse
 
@@ -13,11 +16,37 @@ app.register_blueprint(index_bp)
 app.register_blueprint(signal_checker_bp)
 app.register_blueprint(spectrum_checker_bp)
 app.register_blueprint(cfc_checker_bp)
+app.register_blueprint(spectrogram_checker_bp)
+app.register_blueprint(metrics_bp)
 
 with open("./config.yaml", 'r') as config_file:
     config = yaml.safe_load(config_file)
     config_file.close()
 
+metrics.enabled = bool(config['METRICS'])
+
+
+def bk_worker(port):
+    """
+    run the bokeh apps on one port, each worker process serves its own sessions,
+    its metrics are exposed at http://localhost:<port>/metrics
+    """
+    with open("./config.yaml", 'r') as config_file:
+        worker_config = yaml.safe_load(config_file)
+        config_file.close()
+    metrics.enabled = bool(worker_config['METRICS'])
+    spectral.set_workers(worker_config['FFT_WORKERS'])
+    EdfCache.set_cache_dir(worker_config['CACHE_DIR'])
+
+    server = Server({'/signal_bkapp': signal_bkapp,
+                     '/spectrum_bkapp': spectrum_bkapp,
+                     '/cfc_bkapp': cfc_bkapp,
+                     '/spectrogram_bkapp': spectrogram_bkapp},
+                    io_loop=IOLoop(), port=port, allow_websocket_origin=["localhost:"+str(worker_config['PORT'])],
+                    extra_patterns=[('/metrics', MetricsHandler)])
+    server.start()
+    server.io_loop.start()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -25,26 +54,38 @@ if __name__ == "__main__":
                         help='Select port for you server to run on')
     parser.add_argument('-f', '--file', default='none', type=str,
                         help='Select the base file for your server')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='Number of bokeh server processes, on consecutive ports from BOKEH_PORT')
 
     args = parser.parse_args()
 
     config['PORT'] = args.port
     config['FILENAME'] = args.file if args.file.lower() != 'none' else config['FILENAME']
+    config['BOKEH_WORKERS'] = max(args.workers, 1)
 
     with open("./config.yaml", 'w') as config_file:
         yaml.dump(config, config_file, default_flow_style=False)
         config_file.close()
 
+    if config['BOKEH_WORKERS'] == 1:
+        Thread(target=bk_worker, args=(config['BOKEH_PORT'],)).start()
+
+    else:
+        # the workers map the samples from the cache, the pages are loaded once for all processes
+        EdfCache.set_cache_dir(config['CACHE_DIR'])
+        if not EdfCache.is_fresh(config['FILENAME']):
+            EdfCache.write(RawDF(filename=config['FILENAME'], lazy=True, use_cache=False), dtype=config['PRECISION'])
 
-    def bk_worker():
-        server = Server({'/signal_bkapp': signal_bkapp,
-                         '/spectrum_bkapp': spectrum_bkapp,
-                         '/cfc_bkapp': cfc_bkapp},
-                        io_loop=IOLoop(), allow_websocket_origin=["localhost:"+str(config['PORT'])])
-        server.start()
-        server.io_loop.start()
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=bk_worker, args=(config['BOKEH_PORT'] + i,))
+                   for i in range(config['BOKEH_WORKERS'])]
+        for worker in workers:
+            worker.start()
 
+        def stop_workers():
+            for worker in workers:
+                worker.terminate()
 
-    Thread(target=bk_worker).start()
+        atexit.register(stop_workers)
 
-    app.run(port=config['PORT'])
\ No newline at end of file
+    app.run(port=config['PORT'])
@@ -0,0 +1,306 @@
+from blueprints.source_utils import RawDF, FrequencyAnalysis, CrossFrequencyCoupling, BAND_PRESETS, spectral, \
+    EdfCache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import numpy as np
+import pandas as pd
+import argparse
+import shutil
+import glob
+import json
+import traceback
+import time
+import yaml
+import sys
+import os
+
+BANDS = BAND_PRESETS['db4'][::-1]  # from the lowest band
+OUTPUTS = ['psd', 'band_power', 'pac']
+
+_recordings = dict()
+
+
+def find_files(inputs):
+    """
+    :param inputs: EDF files, directories (searched recursively) or glob patterns
+    :return: sorted list of absolute paths, without duplicates
+    """
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            files.update(glob.glob(os.path.join(item, '**', '*.edf'), recursive=True))
+            files.update(glob.glob(os.path.join(item, '**', '*.EDF'), recursive=True))
+        else:
+            files.update(glob.glob(item, recursive=True))
+    return sorted(os.path.abspath(filename) for filename in files)
+
+
+def output_path(output, filename, root=None):
+    """
+    :param output: output directory of the batch
+    :param filename: EDF file
+    :param root: common directory of the inputs, kept out of the result path
+    :return: directory of the results of this file
+    """
+    relative = os.path.relpath(filename, root) if root is not None else os.path.basename(filename)
+    return os.path.join(output, os.path.splitext(relative)[0])
+
+
+def is_done(path, params):
+    """
+    a file is done once its _SUCCESS marker exists and records the same parameters and source modification time
+    """
+    try:
+        with open(os.path.join(path, '_SUCCESS'), 'r') as marker:
+            return json.load(marker) == params
+    except (OSError, ValueError):
+        return False
+
+
+def prepare_parts(path, params):
+    """
+    directory of the blocks of a file, the blocks of an interrupted run are only kept if they were computed
+    with the same parameters, recorded in parts/params.json
+    :param path: directory of the results of the file
+    :param params: parameters of the blocks, including the number of channels per block
+    :return: directory of the blocks
+    """
+    parts_path = os.path.join(path, 'parts')
+    try:
+        with open(os.path.join(parts_path, 'params.json'), 'r') as marker:
+            reusable = json.load(marker) == params
+    except (OSError, ValueError):
+        reusable = False
+    if not reusable:
+        shutil.rmtree(parts_path, ignore_errors=True)
+        os.makedirs(parts_path)
+        with open(os.path.join(parts_path, 'params.json'), 'w') as marker:
+            json.dump(params, marker)
+    return parts_path
+
+
+def record_failure(path, params, error):
+    """
+    log the error of a file and write it in its _FAILED marker, with its parameters,
+    the file is tried again by the next run, the blocks already written are kept
+    :param path: directory of the results of the file
+    :param params: parameters of the file
+    :param error: exception raised while opening or analysing the file
+    """
+    print('{}: failed, {}: {}'.format(params['source'], type(error).__name__, error), file=sys.stderr)
+    traceback.print_exception(type(error), error, error.__traceback__)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, '_FAILED'), 'w') as marker:
+        json.dump(dict(params, error='{}: {}'.format(type(error).__name__, error)), marker)
+
+
+def open_recording(filename, dtype):
+    """
+    one lazy recording per worker process, read through the memory-mapped cache when it is up to date
+    """
+    if filename not in _recordings:
+        _recordings.clear()
+        _recordings[filename] = RawDF(filename=filename, lazy=True, dtype=dtype)
+    return _recordings[filename]
+
+
+def analyse_channels(filename, picks, params):
+    """
+    PSD, band powers and phase-amplitude coupling of some channels over the whole recording
+    :param filename: EDF file
+    :param picks: channel positions
+    :param params: NOTCH, QUALITY, HIGHPASS, LOWPASS, ORDER, NPERSEG, LOG, WIN1, WIN2 and PRECISION
+    :return: dictionary of pd.DataFrame, psd (frequencies x channels), band_power and pac (channels x values)
+    """
+    recording = open_recording(filename, params['PRECISION'])
+    fs = recording.freq
+    ch_names = [recording.ch_names[i] for i in picks]
+    data = recording.get_window(picks)
+
+    if params['NOTCH']:
+        data = FrequencyAnalysis.notch_filter(data, params['NOTCH'], fs, params['QUALITY'])
+    if params['HIGHPASS']:
+        data = FrequencyAnalysis.butter_highpass_filter(data, params['HIGHPASS'], fs, params['ORDER'])
+    if params['LOWPASS']:
+        data = FrequencyAnalysis.butter_lowpass_filter(data, params['LOWPASS'], fs, params['ORDER'])
+
+    fseq, den = FrequencyAnalysis.data_filted_to_den(data, int(params['NPERSEG'] / 2 + 1), fs,
+                                                     nperseg=params['NPERSEG'], log=False)
+    band_power = FrequencyAnalysis.band_power_from_psd(fseq, den, BANDS)
+    if params['LOG']:
+        with np.errstate(divide='ignore'):
+            den = np.log10(den)
+
+    p_bins = np.arange(-np.pi, np.pi, 0.1)
+    pac = np.zeros((len(picks), 2))
+    V1 = FrequencyAnalysis.fir_bandpass_filter(data, params['WIN1'], fs, numtaps=100)
+    V2 = FrequencyAnalysis.fir_bandpass_filter(data, params['WIN2'], fs, numtaps=100)
+    # one analytic signal per band, for all the channels at once
+    phases = np.angle(spectral.analytic_signal(V1))
+    amplitudes = np.abs(spectral.analytic_signal(V2))
+    for i in range(len(picks)):
+        phi = phases[i]
+        amp = amplitudes[i]
+        p_mean, a_mean = CrossFrequencyCoupling.phase_amplitude_distribution(phi, amp, p_bins)
+        pac[i] = [CrossFrequencyCoupling.modulation_index(a_mean), CrossFrequencyCoupling.mean_vector_length(phi, amp)]
+
+    psd = pd.DataFrame(data=den.T, columns=ch_names)
+    psd.insert(0, 'frequency', fseq)
+    return dict(psd=psd,
+                band_power=pd.DataFrame(data=band_power, index=pd.Index(ch_names, name='channel'),
+                                        columns=['{}-{}Hz'.format(*band) for band in BANDS]),
+                pac=pd.DataFrame(data=pac, index=pd.Index(ch_names, name='channel'), columns=['mi', 'mvl']))
+
+
+def write_table(df, path, file_format, index):
+    # written aside and renamed, an interrupted write never leaves a partial table behind
+    tmp_path = path + '.tmp'
+    if file_format == 'parquet':
+        df.to_parquet(tmp_path, index=index)
+    else:
+        df.to_csv(tmp_path, index=index)
+    os.replace(tmp_path, path)
+
+
+def read_table(path, file_format, index):
+    if file_format == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_csv(path, index_col=0 if index else None)
+
+
+def run_task(filename, picks, params, part_path, file_format):
+    """
+    analyse a block of channels and write its tables, in a worker process
+    :return: part_path
+    """
+    # the processes of the pool already use every core
+    spectral.set_workers(1)
+    results = analyse_channels(filename, picks, params)
+    for name in OUTPUTS:
+        write_table(results[name], '{}.{}.{}'.format(part_path, name, file_format), file_format, name != 'psd')
+    return part_path
+
+
+def merge_parts(path, part_paths, file_format):
+    """
+    concatenate the blocks of channels of a file, psd side by side, band_power and pac one below the other
+    """
+    for name in OUTPUTS:
+        index = name != 'psd'
+        parts = [read_table('{}.{}.{}'.format(part_path, name, file_format), file_format, index)
+                 for part_path in part_paths]
+        if index:
+            table = pd.concat(parts, axis=0)
+        else:
+            table = pd.concat([parts[0]] + [part.drop(columns='frequency') for part in parts[1:]], axis=1)
+        write_table(table, os.path.join(path, '{}.{}'.format(name, file_format)), file_format, index)
+    shutil.rmtree(os.path.join(path, 'parts'), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute the PSD, band powers and phase-amplitude coupling '
+                                                 'of every channel of many EDF recordings')
+    parser.add_argument('inputs', nargs='+', type=str,
+                        help='EDF files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='./batch_output', type=str,
+                        help='Directory of the results, one sub-directory per file')
+    parser.add_argument('--config', default='./config.yaml', type=str,
+                        help='Configuration giving the default parameters')
+    parser.add_argument('--notch', type=float, help='Notch frequency, NOTCH in the configuration')
+    parser.add_argument('--highpass', type=float, help='High pass cutoff, HIGHPASS in the configuration')
+    parser.add_argument('--lowpass', type=float, help='Low pass cutoff, LOWPASS in the configuration')
+    parser.add_argument('--nperseg', type=int, help='Welch segment length, NPERSEG in the configuration')
+    parser.add_argument('--win1', type=float, nargs=2, help='Phase band, WIN1 in the configuration')
+    parser.add_argument('--win2', type=float, nargs=2, help='Amplitude band, WIN2 in the configuration')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of processes, all cores by default')
+    parser.add_argument('--channels-per-task', type=int, default=8,
+                        help='Channels analysed together by a process')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'],
+                        help='Format of the tables, parquet needs pyarrow')
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute files that are already done')
+
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        config_file.close()
+
+    params = {key: config[key] for key in ['NOTCH', 'QUALITY', 'HIGHPASS', 'LOWPASS', 'ORDER', 'NPERSEG', 'LOG',
+                                           'WIN1', 'WIN2', 'PRECISION']}
+    for key in ['notch', 'highpass', 'lowpass', 'nperseg', 'win1', 'win2']:
+        if getattr(args, key) is not None:
+            params[key.upper()] = getattr(args, key)
+    params['WIN1'], params['WIN2'] = list(params['WIN1']), list(params['WIN2'])
+
+    files = find_files(args.inputs)
+    root = os.path.commonpath([os.path.dirname(filename) for filename in files]) if files else None
+
+    # spawn: the workers only import the analysis code
+    EdfCache.set_cache_dir(config['CACHE_DIR'])
+    executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=EdfCache.set_cache_dir, initargs=(config['CACHE_DIR'],))
+    pending = dict()
+    failed = []
+    for filename in files:
+        path = output_path(args.output, filename, root)
+        file_params = dict(params, source=filename, format=args.format)
+        # an unreadable file is recorded and skipped, the other files are still analysed
+        try:
+            file_params['source_mtime'] = os.path.getmtime(filename)
+            if is_done(path, file_params) and not args.force:
+                print(filename + ': done')
+                continue
+            if args.force or os.path.exists(os.path.join(path, '_SUCCESS')):
+                shutil.rmtree(path, ignore_errors=True)
+            prepare_parts(path, dict(file_params, channels_per_task=args.channels_per_task))
+            nchan = RawDF(filename=filename, lazy=True).nchan
+        except Exception as error:
+            record_failure(path, file_params, error)
+            failed.append(filename)
+            continue
+
+        part_paths = []
+        futures = []
+        for first in range(0, nchan, args.channels_per_task):
+            picks = list(range(first, min(first + args.channels_per_task, nchan)))
+            part_path = os.path.join(path, 'parts', '{:05d}'.format(first))
+            part_paths.append(part_path)
+            # blocks finished before an interruption are kept
+            if all(os.path.exists('{}.{}.{}'.format(part_path, name, args.format)) for name in OUTPUTS):
+                continue
+            futures.append(executor.submit(run_task, filename, picks, params, part_path, args.format))
+        pending[filename] = dict(path=path, params=file_params, part_paths=part_paths, futures=futures,
+                                 start_time=time.time())
+
+    def finish(filename):
+        state = pending.pop(filename)
+        try:
+            for future in state['futures']:
+                future.result()
+            merge_parts(state['path'], state['part_paths'], args.format)
+        except Exception as error:
+            record_failure(state['path'], state['params'], error)
+            failed.append(filename)
+            return
+        with open(os.path.join(state['path'], '_SUCCESS'), 'w') as marker:
+            json.dump(state['params'], marker)
+        if os.path.exists(os.path.join(state['path'], '_FAILED')):
+            os.remove(os.path.join(state['path'], '_FAILED'))
+        print(filename + ': ' + state['path'] + ' (%.1fs)' % (time.time() - state['start_time']))
+
+    # results are merged as soon as every block of a file is written, whatever the order of completion
+    futures = {future: filename for filename, state in pending.items() for future in state['futures']}
+    for filename in [filename for filename, state in pending.items() if not state['futures']]:
+        finish(filename)
+    for future in as_completed(futures):
+        filename = futures[future]
+        if filename in pending and all(f.done() for f in pending[filename]['futures']):
+            finish(filename)
+
+    executor.shutdown()
+    if failed:
+        print('{} file(s) failed, see their _FAILED marker:\n'.format(len(failed)) + '\n'.join(failed),
+              file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,293 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import yaml
+from .synthetic_edf import make_synthetic_edf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(name, func, repeat=3, setup=None):
+    """
+    time a function, then run it once more under tracemalloc for the peak memory
+    :param name: name of the benchmark
+    :param func: function without arguments
+    :param repeat: number of timed runs
+    :param setup: optional function called before every run, not timed
+    :return: dictionary with the wall times (seconds) and the peak memory (MB), or the error
+    """
+    result = dict(name=name, repeat=repeat)
+    try:
+        times = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            start_time = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start_time)
+
+        if setup is not None:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as error:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        print('{:<45s} failed, {}'.format(name, result['error']))
+        return result
+
+    result.update(wall_min=min(times), wall_median=float(np.median(times)), peak_mb=peak / 2 ** 20)
+    print('{:<45s} {:9.4f}s  {:9.1f}MB'.format(name, result['wall_min'], result['peak_mb']))
+    return result
+
+
+def reset_caches():
+    """
+    drop the recordings shared between sessions, the filter designs and the spectrogram tiles,
+    so the next run starts cold
+    """
+    from blueprints.source_utils import recording_store, filter_cache, tile_cache
+    recording_store.clear()
+    filter_cache.clear()
+    tile_cache.clear()
+
+
+def prime_below(n):
+    """
+    :return: largest prime <= n, the slowest length for an FFT
+    """
+    n = int(n)
+    while n > 2 and any(n % i == 0 for i in range(2, int(n ** 0.5) + 1)):
+        n -= 1
+    return n
+
+
+def spectral_benchmarks(filename, repeat):
+    """
+    the calls of the analyses before the shared spectral backend, next to the backend, on a prime number of samples
+    """
+    from scipy import fft, signal
+    from blueprints.source_utils import RawDF, spectral
+
+    raw_edf = RawDF(filename=filename, lazy=True, use_cache=False)
+    fs = raw_edf.freq
+    channel = raw_edf.get_window([0])[0]
+    channel = channel[:prime_below(channel.size)].astype(np.float64)
+    channels = raw_edf.get_window(None, 0, prime_below(int(60 * fs))).astype(np.float64)
+
+    def fft_positive_half():
+        yf = fft.fft(channel)
+        xf = fft.fftfreq(len(channel), 1 / fs)
+        return [xf[xf >= 0], yf[xf >= 0]]
+
+    def phase_amplitude_twice():
+        return [np.angle(signal.hilbert(channel)), np.abs(signal.hilbert(channel))]
+
+    def phase_amplitude_once():
+        analytic = spectral.analytic_signal(channel)
+        return [np.angle(analytic), np.abs(analytic)]
+
+    return [measure('fft.fft positive half (1 channel)', fft_positive_half, repeat),
+            measure('spectral.positive_spectrum (1 channel)', lambda: spectral.positive_spectrum(channel, fs), repeat),
+            measure('signal.hilbert (1 channel)', lambda: signal.hilbert(channel), repeat),
+            measure('spectral.analytic_signal (1 channel)', lambda: spectral.analytic_signal(channel), repeat),
+            measure('signal.hilbert twice, phase and amplitude', phase_amplitude_twice, repeat),
+            measure('analytic_signal once, phase and amplitude', phase_amplitude_once, repeat),
+            measure('signal.hilbert (60s, all channels)', lambda: signal.hilbert(channels), repeat),
+            measure('spectral.analytic_signal (60s, all channels)', lambda: spectral.analytic_signal(channels),
+                    repeat)]
+
+
+def widgets(doc, cls, title):
+    return [m for m in doc.models if type(m).__name__ == cls and getattr(m, 'title', None) == title][0]
+
+
+def set_value(widget, value, event='value'):
+    """
+    change a widget the way the browser does, value_throttled callbacks are triggered explicitly
+    """
+    old = widget.value
+    widget.value = value
+    if event == 'value_throttled':
+        widget.trigger('value_throttled', old, value)
+
+
+def library_benchmarks(filename, repeat):
+    from blueprints.source_utils import RawDF, SpectrumDF, FrequencyAnalysis as fa
+    from blueprints.bp_utils import smooth_multichannel
+
+    results = [measure('RawDF(lazy=False)', lambda: RawDF(filename=filename, use_cache=False), repeat),
+               measure('RawDF(lazy=True)', lambda: RawDF(filename=filename, lazy=True, use_cache=False), repeat),
+               measure('SpectrumDF(notch=60)', lambda: SpectrumDF(filename=filename, notch_freq=60,
+                                                                  use_cache=False), repeat)]
+
+    raw_edf = RawDF(filename=filename, lazy=True, use_cache=False)
+    fs = raw_edf.freq
+    window = raw_edf.get_window(None, 0, int(10 * fs))
+    channel = raw_edf.get_window([0])[0]
+    results += [measure('butter_lowpass_filter (10s, all channels)',
+                        lambda: fa.butter_lowpass_filter(window, 40, fs), repeat),
+                measure('butter_highpass_filter (10s, all channels)',
+                        lambda: fa.butter_highpass_filter(window, 1, fs), repeat),
+                measure('butter_bandpass_filter (10s, all channels)',
+                        lambda: fa.butter_bandpass_filter(window, 4, 8, fs), repeat),
+                measure('notch_filter (10s, all channels)',
+                        lambda: fa.notch_filter(window, 60, fs), repeat),
+                measure('fir_bandpass_filter (10s, all channels)',
+                        lambda: fa.fir_bandpass_filter(window, [4, 8], fs), repeat),
+                measure('data_filted_to_den (10s, all channels)',
+                        lambda: fa.data_filted_to_den(window, 0, fs, nperseg=1024), repeat),
+                measure('notch_filter (whole recording, 1 channel)', lambda: fa.notch_filter(channel, 60, fs), repeat),
+                measure('filter_window (10s of 1 channel, notch)',
+                        lambda: fa.filter_window(lambda begin, end: raw_edf.get_window([0], begin, end)[0],
+                                                 raw_edf.n_times // 2, raw_edf.n_times // 2 + int(10 * fs),
+                                                 raw_edf.n_times, fs, (('notch', 60),)), repeat),
+                measure('smooth_multichannel (10s, all channels, box 500)',
+                        lambda: smooth_multichannel(window, 500), repeat),
+                measure('smooth_multichannel (10s, all channels, gaussian 500)',
+                        lambda: smooth_multichannel(window, 500, 'gaussian'), repeat),
+                measure('db4_filter (1 channel)', lambda: fa.db4_filter(channel, fs), repeat),
+                measure('band_power (all channels, classic bands)',
+                        lambda: fa.band_power(raw_edf.get_window(None), fs, 'classic'), repeat)]
+    return results
+
+
+def app_benchmarks(filename, compare_filename, repeat):
+    from bokeh.document import Document
+    from bokeh.models import Plot
+    from blueprints import signal_bkapp, spectrum_bkapp, cfc_bkapp, spectrogram_bkapp
+    from blueprints.source_utils import RawDF
+
+    results = []
+    docs = dict()
+
+    def init(name, app):
+        def run():
+            docs[name] = Document()
+            app(docs[name])
+        return run
+
+    for name, app in [('signal', signal_bkapp), ('spectrum', spectrum_bkapp), ('cfc', cfc_bkapp),
+                      ('spectrogram', spectrogram_bkapp)]:
+        results.append(measure('{}_bkapp init (cold)'.format(name), init(name, app), repeat, setup=reset_caches))
+
+    doc = docs['signal']
+    range_slider = widgets(doc, 'RangeSlider', 'Range Slider')
+    compare_input = widgets(doc, 'TextInput', 'Compare File:')
+    n_times = range_slider.end
+    steps = iter(range(1, 10 ** 6))
+    results += [
+        measure('signal update: scroll raw window',
+                lambda: set_value(range_slider, (500 * next(steps), 500 * next(steps) + 3000), 'value_throttled'),
+                repeat),
+        measure('signal update: highpass filter',
+                lambda: set_value(widgets(doc, 'TextInput', 'Highpass Filter:'), str(1 + next(steps) % 2)), repeat),
+        measure('signal update: compare file',
+                lambda: set_value(compare_input, compare_filename if compare_input.value == 'None' else 'None'),
+                repeat),
+        measure('signal update: full recording envelope',
+                lambda: set_value(range_slider, (0, n_times - 1 - next(steps) % 2), 'value_throttled'), repeat)]
+
+    doc = docs['spectrum']
+    channel_slider = widgets(doc, 'Slider', 'Channel')
+    results += [
+        measure('spectrum update: channel',
+                lambda: set_value(channel_slider, next(steps) % channel_slider.end, 'value_throttled'), repeat),
+        measure('spectrum update: interval',
+                lambda: set_value(widgets(doc, 'TextInput', 'Time Interval:'),
+                                  '{},{}'.format(next(steps) * 100, n_times // 2)), repeat),
+        measure('spectrum update: notch filter',
+                lambda: set_value(widgets(doc, 'TextInput', 'Notch Filter:'), str(59 + next(steps) % 2)), repeat)]
+
+    doc = docs['cfc']
+    channel_slider = widgets(doc, 'Slider', 'Channel Base: ')
+    results += [
+        measure('cfc update: channel',
+                lambda: set_value(channel_slider, next(steps) % channel_slider.end, 'value_throttled'), repeat),
+        measure('cfc update: bands',
+                lambda: set_value(widgets(doc, 'TextInput', 'Frequency Comparison: '),
+                                  '{},120'.format(30 + next(steps) % 5)), repeat)]
+
+    doc = docs['spectrogram']
+    # the time axis of the spectrogram, its y_range is the frequency axis
+    x_range = [m for m in doc.models if isinstance(m, Plot)][0].x_range
+    recording = RawDF(filename=filename, lazy=True)
+    duration = recording.n_times / recording.freq
+
+    def zoom(width):
+        def run():
+            start = (next(steps) * 37) % max(duration - width, 1)
+            x_range.update(start=start, end=start + width)
+        return run
+
+    results += [
+        measure('spectrogram update: zoom to 60s', zoom(60), repeat),
+        measure('spectrogram update: full recording', lambda: x_range.update(start=next(steps) % 2, end=duration),
+                repeat)]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the EEG visualizer on synthetic recordings')
+    parser.add_argument('-c', '--channels', default=64, type=int, help='Number of channels')
+    parser.add_argument('-d', '--duration', default=600, type=float, help='Duration in seconds')
+    parser.add_argument('-s', '--sfreq', default=1000, type=int, help='Sampling frequency')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='Timed runs per benchmark')
+    parser.add_argument('-o', '--output', default='benchmark.json', type=str, help='JSON file of the results')
+    parser.add_argument('--no-apps', action='store_true', help='Skip the Bokeh app benchmarks')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    import mne
+    mne.set_log_level('ERROR')
+    work_dir = tempfile.mkdtemp(prefix='eeg_benchmark_')
+    cwd = os.getcwd()
+    try:
+        filename = make_synthetic_edf(os.path.join(work_dir, 'base.edf'), args.channels, args.duration,
+                                      args.sfreq, seed=0)
+        compare_filename = make_synthetic_edf(os.path.join(work_dir, 'compare.edf'), args.channels,
+                                              args.duration, args.sfreq, seed=1)
+
+        # the apps read ./config.yaml, run them from a copy pointing to the synthetic recording
+        with open(os.path.join(ROOT, 'config.yaml'), 'r') as config_file:
+            config = yaml.safe_load(config_file)
+            config_file.close()
+        config['FILENAME'] = filename
+        with open(os.path.join(work_dir, 'config.yaml'), 'w') as config_file:
+            yaml.dump(config, config_file, default_flow_style=False)
+            config_file.close()
+        os.chdir(work_dir)
+
+        results = library_benchmarks(filename, args.repeat) + spectral_benchmarks(filename, args.repeat)
+        if not args.no_apps:
+            results += app_benchmarks(filename, compare_filename, args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(parameters=dict(channels=args.channels, duration=args.duration, sfreq=args.sfreq,
+                                  repeat=args.repeat),
+                  machine=dict(python=platform.python_version(), platform=platform.platform(),
+                               processor=platform.processor(), cpu_count=os.cpu_count()),
+                  timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  results=results)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+        output_file.close()
+    print('results written to ' + output)
+
+
+if __name__ == "__main__":
+    main()
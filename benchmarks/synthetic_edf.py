@@ -0,0 +1,106 @@
+import argparse
+import numpy as np
+
+
+def region_channel_names(n_channels, per_region=12):
+    """
+    SEEG style channel names, a letter per electrode (brain region) followed by the contact number
+    :param n_channels: number of channels
+    :param per_region: number of contacts per electrode
+    :return: channel names, e.g. ['A1', ..., 'A12', 'B1', ...]
+    """
+    names = []
+    for i in range(n_channels):
+        region, contact = divmod(i, per_region)
+        prefix = chr(ord('A') + region % 26) * (region // 26 + 1)
+        names.append('{}{}'.format(prefix, contact + 1))
+    return names
+
+
+def synthetic_signals(n_channels, duration, sfreq, seed=0):
+    """
+    background noise, a theta rhythm whose phase modulates a gamma rhythm, and line noise at 60Hz
+    :param n_channels: number of channels
+    :param duration: duration in seconds
+    :param sfreq: sampling frequency
+    :param seed: seed of the random generator
+    :return: 2d-array, channels x samples, in volts
+    """
+    rng = np.random.default_rng(seed)
+    n_times = int(duration * sfreq)
+    t = np.arange(n_times) / sfreq
+    theta = np.sin(2 * np.pi * 7 * t)
+    gamma = (1 + theta) * np.sin(2 * np.pi * 80 * t)
+    line = np.sin(2 * np.pi * 60 * t)
+    gains = rng.uniform(0.5, 1.5, size=(n_channels, 3))
+    data = 2e-5 * rng.standard_normal((n_channels, n_times))
+    data += 1e-4 * gains[:, :1] * theta + 2e-5 * gains[:, 1:2] * gamma + 1e-5 * gains[:, 2:] * line
+    return data
+
+
+def write_edf(filename, data, sfreq, ch_names, record_duration=1):
+    """
+    write a 16 bits EDF file, every channel is scaled to its own physical range, stored in microvolts
+    so that the range fits in the 8 characters of the header fields
+    :param filename: path of the file
+    :param data: 2d-array, channels x samples, in volts, trailing samples not filling a record are dropped
+    :param sfreq: sampling frequency, sfreq * record_duration must be an integer
+    :param ch_names: channel names
+    :param record_duration: duration of a data record in seconds
+    """
+    n_channels, n_times = data.shape
+    samples_per_record = int(round(sfreq * record_duration))
+    n_records = n_times // samples_per_record
+    data = data[:, :n_records * samples_per_record] * 1e6
+    physical_min = np.floor(data.min(axis=1)) - 1
+    physical_max = np.ceil(data.max(axis=1)) + 1
+    digital_min, digital_max = -32768, 32767
+    scale = (digital_max - digital_min) / (physical_max - physical_min)
+    digital = np.round((data - physical_min[:, np.newaxis]) * scale[:, np.newaxis] + digital_min).astype('<i2')
+
+    def field(value, width):
+        return str(value)[:width].ljust(width).encode('ascii')
+
+    header = field('0', 8) + field('X X X X', 80) + field('Startdate X X X X', 80) + field('01.01.20', 8) \
+        + field('00.00.00', 8) + field(256 * (n_channels + 1), 8) + field('', 44) + field(n_records, 8) \
+        + field(record_duration, 8) + field(n_channels, 4)
+    for values, width in [(ch_names, 16), ([''] * n_channels, 80), (['uV'] * n_channels, 8),
+                          (['%d' % i for i in physical_min], 8), (['%d' % i for i in physical_max], 8),
+                          ([digital_min] * n_channels, 8), ([digital_max] * n_channels, 8),
+                          ([''] * n_channels, 80), ([samples_per_record] * n_channels, 8),
+                          ([''] * n_channels, 32)]:
+        header += b''.join(field(value, width) for value in values)
+
+    with open(filename, 'wb') as edf_file:
+        edf_file.write(header)
+        digital.reshape(n_channels, n_records, samples_per_record).transpose(1, 0, 2).tofile(edf_file)
+        edf_file.close()
+
+
+def make_synthetic_edf(filename, n_channels=64, duration=600, sfreq=1000, per_region=12, seed=0):
+    """
+    generate a synthetic SEEG recording
+    :param filename: path of the EDF file
+    :param n_channels: number of channels
+    :param duration: duration in seconds
+    :param sfreq: sampling frequency
+    :param per_region: number of contacts per electrode
+    :param seed: seed of the random generator
+    :return: filename
+    """
+    data = synthetic_signals(n_channels, duration, sfreq, seed)
+    write_edf(filename, data, sfreq, region_channel_names(n_channels, per_region))
+    return filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic SEEG recording')
+    parser.add_argument('filename', type=str, help='Path of the EDF file')
+    parser.add_argument('-c', '--channels', default=64, type=int, help='Number of channels')
+    parser.add_argument('-d', '--duration', default=600, type=float, help='Duration in seconds')
+    parser.add_argument('-s', '--sfreq', default=1000, type=int, help='Sampling frequency')
+    parser.add_argument('--per-region', default=12, type=int, help='Contacts per electrode')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random generator')
+    args = parser.parse_args()
+
+    make_synthetic_edf(args.filename, args.channels, args.duration, args.sfreq, args.per_region, args.seed)
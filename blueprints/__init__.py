@@ -1,7 +1,11 @@
 from .index_bp import bp as index_bp
+from .metrics_bp import bp as metrics_bp
+from .metrics_bp import MetricsHandler
 from .signal_checker_bp import bp as signal_checker_bp
 from .signal_checker_bp import signal_bkapp
 from .spectrum_checker_bp import bp as spectrum_checker_bp
 from .spectrum_checker_bp import spectrum_bkapp
 from .cfc_checker_bp import bp as cfc_checker_bp
 from .cfc_checker_bp import cfc_bkapp
+from .spectrogram_checker_bp import bp as spectrogram_checker_bp
+from .spectrogram_checker_bp import spectrogram_bkapp
@@ -1,3 +1,7 @@
 from .signal_processing import convolve_multichannel, butter_lowpass_filter, butter_highpass_filter,\
-    butter_bandpass_filter, notch_filter, signal_time_in_freq_out, db4_filter
-from .plot_utils import stack_x_axis_times, stack_y_axis_signals, stackc_tick_loc
\ No newline at end of file
+    butter_bandpass_filter, notch_filter, signal_time_in_freq_out, db4_filter, smooth_multichannel, SMOOTH_METHODS
+from .plot_utils import stack_x_axis_times, stack_y_axis_signals, stackc_tick_loc, auto_offset, stack_line_columns, \
+    rasterize_lanes
+from .decimation import MinMaxPyramid, get_pyramid, envelope_window
+from .callbacks import LatestWinsRunner, RecordingLoader, callback_executor, loader_executor
+from .serving import bokeh_app_url
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ..source_utils import metrics, recording_store, RawDF, EdfCache
+
+callback_executor = ThreadPoolExecutor(thread_name_prefix='bokeh-callback')
+# recordings are opened apart from the callbacks, a long parse never holds a callback thread
+loader_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='recording-loader')
+
+
+class LatestWinsRunner():
+    """
+    run the heavy part of the callbacks of a session outside of the server IOLoop
+    every submit starts a new generation, a result is only applied if no newer work was submitted meanwhile,
+    so a slow update never overwrites the plot after the user has moved on
+    doc: bokeh document of the session
+    busy: optional model shown while work is pending (e.g. a Div)
+    name: label of the latency metrics of this runner
+    """
+
+    def __init__(self, doc, busy=None, executor=None, name='callback'):
+        """
+        initial method
+        :param doc: bokeh document of the session
+        :param busy: model made visible while work is pending
+        :param executor: concurrent.futures executor, the shared callback_executor by default
+        :param name: label of the latency metrics, usually app:callback
+        """
+        self.doc = doc
+        self.busy = busy
+        self.name = name
+        self.executor = executor if executor is not None else callback_executor
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def submit(self, compute, apply):
+        """
+        run compute in the executor, then apply(result) on the next tick of the session
+        compute must not touch bokeh models, read the widget values before submitting
+        without a server session (e.g. a standalone document) both run immediately
+        :param compute: function without arguments doing the heavy work
+        :param apply: function receiving the result and updating the models
+        :return: generation of this work
+        """
+        with self._lock:
+            self.generation += 1
+            generation = self.generation
+
+        start_time = time.perf_counter()
+        if self.doc.session_context is None:
+            apply(compute())
+            metrics.observe('eeg_callback_seconds', time.perf_counter() - start_time, callback=self.name)
+            return generation
+
+        if self.busy is not None:
+            self.busy.visible = True
+        future = self.executor.submit(compute)
+        future.add_done_callback(
+            lambda f: self.doc.add_next_tick_callback(partial(self._finish, generation, f, apply, start_time)))
+        return generation
+
+    def _finish(self, generation, future, apply, start_time):
+        if generation != self.generation:
+            # a newer update was submitted, its own callback will refresh the plot
+            metrics.inc('eeg_callback_dropped_total', callback=self.name)
+            return
+        if self.busy is not None:
+            self.busy.visible = False
+        error = future.exception()
+        if error is not None:
+            metrics.inc('eeg_callback_errors_total', callback=self.name)
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return
+        apply(future.result())
+        metrics.observe('eeg_callback_seconds', time.perf_counter() - start_time, callback=self.name)
+
+
+class RecordingLoader():
+    """
+    open the compare recording of a session in the background, the session keeps updating meanwhile
+    the progress, the opened recording or the error is shown in a status model (e.g. a Div),
+    and on_ready is called on the session once the recording is open, usually to redraw with it
+    doc: bokeh document of the session
+    status: optional model whose text reports the loading
+    on_ready: function without arguments called on the session when a recording is open
+    write_cache: if True, a lazy file without an up-to-date cache is first converted to the cache (CACHE_COMPARE)
+    options: options of the recordings, passed to recording_store.get_raw (lazy, dtype)
+    """
+
+    def __init__(self, doc, status=None, on_ready=None, executor=None, write_cache=False, **kwargs):
+        """
+        initial method
+        :param doc: bokeh document of the session
+        :param status: model whose text and visibility report the loading, e.g. a Div
+        :param on_ready: function without arguments called on the session when a recording is open
+        :param executor: concurrent.futures executor, the shared loader_executor by default
+        :param write_cache: convert lazy files without an up-to-date cache to the cache, reporting the progress,
+                            the file is opened lazily from the EDF if the cache cannot be written
+        :param kwargs: options of the recordings, passed to recording_store.get_raw
+        """
+        self.doc = doc
+        self.status = status
+        self.on_ready = on_ready
+        self.executor = executor if executor is not None else loader_executor
+        self.write_cache = write_cache
+        self.options = kwargs
+        self.filename = None
+        self.recording = None
+        self.generation = 0
+        self.closed = False
+
+    def get(self, filename):
+        """
+        the recording of this file, opened in the background the first time it is asked
+        call it from the session (e.g. in a widget callback), on_ready follows once a load finishes
+        without a server session (e.g. a standalone document) the file is opened immediately
+        :param filename: path of the EDF file
+        the progress is reported while a file is loaded, or converted to the cache when write_cache is set
+        :return: the recording, None while it is loading or if it could not be opened, a failed file is tried again
+                 on the next call
+        """
+        if filename == self.filename:
+            return self.recording
+        self.generation += 1
+        generation = self.generation
+        self.filename = filename
+        self.recording = None
+
+        try:
+            recording = recording_store.lookup_raw(filename, owner=id(self.doc), **self.options)
+        except OSError as error:
+            self._report(generation, 'Could not open {}: {}'.format(filename, error))
+            # not kept, the next call tries again
+            self.filename = None
+            return None
+        if recording is None and self.doc.session_context is None:
+            recording = self._load(generation, filename)
+        if recording is not None:
+            # already open: the caller uses it right away, on_ready is not needed
+            self._finish(generation, recording, notify=False)
+            return self.recording
+
+        self._report(generation, 'Opening {}...'.format(os.path.basename(filename)))
+        future = self.executor.submit(self._load, generation, filename)
+        future.add_done_callback(
+            lambda f: self.doc.add_next_tick_callback(partial(self._finish, generation, f.result())))
+        return None
+
+    def reset(self):
+        """
+        forget the current file, a load still running is ignored when it finishes
+        """
+        self.generation += 1
+        self.filename = None
+        self.recording = None
+        if self.status is not None:
+            self.status.visible = False
+
+    def close(self):
+        """
+        call it when the session is destroyed, before releasing its recordings from the store
+        """
+        self.closed = True
+        self.reset()
+
+    def _load(self, generation, filename):
+        percent = [-1]
+
+        def progress(fraction):
+            # one status update per percent, from the loading thread to the session
+            if int(fraction * 100) > percent[0] and self.doc.session_context is not None:
+                percent[0] = int(fraction * 100)
+                self.doc.add_next_tick_callback(partial(
+                    self._report, generation,
+                    'Loading {}: {}%'.format(os.path.basename(filename), percent[0])))
+
+        # the error is returned, so that the session reports it
+        try:
+            if self.write_cache and self.options.get('lazy') and self.options.get('use_cache', True) \
+                    and not EdfCache.is_fresh(filename):
+                self._write_cache(filename, progress)
+            recording = recording_store.get_raw(filename, owner=id(self.doc), progress=progress, **self.options)
+        except Exception as error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return error
+        if self.closed:
+            # the session was destroyed during the load, its release missed this recording
+            recording_store.release(id(self.doc))
+        return recording
+
+    def _write_cache(self, filename, progress):
+        # a cache that cannot be written (read-only media, disk full) only costs the speed of the cache
+        try:
+            EdfCache.write(RawDF(filename=filename, lazy=True, use_cache=False),
+                           dtype=self.options.get('dtype', 'float32'), progress=progress)
+        except OSError as error:
+            print("Could not write the cache of {}: {}".format(filename, error))
+
+    def _report(self, generation, text):
+        if generation != self.generation or self.status is None:
+            return
+        self.status.text = text
+        self.status.visible = True
+
+    def _finish(self, generation, result, notify=True):
+        if generation != self.generation:
+            return
+        if isinstance(result, Exception):
+            self._report(generation, 'Could not open {}: {}'.format(self.filename, result))
+            # not kept, the next call tries again, e.g. once the file is fixed
+            self.filename = None
+            return
+        self.recording = result
+        self._report(generation, 'Compare file: {} ({} channels, {:.1f}s)'.format(
+            os.path.basename(self.filename), result.nchan, result.n_times / result.freq))
+        if notify and self.on_ready is not None:
+            self.on_ready()
@@ -0,0 +1,144 @@
+import threading
+import numpy as np
+
+
+class MinMaxPyramid():
+    """
+    min/max envelopes of every channel of a recording, at several resolutions
+    block_size: number of samples summarized by one block of the finest level
+    factor: number of blocks of a level merged into one block of the next level
+    levels: list of [mins, maxs], 2d-arrays channels x blocks, level i has blocks of block_size * factor ** i samples
+    """
+
+    def __init__(self, recording, block_size=64, factor=4, chunk_size=2 ** 18):
+        """
+        build the pyramid, the recording is read once, chunk by chunk
+        :param recording: RawDF object
+        :param block_size: number of samples in a block of the finest level
+        :param factor: reduction factor between two levels
+        :param chunk_size: number of samples read from the recording at once
+        """
+        self.recording = recording
+        self.block_size = block_size
+        self.factor = factor
+        self.ch_index = {ch_name: i for i, ch_name in enumerate(recording.ch_names)}
+
+        chunk_size = max(chunk_size // block_size, 1) * block_size
+        mins, maxs = [], []
+        for start in range(0, recording.n_times, chunk_size):
+            chunk = recording.get_window(None, start, start + chunk_size)
+            chunk_min, chunk_max = self.reduce(chunk, chunk, block_size)
+            mins.append(chunk_min.astype(np.float32))
+            maxs.append(chunk_max.astype(np.float32))
+        self.levels = [[np.hstack(mins), np.hstack(maxs)]]
+
+        while self.levels[-1][0].shape[1] > 1:
+            level_min, level_max = self.levels[-1]
+            self.levels.append(list(self.reduce(level_min, level_max, factor)))
+
+    def memory_usage(self):
+        """
+        :return: number of bytes of the levels
+        """
+        return int(sum(level_min.nbytes + level_max.nbytes for level_min, level_max in self.levels))
+
+    @staticmethod
+    def reduce(mins, maxs, size):
+        """
+        merge every `size` consecutive columns, the last group may be shorter
+        :param mins: 2d-array, channels x columns
+        :param maxs: 2d-array, channels x columns
+        :param size: number of columns in a group
+        :return: [mins, maxs] of the groups
+        """
+        edges = np.arange(0, mins.shape[1], size)
+        return [np.minimum.reduceat(mins, edges, axis=1), np.maximum.reduceat(maxs, edges, axis=1)]
+
+    def window(self, channels, start, stop, n_points):
+        """
+        envelope of some channels in [start, stop), with at most n_points points per channel
+        every bucket of samples gives two points, its minimum and its maximum
+        :param channels: channel names or channel indices
+        :param start: first sample
+        :param stop: last sample (excluded)
+        :param n_points: maximum number of points per channel
+        :return: [x: times of the points, y: 2d-array channels x points]
+        """
+        picks = [self.ch_index[i] if isinstance(i, str) else int(i) for i in channels]
+        stop = min(int(stop), self.recording.n_times)
+        start = min(max(int(start), 0), stop)
+        n_buckets = max(n_points // 2, 1)
+        bucket_size = int(np.ceil((stop - start) / n_buckets))
+
+        if bucket_size < self.block_size:
+            # few samples per bucket, reducing the raw samples is cheap
+            data = self.recording.get_window(picks, start, stop)
+            if bucket_size <= 1:
+                return [self.recording.times[start:stop], data]
+            bucket_starts = np.arange(start, stop, bucket_size)
+            y_min, y_max = self.reduce(data, data, bucket_size)
+        else:
+            level = int(np.log(bucket_size / self.block_size) / np.log(self.factor))
+            level = min(level, len(self.levels) - 1)
+            level_block = self.block_size * self.factor ** level
+            level_min, level_max = self.levels[level]
+            first_block, last_block = start // level_block, int(np.ceil(stop / level_block))
+            blocks_per_bucket = int(np.ceil(bucket_size / level_block))
+            y_min, y_max = self.reduce(level_min[picks, first_block:last_block],
+                                       level_max[picks, first_block:last_block], blocks_per_bucket)
+            bucket_starts = np.arange(first_block, last_block, blocks_per_bucket) * level_block
+
+        x = np.repeat(bucket_starts / self.recording.freq, 2)
+        y = np.empty((len(picks), 2 * y_min.shape[1]), dtype=y_min.dtype)
+        y[:, 0::2] = y_min
+        y[:, 1::2] = y_max
+        return [x, y]
+
+
+def envelope_window(read, start, stop, n_points, fs, chunk_size=2 ** 18):
+    """
+    envelope of a transformed signal (filtered, smoothed) in [start, stop), buckets as in MinMaxPyramid.window
+    the pyramid only holds the raw samples, here the window is read chunk by chunk and every chunk is reduced
+    :param read: function returning the samples in [begin, end), 2d-array (channels x samples)
+    :param start: first sample
+    :param stop: last sample (excluded)
+    :param n_points: maximum number of points per channel
+    :param fs: sampling frequency
+    :param chunk_size: number of samples read at once
+    :return: [x: times of the points, y: 2d-array channels x points]
+    """
+    n_buckets = max(n_points // 2, 1)
+    bucket_size = int(np.ceil((stop - start) / n_buckets))
+    if bucket_size <= 1:
+        return [np.arange(start, stop) / fs, read(start, stop)]
+
+    chunk_size = max(chunk_size // bucket_size, 1) * bucket_size
+    mins, maxs = [], []
+    for begin in range(start, stop, chunk_size):
+        chunk = read(begin, min(begin + chunk_size, stop))
+        chunk_min, chunk_max = MinMaxPyramid.reduce(chunk, chunk, bucket_size)
+        mins.append(chunk_min)
+        maxs.append(chunk_max)
+    y_min, y_max = np.hstack(mins), np.hstack(maxs)
+
+    x = np.repeat(np.arange(start, stop, bucket_size) / fs, 2)
+    y = np.empty((y_min.shape[0], 2 * y_min.shape[1]), dtype=y_min.dtype)
+    y[:, 0::2] = y_min
+    y[:, 1::2] = y_max
+    return [x, y]
+
+
+_pyramids_lock = threading.Lock()
+
+
+def get_pyramid(recording):
+    """
+    the pyramid of a recording, built on the first call and shared afterwards
+    it is kept in recording.derived, the recording store counts it in the memory of the recording
+    :param recording: RawDF object
+    :return: MinMaxPyramid object
+    """
+    with _pyramids_lock:
+        if 'pyramid' not in recording.derived:
+            recording.derived['pyramid'] = MinMaxPyramid(recording)
+        return recording.derived['pyramid']
@@ -4,49 +4,118 @@ import numpy as np
 def stack_x_axis_times(times, num):
     """
     Stack x axis data(mostly time in EEG), used in bokeh.plotting.figure.multi_line
+    Every channel shares the same time array, nothing is copied.
     :param times: x axis data, mostly time
     :param num: how many channels we want to use
     :return: stacked time steps
     """
-    stacked_times = []
-    for i in range(num):
-        stacked_times.append(times)
-
-    return stacked_times
+    return [times] * num
 
 
 def stack_y_axis_signals(signals, num, offset, *channels):
     """
     Stack y axis(mostly signal, time series), used in bokeh.plotting.figure.multi_line
+    The offsets are added in one broadcast operation, the returned lines are rows of a single 2d-array
+    keeping the sample type of the signals (float32 signals give float32 lines).
     :param signals: signal time series we want to stack together
     :param num: how many channel we want to use
     :param offset: offset between each channel
     :param channels: selected channels
     :return: stacked signals
     """
+    dtype = signals.dtype if np.issubdtype(signals.dtype, np.floating) else np.float64
+    offsets = (np.arange(num)[:, np.newaxis] * offset).astype(dtype)
     if channels:
-        channels = channels[0]
+        stacked_signals = signals[np.asarray(channels[0])[:num]] + offsets
     else:
-        channels = np.arange(0, num, 1)
-
-    stacked_signals = []
-    for i in range(num):
-        stacked_signals.append(signals[channels[i], :] + i * offset)
+        stacked_signals = signals[:num] + offsets
 
-    return stacked_signals
+    return list(stacked_signals)
 
 
 def stackc_tick_loc(signal, num, offset):
     """
     Stacked tick location for the bokeh plot.
-    :param signal: time series signal
+    :param signal: time series signal, or the mean of each channel (see RawDF.channel_stats)
     :param num: channel number
     :param offset: offset between different channels
     :return: stacked ticker
     """
-    y_tick_loc = []
-    for i in range(num):
-        y_tick_loc.append(np.mean(signal[i, :]) + i * offset)
+    if np.ndim(signal) == 1:
+        channel_means = np.asarray(signal[:num])
+    else:
+        channel_means = np.mean(signal[:num], axis=1)
+
+    y_tick_loc = np.around(channel_means + np.arange(num) * offset, 5)
+    return y_tick_loc
+
+
+def auto_offset(channel_std, scale=6):
+    """
+    Offset between stacked channels that keeps typical channels from overlapping.
+    :param channel_std: standard deviation of each channel (see RawDF.channel_stats)
+    :param scale: number of standard deviations between two channels
+    :return: offset
+    """
+    offset = scale * np.median(channel_std)
+    if not np.isfinite(offset) or offset <= 0:
+        offset = 1.0
+    return float(offset)
+
+
+def stack_line_columns(x, signals, num, offset):
+    """
+    Columns of a ColumnDataSource drawn with one line renderer per channel, all channels share the x column.
+    Every column is a single typed array, so bokeh sends it binary encoded, and new samples can be
+    appended with ColumnDataSource.stream.
+    :param x: x axis data, mostly time
+    :param signals: signal time series, channels x samples
+    :param num: how many channels we want to use
+    :param offset: offset between each channel
+    :return: dictionary with the columns x, y_0, ..., y_{num-1}
+    """
+    columns = dict(x=np.asarray(x))
+    for i, line in enumerate(stack_y_axis_signals(signals, num, offset)):
+        columns['y_%d' % i] = line
+    return columns
+
+
+def rasterize_lanes(x, signals, offset, x_range, y_range, width, height):
+    """
+    Draw stacked channels into a pixel grid on the server, the browser then receives one image
+    whatever the number of channels. Every pixel column covers the samples falling into it, and
+    is filled between their minimum and maximum, joined to the last sample of the previous column.
+    :param x: x axis data, mostly time, increasing
+    :param signals: signal time series, channels x samples (raw samples or a min/max envelope)
+    :param offset: offset between each channel
+    :param x_range: [left, right] of the image
+    :param y_range: [bottom, top] of the image
+    :param width: number of pixel columns
+    :param height: number of pixel rows
+    :return: 2d-array of uint8, rows x columns, 1 where a channel crosses the pixel, row 0 at the bottom
+    """
+    image = np.zeros((height, width), dtype=np.uint8)
+    num, n = signals.shape
+    if num == 0 or n == 0:
+        return image
+
+    columns = np.clip(((np.asarray(x) - x_range[0]) / (x_range[1] - x_range[0]) * width).astype(int), 0, width - 1)
+    edges = np.flatnonzero(np.r_[True, np.diff(columns) > 0])
+    stacked = signals + (np.arange(num)[:, np.newaxis] * offset).astype(signals.dtype)
+    y_min = np.minimum.reduceat(stacked, edges, axis=1)
+    y_max = np.maximum.reduceat(stacked, edges, axis=1)
+    last = stacked[:, np.r_[edges[1:], n] - 1]
+    y_min[:, 1:] = np.minimum(y_min[:, 1:], last[:, :-1])
+    y_max[:, 1:] = np.maximum(y_max[:, 1:], last[:, :-1])
+
+    scale = height / (y_range[1] - y_range[0])
+    row_min = np.clip(((y_min - y_range[0]) * scale).astype(int), 0, height - 1)
+    row_max = np.clip(((y_max - y_range[0]) * scale).astype(int), 0, height - 1)
 
-    y_tick_loc = np.around(y_tick_loc, 5)
-    return y_tick_loc
\ No newline at end of file
+    # every span adds one at its first row and removes one after its last row, a cumulative sum fills it
+    spans = np.zeros((height + 1, width), dtype=np.int32)
+    column_index = np.broadcast_to(columns[edges], row_min.shape)
+    np.add.at(spans, (row_min, column_index), 1)
+    np.add.at(spans, (row_max + 1, column_index), -1)
+    image[np.cumsum(spans[:height], axis=0) > 0] = 1
+    return image
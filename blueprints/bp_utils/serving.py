@@ -0,0 +1,14 @@
+import itertools
+
+_pages = itertools.count()
+
+
+def bokeh_app_url(app_path, config):
+    """
+    url of a bokeh app, successive pages are spread over the bokeh worker processes in turn
+    :param app_path: name of the app, e.g. 'signal_bkapp'
+    :param config: content of config.yaml, BOKEH_PORT is the port of the first worker
+    :return: url for bokeh.embed.server_document
+    """
+    worker = next(_pages) % max(int(config['BOKEH_WORKERS']), 1)
+    return "http://localhost:{}/{}".format(config['BOKEH_PORT'] + worker, app_path)
@@ -1,24 +1,76 @@
 import numpy as np
-from scipy import fft, signal, integrate
+from scipy import ndimage
+from scipy import signal as sp_signal
+from ..source_utils import FrequencyAnalysis
+
+SMOOTH_METHODS = ['box', 'gaussian', 'savgol']
+
+
+def smooth_multichannel(signal, window, method='box', axis=-1, polyorder=3):
+    """
+    Smooth every channel in one vectorized call, samples outside the signal count as zeros,
+    like np.convolve(channel, np.ones(window) / window, mode='same') for the box
+    :param signal: 1-channel signal or multichannel signal
+    :param window: number of samples of the smoothing window, 0 or 1 leaves the signal unchanged
+    :param method: 'box' (moving average, from cumulative sums, the cost does not depend on the window),
+                   'gaussian' (the window covers +-3 standard deviations) or 'savgol' (Savitzky-Golay)
+    :param axis: time axis
+    :param polyorder: order of the Savitzky-Golay polynomials
+    :return: smoothed signal, same shape, float32 input stays float32
+    """
+    signal = np.asarray(signal)
+    window = int(window)
+    if window <= 1 or signal.shape[axis] == 0:
+        return signal
+    dtype = signal.dtype if signal.dtype == np.float32 else np.float64
+
+    if method == 'box':
+        data = np.moveaxis(signal, axis, -1)
+        n = data.shape[-1]
+        # cumulative sums padded so that sample i averages [i - window // 2, i + (window - 1) // 2],
+        # the window of mode='same', the padding clips it to the signal
+        cumsum = np.empty(data.shape[:-1] + (n + window,))
+        cumsum[..., :window // 2 + 1] = 0
+        np.cumsum(data, axis=-1, dtype=np.float64, out=cumsum[..., window // 2 + 1:window // 2 + 1 + n])
+        cumsum[..., window // 2 + 1 + n:] = cumsum[..., window // 2 + n:window // 2 + 1 + n]
+        smoothed = np.subtract(cumsum[..., window:], cumsum[..., :n])
+        smoothed /= window
+        smoothed = np.moveaxis(smoothed, -1, axis)
+    elif method == 'gaussian':
+        smoothed = ndimage.gaussian_filter1d(signal.astype(np.float64), window / 6, axis=axis, mode='constant',
+                                             truncate=3.0)
+    elif method == 'savgol':
+        window_length = window if window % 2 else window + 1
+        smoothed = sp_signal.savgol_filter(signal.astype(np.float64), window_length,
+                                           min(polyorder, window_length - 1), axis=axis, mode='constant')
+    else:
+        raise ValueError("smoothing method has to be 'box', 'gaussian' or 'savgol'!")
+    return smoothed.astype(dtype, copy=False)
 
 
 def convolve_multichannel(signal, kernel, axis):
     """
-    Apply 1D convolution for multichannel time series
+    Apply 1D convolution for multichannel time series, all channels in one call
     :param signal: multichannel signal
-    :param kernel: kernel that will be applied to each channel
-    :param axis: which axis we want to apply the convolution
-    :return: convolved multichannel signal
+    :param kernel: kernel that will be applied to each channel, None, an empty kernel, [1] or a kernel starting
+                   with -1 (smoothing off) leave the signal unchanged,
+                   a constant kernel (moving average) goes through smooth_multichannel
+    :param axis: which axis holds the channels, the convolution runs along the other one
+    :return: convolved multichannel signal, edges as np.convolve(mode='same')
     """
-    if kernel[0] == -1:
-        data_convolved = signal
-    else:
-        ch_num = signal.shape[axis]
-        data_convolved = np.zeros_like(signal)
-        for i in range(ch_num):
-            data_convolved[i] = np.convolve(signal[i], kernel, mode='same')
+    if kernel is None or len(kernel) == 0 or kernel[0] == -1 or len(kernel) == 1 and kernel[0] == 1:
+        return signal
+    kernel = np.asarray(kernel, dtype=np.float64)
+    time_axis = 1 - axis
+    if np.all(kernel == kernel[0]):
+        return smooth_multichannel(signal, kernel.size, 'box', axis=time_axis) * (kernel[0] * kernel.size)
 
-    return data_convolved
+    kernel_shape = [1, 1]
+    kernel_shape[time_axis] = kernel.size
+    dtype = signal.dtype if signal.dtype == np.float32 else np.float64
+    data_convolved = sp_signal.oaconvolve(signal.astype(np.float64), kernel.reshape(kernel_shape), mode='same',
+                                          axes=time_axis)
+    return data_convolved.astype(dtype, copy=False)
 
 
 def butter_bandpass_filter(cls, data, lowcut, highcut, fs, order=5):
@@ -31,9 +83,7 @@ def butter_bandpass_filter(cls, data, lowcut, highcut, fs, order=5):
     :param order: parameter in the butter function
     :return: filtered data
     '''
-    b, a = signal.butter(order, [lowcut, highcut], fs=fs, btype='band')
-    y = signal.filtfilt(b, a, data)
-    return y
+    return FrequencyAnalysis.butter_bandpass_filter(data, lowcut, highcut, fs, order)
 
 
 def butter_lowpass_filter(cls, data, cutoff, fs, order=5):
@@ -45,9 +95,7 @@ def butter_lowpass_filter(cls, data, cutoff, fs, order=5):
     :param order: parameter for the butter function
     :return: filtered signal
     '''
-    b, a = signal.butter(order, cutoff, fs=fs, btype='low', analog=False)
-    y = signal.filtfilt(b, a, data)
-    return y
+    return FrequencyAnalysis.butter_lowpass_filter(data, cutoff, fs, order)
 
 
 def butter_highpass_filter(cls, data, cutoff, fs, order=5):
@@ -59,11 +107,7 @@ def butter_highpass_filter(cls, data, cutoff, fs, order=5):
     :param order: order parameter for signal.signal.butter function
     :return: filtered signal
     '''
-    nyq = 0.5 * fs
-    normal_cutoff = cutoff / nyq
-    b, a = signal.butter(order, normal_cutoff, btype='high', analog=False)
-    y = signal.filtfilt(b, a, data)
-    return y
+    return FrequencyAnalysis.butter_highpass_filter(data, cutoff, fs, order)
 
 
 def notch_filter(cls, data, notch_freq, fs, quality_factor=30):
@@ -75,9 +119,7 @@ def notch_filter(cls, data, notch_freq, fs, quality_factor=30):
     :param quality_factor: parameter for the scipy.signal.iirnotch function
     :return: filtered signal
     '''
-    b, a = signal.iirnotch(notch_freq, quality_factor, fs)
-    y = signal.filtfilt(b, a, data)
-    return y
+    return FrequencyAnalysis.notch_filter(data, notch_freq, fs, quality_factor)
 
 
 def signal_time_in_freq_out(cls, data, cutoff, fs, filter_type, order=5):
@@ -92,102 +134,14 @@ def signal_time_in_freq_out(cls, data, cutoff, fs, filter_type, order=5):
     :return: [xf_half, yf_half]: Turn the filtered data into frequency domain and only output half
                                 (positive frequency) of the frequency domain signal
     '''
-    if filter_type == 'low':
-        y = cls.butter_lowpass_filter(data, cutoff, fs, order)
-        yf = fft.fft(y)
-        xf = fft.fftfreq(len(y), 1 / fs)
-
-        xf_ind = np.where(xf >= 0)
-        yf_half = yf[xf_ind]
-        xf_half = xf[xf_ind]
-        return [xf_half, yf_half]
-
-    elif filter_type == 'high':
-        y = cls.butter_highpass_filter(data, cutoff, fs, order)
-        yf = fft.fft(y)
-        xf = fft.fftfreq(len(y), 1 / fs)
-
-        xf_ind = np.where(xf >= 0)
-        yf_half = yf[xf_ind]
-        xf_half = xf[xf_ind]
-        return [xf_half, yf_half]
-
-    elif filter_type == 'band':
-        lowcut = cutoff[0]
-        highcut = cutoff[1]
-        y = cls.butter_bandpass_filter(data, lowcut, highcut, fs, order)
-        yf = fft.fft(y)
-        xf = fft.fftfreq(len(y), 1 / fs)
-
-        xf_ind = np.where(xf >= 0)
-        yf_half = yf[xf_ind]
-        xf_half = xf[xf_ind]
-        return [xf_half, yf_half]
-
-    elif filter_type == 'notch':
-        # Notice that the order here is the quality factor for notch
-        y = cls.notch_filter(data, cutoff, fs, order)
-        yf = fft.fft(y)
-        xf = fft.fftfreq(len(y), 1 / fs)
-
-        xf_ind = np.where(xf >= 0)
-        yf_half = yf[xf_ind]
-        xf_half = xf[xf_ind]
-        return [xf_half, yf_half]
+    return FrequencyAnalysis.signal_time_in_freq_out(data, cutoff, fs, filter_type, order)
 
 
 def db4_filter(cls, data, freq):
     '''
-    Apply db4 filter on EEG data
+    Power of the db4 bands (32-64, 16-32, 8-16, 4-8 and 0.5-4 Hz) after a 60 Hz notch filter
     :param data: 1-channel data, a time series
-    :param freq:
-    :return:
+    :param freq: sampling frequency
+    :return: [power_32_64, power_16_32, power_8_16, power_4_8, power_0_4]
     '''
-
-    xf_60, yf_60 = cls.signal_time_in_freq_out(data, 60, freq, 'notch', order=30)
-    data = cls.notch_filter(data, 60, freq, quality_factor=30)
-
-    xf_0_64, yf_0_64 = cls.signal_time_in_freq_out(data, 64, freq, 'low')
-    y_0_64 = cls.butter_lowpass_filter(data, 64, freq)
-
-    xf_0_32, yf_0_32 = cls.signal_time_in_freq_out(y_0_64, 32, freq, 'low')
-    y_0_32 = cls.butter_lowpass_filter(y_0_64, 32, freq)
-
-    xf_32_64, yf_32_64 = cls.signal_time_in_freq_out(y_0_64, 32, freq, 'high')
-    y_32_64 = cls.butter_highpass_filter(y_0_64, 32, freq)
-    f_32_64, power_den_32_64 = signal.welch(y_32_64, freq, nperseg=1024)
-    power_32_64 = integrate.trapz(power_den_32_64, f_32_64)
-
-    xf_32_64_tmp, yf_32_64_tmp = cls.signal_time_in_freq_out(data, [32, 64], freq, 'band')
-    y_32_64_tmp = cls.butter_bandpass_filter(data, 32, 64, freq)
-
-    xf_0_16, yf_0_16 = cls.signal_time_in_freq_out(y_0_32, 16, freq, 'low')
-    y_0_16 = cls.butter_lowpass_filter(y_0_32, 16, freq)
-
-    xf_16_32, yf_16_32 = cls.signal_time_in_freq_out(y_0_32, 16, freq, 'high')
-    y_16_32 = cls.butter_highpass_filter(y_0_32, 16, freq)
-    f_16_32, power_den_16_32 = signal.welch(y_16_32, freq, nperseg=1024)
-    power_16_32 = integrate.trapz(power_den_16_32, f_16_32)
-
-    xf_0_8, yf_0_8 = cls.signal_time_in_freq_out(y_0_16, 8, freq, 'low')
-    y_0_8 = cls.butter_lowpass_filter(y_0_16, 8, freq)
-
-    xf_8_16, yf_8_16 = cls.signal_time_in_freq_out(y_0_16, 8, freq, 'high')
-    y_8_16 = cls.butter_highpass_filter(y_0_16, 8, freq)
-    f_8_16, power_den_8_16 = signal.welch(y_8_16, freq, nperseg=1024)
-    power_8_16 = integrate.trapz(power_den_8_16, f_8_16)
-
-    xf_0_4, yf_0_4 = cls.signal_time_in_freq_out(y_0_8, 4, freq, 'low')
-    y_0_4 = cls.butter_lowpass_filter(y_0_8, 4, freq)
-
-    xf_4_8, yf_4_8 = cls.signal_time_in_freq_out(y_0_8, 4, freq, 'high')
-    y_4_8 = cls.butter_highpass_filter(y_0_8, 4, freq)
-    f_4_8, power_den_4_8 = signal.welch(y_4_8, freq, nperseg=1024)
-    power_4_8 = integrate.trapz(power_den_4_8, f_4_8)
-
-    xf_0_4, yf_0_4 = cls.signal_time_in_freq_out(y_0_4, 0.5, freq, 'high')
-    y_0_4 = cls.butter_highpass_filter(y_0_8, 0.5, freq)
-    f_0_4, power_den_0_4 = signal.welch(y_0_4, freq, nperseg=1024)
-    power_0_4 = integrate.trapz(power_den_0_4, f_0_4)
-
-    return [power_32_64, power_16_32, power_8_16, power_4_8, power_0_4]
+    return FrequencyAnalysis.db4_filter(data, freq)
@@ -3,12 +3,13 @@ from flask import render_template, Blueprint
 import mne
 import yaml
 import numpy as np
-from scipy import signal
 from .source_utils import FrequencyAnalysis as fa
-from .source_utils import RawDF, SpectrumDF, FrequencyAnalysis
+from .source_utils import RawDF, SpectrumDF, FrequencyAnalysis, recording_store, metrics, spectral
+from .source_utils import CrossFrequencyCoupling as cfc
+from .bp_utils import LatestWinsRunner, RecordingLoader, bokeh_app_url
 from bokeh.embed import server_document
 from bokeh.layouts import column, row
-from bokeh.models import ColumnDataSource, Slider, Select, TextInput
+from bokeh.models import ColumnDataSource, Slider, Select, TextInput, Button, Div
 from bokeh.plotting import figure
 
 
@@ -19,9 +20,11 @@ def cfc_bkapp(doc):
 
     # import os
     # print(os.listdir('./'))
-    raw_edf = RawDF(filename=config['FILENAME'])
+    metrics.inc('eeg_active_sessions', app='cfc')
+    recording_store.set_budget(config['STORE_BUDGET'])
+    raw_edf = recording_store.get_raw(config['FILENAME'], owner=id(doc), lazy=config['LAZY'],
+                                      dtype=config['PRECISION'])
     current_channel = 0
-    data = raw_edf.raw.get_data()[current_channel]
     ch_num = raw_edf.nchan
     fs = raw_edf.freq
     fNQ = fs / 2
@@ -30,25 +33,40 @@ def cfc_bkapp(doc):
     Wn1 = [config['WIN1'][0], config['WIN1'][1]]
     Wn2 = [config['WIN2'][0], config['WIN2'][1]]
 
-    if notch_freq != None:
-        b_notch, a_notch = signal.iirnotch(notch_freq, quality_factor, fs)
-        data = signal.filtfilt(b_notch, a_notch, data)
-
     n = 100  # filter order,
-    b1 = signal.firwin(n, Wn1, nyq=fNQ, pass_zero=False, window='hamming')
-    b2 = signal.firwin(n, Wn2, nyq=fNQ, pass_zero=False, window='hamming')
-    V1 = signal.filtfilt(b1, 1, data)
-    V2 = signal.filtfilt(b2, 1, data)
-    phi = np.angle(signal.hilbert(V1))
-    amp = abs(signal.hilbert(V2))
-
-    t = np.arange(0, len(data) / fs, 1 / fs)
+
+    def read_channel(raw, channel):
+        return lambda begin, end: raw.get_window([channel], begin, end)[0]
+
+    def demo_window(channel, start_time, band1, band2, notch, quality=30):
+        """
+        2s of a channel and of its two bands, only the window and the padding of the filters are filtered
+        """
+        start = min(int(start_time * fs), raw_edf.n_times)
+        stop = min(start + int(2 * fs), raw_edf.n_times)
+        notch_filters = (('notch', notch),) if notch is not None else ()
+        read = read_channel(raw_edf, channel)
+        return dict(t=raw_edf.times[start:stop],
+                    signal=fa.filter_window(read, start, stop, raw_edf.n_times, fs, notch_filters,
+                                            quality_factor=quality),
+                    V1=fa.filter_window(read, start, stop, raw_edf.n_times, fs, notch_filters + (('fir', band1),),
+                                        quality_factor=quality, numtaps=n),
+                    V2=fa.filter_window(read, start, stop, raw_edf.n_times, fs, notch_filters + (('fir', band2),),
+                                        quality_factor=quality, numtaps=n))
+
+    def analytic_signal(raw, channel, interval, band, notch):
+        """
+        analytic signal of a band of a channel in an interval, filtered with the padding of its filters,
+        plus a few cycles of the band so that the Hilbert transform is not distorted at the edges either
+        """
+        start, stop = (0, raw.n_times) if interval is None else (max(interval[0], 0), min(interval[1], raw.n_times))
+        filters = ((('notch', notch),) if notch is not None else ()) + (('fir', band),)
+        data, begin = fa.padded_window(read_channel(raw, channel), start, stop, raw.n_times, fs, filters, numtaps=n,
+                                       padding=cfc.band_numtaps(band, fs))
+        return spectral.analytic_signal(data)[start - begin:stop - begin]
+
     t_int = [24, 26]
-    source1 = ColumnDataSource(data=dict(t=t[int(t_int[0] * fs):int(t_int[1] * fs)],
-                                         signal=data[int(t_int[0] * fs):int(t_int[1] * fs)],
-                                         V1=V1[int(t_int[0] * fs):int(t_int[1] * fs)],
-                                         V2=V2[int(t_int[0] * fs):int(t_int[1] * fs)],
-                                         ))
+    source1 = ColumnDataSource(data=demo_window(current_channel, t_int[0], Wn1, Wn2, notch_freq, quality_factor))
 
     p1 = figure(width=600, height=300)
     p1.line('t', 'signal', source=source1, line_color='skyblue', line_width=2, legend_label="data")
@@ -58,19 +76,13 @@ def cfc_bkapp(doc):
     p1.legend.click_policy = 'hide'
 
     p_bins = np.arange(-np.pi, np.pi, 0.1)
-    a_mean = np.zeros(np.size(p_bins) - 1)
-    p_mean = np.zeros(np.size(p_bins) - 1)
-    for k in range(np.size(p_bins) - 1):  # For each phase bin,
-        pL = p_bins[k]  # ... lower phase limit,
-        pR = p_bins[k + 1]  # ... upper phase limit.
-        indices = (phi >= pL) & (phi < pR)  # Find phases falling in bin,
-        a_mean[k] = np.mean(amp[indices])  # ... compute mean amplitude,
-        p_mean[k] = np.mean([pL, pR])  # ... save center phase.
 
-
-    source2 = ColumnDataSource(data=dict(V1=p_mean, V2=a_mean))
+    # the distribution over the whole recording is computed by the first update
+    source2 = ColumnDataSource(data=dict(V1=[], V2=[]))
     p2 = figure(width=600, height=300)
     p2.line('V1', 'V2', source=source2, line_color='skyblue', line_width=2, )
+    mi_output = TextInput(title='Modulation Index (Tort):', value='')
+    mvl_output = TextInput(title='Mean Vector Length:', value='')
 
     file_input1 = TextInput(title="Base File(Don't change): ", value=config['FILENAME'])
     file_input2 = TextInput(title='Compare File: ', value=config['FILENAME'])
@@ -84,11 +96,57 @@ def cfc_bkapp(doc):
     time_interval_input2 = TextInput(title='Time Interval Comparison(time point):', value='All')
     band_input1 = TextInput(title='Frequency Base: ', value='{wn1},{wn2}'.format(wn1=Wn1[0], wn2=Wn1[1]))
     band_input2 = TextInput(title='Frequency Comparison: ', value='{wn1},{wn2}'.format(wn1=Wn2[0], wn2=Wn2[1]))
-    time_slider = Slider(value=0, start=0, end=len(data) / fs, title="Demo for 2s")
+    time_slider = Slider(value=0, start=0, end=raw_edf.n_times / fs, title="Demo for 2s")
     item_selector1 = Select(title="V1 Option:", value="phase", options=["phase", "amplitude"])
     item_selector2 = Select(title="V2 Option:", value="amplitude", options=["phase", "amplitude"])
 
-    file_bank = {config['FILENAME']: raw_edf}
+    phase_grid_input = TextInput(title='Comodulogram Phase Bands (start,stop,width):', value='2,22,1')
+    amp_grid_input = TextInput(title='Comodulogram Amplitude Bands (start,stop,width):', value='20,170,5')
+    comodulogram_button = Button(label='Compute Comodulogram (base channel and interval)', width=400)
+    source3 = ColumnDataSource(data=dict(image=[np.zeros((1, 1))], x=[0], y=[0], dw=[1], dh=[1]))
+    p3 = figure(width=600, height=400, title='Comodulogram (modulation index)',
+                x_axis_label='Phase frequency (Hz)', y_axis_label='Amplitude frequency (Hz)')
+    p3.image(image='image', x='x', y='y', dw='dw', dh='dh', source=source3, palette='Viridis256')
+    busy_div = Div(text='<i>Updating...</i>', visible=False)
+    comodulogram_busy_div = Div(text='<i>Computing the comodulogram...</i>', visible=False)
+    runner = LatestWinsRunner(doc, busy=busy_div, name='cfc:update_data')
+    comodulogram_runner = LatestWinsRunner(doc, busy=comodulogram_busy_div, name='cfc:comodulogram')
+    compare_div = Div(text='', visible=False)
+    # the compare file is opened in the background, the coupling is recomputed with it once it is open
+    compare_loader = RecordingLoader(doc, status=compare_div, on_ready=lambda: update_data(None, None, None),
+                                     write_cache=config['CACHE_COMPARE'], lazy=config['LAZY'],
+                                     dtype=config['PRECISION'])
+
+    def update_comodulogram():
+        phase_grid = [float(i) for i in phase_grid_input.value.split(',')]
+        amp_grid = [float(i) for i in amp_grid_input.value.split(',')]
+        phase_bands = [[f, f + phase_grid[2]] for f in np.arange(phase_grid[0], phase_grid[1], phase_grid[2])]
+        amp_bands = [[f, f + amp_grid[2]] for f in np.arange(amp_grid[0], amp_grid[1], amp_grid[2])]
+
+        channel_update1 = channel_slider1.value
+        time_interval_update1 = time_interval_input1.value
+        notch_update1 = notch_input1.value
+
+        def compute():
+            if time_interval_update1.lower() == 'all':
+                y_base = raw_edf.get_window([channel_update1])[0]
+            else:
+                interval_update1 = [int(i) for i in time_interval_update1.split(',')]
+                y_base = raw_edf.get_window([channel_update1], interval_update1[0], interval_update1[1])[0]
+            if notch_update1.lower() != 'none':
+                y_base = fa.notch_filter(y_base, float(notch_update1), fs)
+
+            return cfc.comodulogram(y_base, fs, phase_bands, amp_bands, workers=config['COMODULOGRAM_WORKERS'])
+
+        def apply(mi):
+            data_update = dict(image=[mi], x=[phase_bands[0][0]], y=[amp_bands[0][0]],
+                               dw=[phase_bands[-1][1] - phase_bands[0][0]], dh=[amp_bands[-1][1] - amp_bands[0][0]])
+            metrics.observe_payload('eeg_payload_bytes', data_update, app='cfc')
+            source3.data = data_update
+
+        comodulogram_runner.submit(compute, apply)
+
+    comodulogram_button.on_click(update_comodulogram)
 
     def update_data(attribute, old, new):
         file_update2 = file_input2.value
@@ -106,101 +164,68 @@ def cfc_bkapp(doc):
         item_update1 = item_selector1.value
         item_update2 = item_selector2.value
 
-        data_base = raw_edf.raw.get_data()[channel_update1]
-
-        if file_update2 in file_bank.keys():
-            raw_noba = file_bank[file_update2]
-            data_noba = raw_noba.raw.get_data()[channel_update2]
-        else:
-            raw_noba = RawDF(filename=file_update2)
-            data_noba = raw_noba.raw.get_data()[channel_update2]
-            file_bank[file_update2] = raw_noba
-
-        if time_interval_update1.lower() == 'all':
-            y_base_filted = data_base
-        else:
-            interval_update1 = time_interval_update1.split(',')
-            interval_update1[0] = int(interval_update1[0])
-            interval_update1[1] = int(interval_update1[1])
-            y_base_filted = data_base[interval_update1[0]:interval_update1[1]]
-
-        if time_interval_update2.lower() == 'all':
-            y_noba_filted = data_noba
-        else:
-            interval_update2 = time_interval_update2.split(',')
-            interval_update2[0] = int(interval_update2[0])
-            interval_update2[1] = int(interval_update2[1])
-            y_noba_filted = data_noba[interval_update2[0]:interval_update2[1]]
-
-        if notch_update1.lower() != 'none':
-            try:
-                cutoff = float(notch_update1)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_base_filted = fa.notch_filter(y_base_filted, cutoff, fs)
-        else:
-            pass
-
-        if notch_update2.lower() != 'none':
-            try:
-                cutoff = float(notch_update2)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_noba_filted = fa.notch_filter(y_noba_filted, cutoff, fs)
-        else:
-            pass
-
         band_update1 = band_update1.split(',')
         band_update2 = band_update2.split(',')
         Wn_update1 = [int(band_update1[0]), int(band_update1[1])]
         Wn_update2 = [int(band_update2[0]), int(band_update2[1])]
-
-        b_update1 = signal.firwin(n, Wn_update1, nyq=fNQ, pass_zero=False, window='hamming')
-        b_update2 = signal.firwin(n, Wn_update2, nyq=fNQ, pass_zero=False, window='hamming')
-        V_update1 = signal.filtfilt(b_update1, 1, y_base_filted)
-        V_update2 = signal.filtfilt(b_update2, 1, y_noba_filted)
-        phi1 = np.angle(signal.hilbert(V_update1))
-        phi2 = np.angle(signal.hilbert(V_update2))
-        amp1 = abs(signal.hilbert(V_update1))
-        amp2 = abs(signal.hilbert(V_update2))
-        print(phi1)
-        print(phi2)
-        print(amp2)
-
-        t_int_update = [int(time_demo_update), 2 + int(time_demo_update)]
-        source1.data = dict(t=t[int(t_int_update[0] * fs):int(t_int_update[1] * fs)],
-                            signal=data[int(t_int_update[0] * fs):int(t_int_update[1] * fs)],
-                            V1=V1[int(t_int_update[0] * fs):int(t_int_update[1] * fs)],
-                            V2=V2[int(t_int_update[0] * fs):int(t_int_update[1] * fs)],
-                            )
-
-        a_mean1 = np.zeros(np.size(p_bins) - 1)
-        p_mean1 = np.zeros(np.size(p_bins) - 1)
-        a_mean2 = np.zeros(np.size(p_bins) - 1)
-        p_mean2 = np.zeros(np.size(p_bins) - 1)
-        for k in range(np.size(p_bins) - 1):  # For each phase bin,
-            pL = p_bins[k]  # ... lower phase limit,
-            pR = p_bins[k + 1]  # ... upper phase limit.
-            indices1 = (phi1 >= pL) & (phi1 < pR)  # Find phases falling in bin,
-            a_mean1[k] = np.mean(amp1[indices1])  # ... compute mean amplitude,
-            p_mean1[k] = np.mean([pL, pR])  # ... save center phase.
-
-            indices2 = (phi1 >= pL) & (phi1 < pR)  # Find phases falling in bin,
-            a_mean2[k] = np.mean(amp2[indices2])  # ... compute mean amplitude,
-            p_mean2[k] = np.mean([pL, pR])  # ... save center phase.
-
-
-        if item_update1 == 'phase':
-            source2.data['V1'] = p_mean1
-        elif item_update1 == 'amplitude':
-            source2.data['V1'] = a_mean1
-
-        if item_update2 == 'phase':
-            source2.data['V2'] = p_mean2
-        elif item_update2 == 'amplitude':
-            source2.data['V2'] = a_mean2
+        # None while the compare file is loading, the base distribution and the demo keep updating
+        raw_noba = compare_loader.get(file_update2)
+
+        def compute():
+
+            intervals = []
+            for time_interval_update in [time_interval_update1, time_interval_update2]:
+                if time_interval_update.lower() == 'all':
+                    intervals.append(None)
+                else:
+                    intervals.append([int(i) for i in time_interval_update.split(',')])
+
+            notches = []
+            for notch_update in [notch_update1, notch_update2]:
+                cutoff = None
+                if notch_update.lower() != 'none':
+                    try:
+                        cutoff = float(notch_update)
+                    except ValueError:
+                        print("Could not convert this input to float!")
+                notches.append(cutoff)
+
+            analytic1 = analytic_signal(raw_edf, channel_update1, intervals[0], Wn_update1, notches[0])
+            phi1 = np.angle(analytic1)
+            amp1 = np.abs(analytic1)
+            demo = demo_window(channel_update1, int(time_demo_update), Wn_update1, Wn_update2, notches[0])
+            if raw_noba is None:
+                p_mean1, a_mean1 = cfc.phase_amplitude_distribution(phi1, amp1, p_bins)
+                return [p_mean1, a_mean1, None, None, None, demo]
+
+            analytic2 = analytic_signal(raw_noba, channel_update2, intervals[1], Wn_update2, notches[1])
+            amp2 = np.abs(analytic2)
+            # both amplitudes are binned by the phase of the base signal in one pass
+            p_mean1, (a_mean1, a_mean2) = cfc.phase_amplitude_distribution(phi1, np.vstack((amp1, amp2)), p_bins)
+            return [p_mean1, a_mean1, a_mean2, cfc.modulation_index(a_mean2), cfc.mean_vector_length(phi1, amp2),
+                    demo]
+
+        def apply(result):
+            p_mean1, a_mean1, a_mean2, mi, mvl, data_update = result
+            p_mean2 = p_mean1
+            metrics.observe_payload('eeg_payload_bytes', data_update, app='cfc')
+            source1.data = data_update
+
+            if a_mean2 is None:
+                # the compare file is still loading, the values depending on it are left empty
+                mi_output.value = ''
+                mvl_output.value = ''
+                if item_update2 == 'amplitude':
+                    source2.data = dict(V1=[], V2=[])
+                    return
+            else:
+                mi_output.value = '{:.6f}'.format(mi)
+                mvl_output.value = '{:.6g}'.format(mvl)
+
+            source2.data = dict(V1=p_mean1 if item_update1 == 'phase' else a_mean1,
+                                V2=p_mean2 if item_update2 == 'phase' else a_mean2)
+
+        runner.submit(compute, apply)
 
     for w in [file_input2, notch_input1, notch_input2, time_interval_input1,
               time_interval_input2, band_input1, band_input2, item_selector1, item_selector2]:
@@ -208,12 +233,22 @@ def cfc_bkapp(doc):
 
     for w in [channel_slider1, channel_slider2, time_slider]:
         w.on_change('value_throttled', update_data)
+    update_data(None, None, None)
 
     left_widgets = column(file_input1, channel_slider1, current_channel_name1, time_interval_input1, band_input1, item_selector1, notch_input1)
-    right_widgets = column(file_input2, channel_slider2, current_channel_name2, time_interval_input2, band_input2, item_selector2,
-                           notch_input2)
+    right_widgets = column(file_input2, compare_div, channel_slider2, current_channel_name2, time_interval_input2, band_input2, item_selector2,
+                           notch_input2, row(mi_output, mvl_output), busy_div)
+
+    comodulogram_widgets = column(row(phase_grid_input, amp_grid_input), comodulogram_button, comodulogram_busy_div, p3)
+
+    doc.add_root(row(column(left_widgets, p1, time_slider), column(right_widgets, p2), comodulogram_widgets))
+
+    def release_recordings(session_context):
+        metrics.inc('eeg_active_sessions', -1, app='cfc')
+        compare_loader.close()
+        recording_store.release(id(doc))
 
-    doc.add_root(row(column(left_widgets, p1, time_slider), column(right_widgets, p2)))
+    doc.on_session_destroyed(release_recordings)
 
 
 bp = Blueprint("cfc checker", __name__, url_prefix="/cfc")
@@ -224,7 +259,7 @@ def bkapp_page():
     with open("./config.yaml", 'r') as config_file:
         config = yaml.safe_load(config_file)
         config_file.close()
-    script = server_document("http://localhost:5006/cfc_bkapp")
+    script = server_document(bokeh_app_url('cfc_bkapp', config))
     return render_template("cfc.html", script=script, template="Flask", port=config['PORT'])
 
 # def bk_worker():
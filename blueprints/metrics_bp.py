@@ -0,0 +1,27 @@
+from flask import Blueprint, Response, abort
+from tornado.web import RequestHandler, HTTPError
+from .source_utils import metrics
+
+bp = Blueprint("metrics", __name__, url_prefix="/metrics")
+
+
+@bp.route("/", methods=["GET"], strict_slashes=False)
+def metrics_page():
+    """
+    metrics of this process in the Prometheus text format, 404 while METRICS is off in config.yaml
+    """
+    if not metrics.enabled:
+        abort(404)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsHandler(RequestHandler):
+    """
+    the same page served by every bokeh worker process (Server extra_patterns), for its own sessions
+    """
+
+    def get(self):
+        if not metrics.enabled:
+            raise HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
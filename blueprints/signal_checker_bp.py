@@ -1,15 +1,17 @@
 from flask import render_template, Blueprint
 from threading import Thread
 from tornado.ioloop import IOLoop
-import numpy as np
 import mne
 import yaml
 from .source_utils import FrequencyAnalysis as fa
-from .source_utils import RawDF, SpectrumDF, FrequencyAnalysis
-from .bp_utils import stackc_tick_loc, stack_x_axis_times, stack_y_axis_signals, convolve_multichannel
+from .source_utils import RawDF, SpectrumDF, FrequencyAnalysis, recording_store, metrics
+from .bp_utils import stackc_tick_loc, stack_x_axis_times, stack_y_axis_signals, smooth_multichannel, get_pyramid, \
+    auto_offset, LatestWinsRunner, RecordingLoader, stack_line_columns, bokeh_app_url, rasterize_lanes, SMOOTH_METHODS, \
+    envelope_window
 from bokeh.embed import server_document
 from bokeh.layouts import column, row
-from bokeh.models import ColumnDataSource, Slider, Select, RangeSlider, TextInput, MultiChoice
+from bokeh.models import ColumnDataSource, Slider, Select, RangeSlider, TextInput, MultiChoice, Div, Legend, \
+    LegendItem, LinearColorMapper
 from bokeh.plotting import figure
 from bokeh.server.server import Server
 
@@ -22,35 +24,63 @@ def signal_bkapp(doc):
     # import os
     # print(os.listdir('./'))
 
-    raw_edf = RawDF(filename=config['FILENAME'])
-    offset = config['OFFSET']
+    metrics.inc('eeg_active_sessions', app='signal')
+    recording_store.set_budget(config['STORE_BUDGET'])
+    raw_edf = recording_store.get_raw(config['FILENAME'], owner=id(doc), lazy=config['LAZY'],
+                                      dtype=config['PRECISION'])
     ch_num = raw_edf.nchan
+    data_init = raw_edf.get_window(start=0, stop=3000)
+    # the statistics of the whole recording are read once per recording, in the background,
+    # the first window gives the offset and the ticks until they are ready
+    stats = dict(frame=raw_edf.channel_stats(compute=False))
+    if stats['frame'] is None:
+        stats['frame'] = raw_edf.window_stats(0, 3000)
+    channel_stats = stats['frame']
+    offset = config['OFFSET'] if config['OFFSET'] is not None else auto_offset(channel_stats['std'])
     p = figure(height=900, width=900, title="sEEG Visualization")
-    source = ColumnDataSource(data=dict(x_base=stack_x_axis_times(raw_edf.raw.times[:3000], ch_num),
-                                        y_base=stack_y_axis_signals(raw_edf.raw.get_data()[:, :3000], ch_num, offset),
-                                        x_noba=stack_x_axis_times(raw_edf.raw.times[:3000], ch_num),
-                                        y_noba=stack_y_axis_signals(raw_edf.raw.get_data()[:, :3000], ch_num, offset),))
-    p.multi_line('x_base', 'y_base', source=source, line_color='skyblue', legend_label='base')
-    p.multi_line('x_noba', 'y_noba', source=source, line_color='orange', legend_label='compare')
-    y_tick_loc = stackc_tick_loc(raw_edf.raw.get_data(), ch_num, offset)
+    # one line renderer per channel, the channels of a trace share the x column of its source
+    source_base = ColumnDataSource(data=stack_line_columns(raw_edf.times[:3000], data_init, ch_num, offset))
+    source_noba = ColumnDataSource(data=stack_line_columns(raw_edf.times[:3000], data_init, ch_num, offset))
+    lines_base = [p.line('x', 'y_%d' % i, source=source_base, line_color='skyblue') for i in range(ch_num)]
+    lines_noba = [p.line('x', 'y_%d' % i, source=source_noba, line_color='orange') for i in range(ch_num)]
+    # raster mode: the lanes of many channels are drawn on the server and sent as a single image,
+    # 1 base, 2 compare, 3 both
+    source_raster = ColumnDataSource(data=dict(image=[], x=[], y=[], dw=[], dh=[]))
+    raster = p.image(image='image', x='x', y='y', dw='dw', dh='dh', source=source_raster,
+                     color_mapper=LinearColorMapper(palette=['#00000000', 'skyblue', 'orange', '#7a6fa8'],
+                                                    low=0, high=3))
+    p.renderers.remove(raster)
+    legend_base = LegendItem(label='base', renderers=lines_base)
+    legend_noba = LegendItem(label='compare', renderers=lines_noba)
+    p.add_layout(Legend(items=[legend_base, legend_noba]))
+    y_tick_loc = stackc_tick_loc(channel_stats['mean'].to_numpy(), ch_num, offset)
     y_tick_labels = raw_edf.ch_names
     y_tick_dict = dict(zip(y_tick_loc, y_tick_labels))
     p.yaxis.ticker = y_tick_loc
     p.yaxis.major_label_overrides = y_tick_dict
     p.legend.click_policy = "hide"
+    # last window sent to the plot, a forward scroll of the same raw window only streams the new samples
+    view = dict(key=None, start=0, stop=3000, num=(ch_num, ch_num), mode='lines')
 
-    range_slider = RangeSlider(start=0, end=10000, value=(0, 3000), step=500, width=900, title="Range Slider")
-    offset_slider = Slider(value=offset, start=0, end=0.002, step=0.0001, width=900, title='Offset', format='0.00000')
-    start_slider = Slider(value=0, start=0, end=raw_edf.raw.get_data().shape[1] - 10000, step=5000, width=900, title='Start From')
+    range_slider = RangeSlider(start=0, end=raw_edf.n_times, value=(0, 3000), step=500, width=900, title="Range Slider")
+    offset_slider = Slider(value=offset, start=0, end=max(0.002, 2 * offset), step=0.0001, width=900, title='Offset',
+                           format='0.00000')
+    start_slider = Slider(value=0, start=0, end=raw_edf.n_times - 10000, step=5000, width=900, title='Start From')
     smooth_slider = Slider(value=0, start=0, end=1000, step=10, width=900, title='Smooth Window')
+    smooth_select = Select(title='Smooth Method:', value='box', options=SMOOTH_METHODS)
     multi_choice = MultiChoice(value=list(raw_edf.brain_regions), options=list(raw_edf.brain_regions), title='Brain Regions')
     highpass_input = TextInput(title='Highpass Filter:', value='None')
     lowpass_input = TextInput(title='Lowpass Filter:', value='None')
     notch_input = TextInput(title='Notch Filter:', value='None')
 
     file_input = TextInput(title='Compare File:', value='None')
-
-    file_bank = dict()
+    compare_div = Div(text='', visible=False)
+    busy_div = Div(text='<i>Updating...</i>', visible=False)
+    runner = LatestWinsRunner(doc, busy=busy_div, name='signal:update_data')
+    # the compare file is opened in the background, the plot is redrawn with it once it is open
+    compare_loader = RecordingLoader(doc, status=compare_div, on_ready=lambda: update_data(None, None, None),
+                                     write_cache=config['CACHE_COMPARE'], lazy=config['LAZY'],
+                                     dtype=config['PRECISION'])
 
     def update_data(attribute, old, new):
         range_update = range_slider.value
@@ -58,101 +88,194 @@ def signal_bkapp(doc):
         file_update = file_input.value
         start_update = start_slider.value
         kernel_size_update = smooth_slider.value
+        smooth_method_update = smooth_select.value
         multi_choice_update = multi_choice.value
         highpass_update = highpass_input.value
         lowpass_update = lowpass_input.value
         notch_update = notch_input.value
 
-        if kernel_size_update == 0:
-            kernel = [-1, -1]
+        if file_update.lower() == "none":
+            compare_loader.reset()
+            raw_compare = raw_edf
         else:
-            kernel = np.ones(kernel_size_update) / kernel_size_update
+            raw_compare = compare_loader.get(file_update)
 
-        if file_update.lower() == "none":
-            raw_base = raw_edf.raw
-            chan_base, data_base = raw_edf.filter_data_from_region(multi_choice_update)
-            raw_noba = raw_edf.raw
-            chan_noba, data_noba = raw_edf.filter_data_from_region(multi_choice_update)
+        plot_width = p.width
+        window_start = start_update + range_update[0]
+        window_stop = min(start_update + range_update[1], raw_edf.n_times)
+        view_key = (file_update, raw_compare is None, tuple(multi_choice_update), offset_update, kernel_size_update,
+                    smooth_method_update, highpass_update, lowpass_update, notch_update, window_stop - window_start)
+        # filters run on the window and on padding sized from their impulse responses, in this order
+        filters = []
+        for filter_type, filter_update in [('high', highpass_update), ('low', lowpass_update),
+                                           ('notch', notch_update)]:
+            if filter_update != 'None':
+                try:
+                    filters.append((filter_type, float(filter_update)))
+                except ValueError:
+                    print("Could not convert this input to float!")
+        filters = tuple(filters)
+
+        scroll = window_start - view['start']
+        streaming = (view_key == view['key'] and view['mode'] == 'lines' and 0 < scroll < window_stop - window_start
+                     and window_stop - window_start <= config['MAX_RAW_SAMPLES'])
+        stream_start = view['stop']
+        frame = stats['frame']
+
+        def compute():
+            raw_base = raw_edf
+            # None while the compare file is loading, its trace stays empty and the base trace keeps updating
+            raw_noba = raw_compare
+
+            chan_base = raw_base.channels_from_region(multi_choice_update)
+            ch_num = len(chan_base)
+            chan_noba = raw_noba.channels_from_region(multi_choice_update)[0:ch_num] if raw_noba is not None else []
+
+            def read_window(raw, channels, start, stop):
+                # smoothing and filters see the samples around the window, its edges match the full signal
+                def read(begin, end):
+                    return smooth_multichannel(raw.get_window(channels, begin, end), kernel_size_update,
+                                               smooth_method_update)
+                padding = 0 if kernel_size_update <= 1 else kernel_size_update
+                if not filters and not padding:
+                    return raw.get_window(channels, start, stop)
+                data, begin = fa.padded_window(read, start, stop, raw.n_times, raw.freq, filters, padding=padding)
+                return data[:, start - begin:stop - begin]
+
+            if streaming:
+                # a window filtered with its padding does not depend on the rest of the window,
+                # only the new samples are read and filtered
+                data_base = read_window(raw_base, chan_base, stream_start, window_stop)
+                columns_noba = dict(x=raw_base.times[stream_start:window_stop])
+                if raw_noba is not None:
+                    data_noba = read_window(raw_noba, chan_noba, stream_start, window_stop)
+                    columns_noba = stack_line_columns(raw_noba.times[stream_start:window_stop], data_noba,
+                                                      len(chan_noba), offset_update)
+                return ['stream',
+                        stack_line_columns(raw_base.times[stream_start:window_stop], data_base, ch_num, offset_update),
+                        columns_noba]
+
+            if window_stop - window_start > config['MAX_RAW_SAMPLES']:
+                # wide window: min/max envelope at a fixed number of points per pixel, from the pyramid of the raw
+                # samples, or from the filtered and smoothed window when filters or smoothing are set
+                n_points = plot_width * config['POINTS_PER_PIXEL']
+
+                def envelope(raw, channels):
+                    if not filters and kernel_size_update <= 1:
+                        return get_pyramid(raw).window(channels, window_start, window_stop, n_points)
+                    return envelope_window(lambda begin, end: read_window(raw, channels, begin, end),
+                                           window_start, window_stop, n_points, raw.freq)
+
+                x_base, y_base_filted = envelope(raw_base, chan_base)
+                x_noba, y_noba_filted = x_base, None
+                if raw_noba is raw_base:
+                    y_noba_filted = y_base_filted
+                elif raw_noba is not None:
+                    x_noba, y_noba_filted = envelope(raw_noba, chan_noba)
 
-        else:
-            if file_update in file_bank.keys():
-                raw_base = raw_edf.raw
-                chan_base, data_base = raw_edf.filter_data_from_region(multi_choice_update)
-                raw_noba, chan_noba, data_noba = file_bank[file_update]
             else:
-                raw_compare_update = RawDF(filename=file_update)
-                raw_base = raw_edf.raw
-                chan_base, data_base = raw_edf.filter_data_from_region(multi_choice_update)
-                raw_noba = raw_compare_update.raw
-                chan_noba, data_noba = raw_compare_update.filter_data_from_region(multi_choice_update)
-                file_bank[file_update] = [raw_noba, chan_noba, data_noba]
-
-        ch_num = len(chan_base)
-        y_base_filted = convolve_multichannel(
-            data_base[0:ch_num, start_update + range_update[0]:start_update + range_update[1]],
-            kernel, 0)
-        y_noba_filted = convolve_multichannel(
-            data_noba[0:ch_num, start_update + range_update[0]:start_update + range_update[1]],
-            kernel, 0)
-
-        if highpass_update != 'None':
-            try:
-                cutoff = float(highpass_update)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_base_filted = fa.butter_highpass_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.butter_highpass_filter(y_noba_filted, cutoff, raw_edf.freq)
+                x_base = raw_base.times[window_start:window_stop]
+                x_noba = x_base
+                y_base_filted = read_window(raw_base, chan_base, window_start, window_stop)
+                if raw_noba is None:
+                    y_noba_filted = None
+                elif raw_noba is raw_base:
+                    y_noba_filted = y_base_filted
+                else:
+                    x_noba = raw_noba.times[window_start:window_stop]
+                    y_noba_filted = read_window(raw_noba, chan_noba, window_start, window_stop)
 
-        else:
-            pass
+            y_tick_loc = stackc_tick_loc(frame.loc[chan_base, 'mean'].to_numpy(), ch_num, offset_update)
+            if ch_num * (window_stop - window_start) > config['RASTER_THRESHOLD']:
+                x_range = [x_base[0], x_base[-1]] if x_base[-1] > x_base[0] else [x_base[0], x_base[0] + 1]
+                y_range = [y_tick_loc[0] - offset_update, y_tick_loc[-1] + offset_update]
+                image = rasterize_lanes(x_base, y_base_filted, offset_update, x_range, y_range, p.width, p.height)
+                if y_noba_filted is not None and raw_noba is not raw_base:
+                    image += 2 * rasterize_lanes(x_noba, y_noba_filted, offset_update, x_range, y_range, p.width,
+                                                 p.height)
+                return ['raster',
+                        dict(image=[image], x=[x_range[0]], y=[y_range[0]], dw=[x_range[1] - x_range[0]],
+                             dh=[y_range[1] - y_range[0]]),
+                        y_tick_loc, chan_base]
 
-        if lowpass_update != 'None':
-            try:
-                cutoff = float(lowpass_update)
-            except ValueError:
-                print("Could not convert this input to float!")
+            columns_noba = dict(x=x_noba)
+            if y_noba_filted is not None:
+                columns_noba = stack_line_columns(x_noba, y_noba_filted, len(chan_noba), offset_update)
+            return ['replace', stack_line_columns(x_base, y_base_filted, ch_num, offset_update), columns_noba,
+                    y_tick_loc, chan_base]
 
-            y_base_filted = fa.butter_lowpass_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.butter_lowpass_filter(y_noba_filted, cutoff, raw_edf.freq)
-        else:
-            pass
+        def apply(result):
+            metrics.observe_payload('eeg_payload_bytes', result[1], app='signal')
+            if result[0] == 'raster':
+                columns_raster, y_tick_loc, y_tick_labels = result[1:]
+                if view['mode'] != 'raster':
+                    p.renderers = [raster]
+                    legend_base.renderers = [raster]
+                    legend_noba.renderers = [raster]
+                    view.update(mode='raster', num=None)
+                source_raster.data = columns_raster
+                p.yaxis.ticker = y_tick_loc
+                p.yaxis.major_label_overrides = dict(zip(y_tick_loc, y_tick_labels))
+                view.update(key=view_key, start=window_start, stop=window_stop)
+                return
 
-        if notch_update != 'None':
-            try:
-                cutoff = float(notch_update)
-            except ValueError:
-                print("Could not convert this input to float!")
+            metrics.observe_payload('eeg_payload_bytes', result[2], app='signal')
+            view['mode'] = 'lines'
+            if result[0] == 'stream':
+                source_base.stream(result[1], rollover=window_stop - window_start)
+                source_noba.stream(result[2], rollover=window_stop - window_start)
+            else:
+                columns_base, columns_noba, y_tick_loc, y_tick_labels = result[1:]
+                num = (len(columns_base) - 1, len(columns_noba) - 1)
+                if num != view['num']:
+                    # detach the lines first, so no renderer refers to a column missing from the new data
+                    p.renderers = []
+                    source_base.data = columns_base
+                    source_noba.data = columns_noba
+                    p.renderers = lines_base[:num[0]] + lines_noba[:num[1]]
+                    legend_base.renderers = lines_base[:num[0]]
+                    legend_noba.renderers = lines_noba[:num[1]]
+                    view['num'] = num
+                else:
+                    source_base.data = columns_base
+                    source_noba.data = columns_noba
+                y_tick_dict = dict(zip(y_tick_loc, y_tick_labels))
+                p.yaxis.ticker = y_tick_loc
+                p.yaxis.major_label_overrides = y_tick_dict
+            view.update(key=view_key, start=window_start, stop=window_stop)
 
-            y_base_filted = fa.notch_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.notch_filter(y_noba_filted, cutoff, raw_edf.freq)
-        else:
-            pass
-
-        source.data = dict(
-            x_base=stack_x_axis_times(raw_base.times[start_update + range_update[0]:start_update + range_update[1]],
-                                      ch_num),
-            y_base=stack_y_axis_signals(y_base_filted, ch_num, offset_update),
-            x_noba=stack_x_axis_times(raw_noba.times[start_update + range_update[0]:start_update + range_update[1]],
-                                      ch_num),
-            y_noba=stack_y_axis_signals(y_noba_filted, ch_num, offset_update))
-
-        y_tick_loc = stackc_tick_loc(data_base, ch_num, offset)
-        y_tick_labels = chan_base
-        y_tick_dict = dict(zip(y_tick_loc, y_tick_labels))
-        p.yaxis.ticker = y_tick_loc
-        p.yaxis.major_label_overrides = y_tick_dict
-
-    for w in [file_input, multi_choice, highpass_input, lowpass_input, notch_input]:
+        runner.submit(compute, apply)
+
+    for w in [file_input, multi_choice, highpass_input, lowpass_input, notch_input, smooth_select]:
         w.on_change('value', update_data)
     for w in [range_slider, offset_slider, smooth_slider, start_slider]:
         w.on_change('value_throttled', update_data)
+    if ch_num * 3000 > config['RASTER_THRESHOLD']:
+        update_data(None, None, None)
+
+    def stats_ready(frame):
+        stats['frame'] = frame
+        if config['OFFSET'] is None and offset_slider.value == offset:
+            # the offset was estimated on the first window and not moved since
+            offset_update = auto_offset(frame['std'])
+            offset_slider.update(value=offset_update, end=max(0.002, 2 * offset_update))
+        update_data(None, None, None)
+
+    if raw_edf.channel_stats(compute=False) is None:
+        LatestWinsRunner(doc, name='signal:channel_stats').submit(raw_edf.channel_stats, stats_ready)
 
-    inputs = column(file_input, range_slider, start_slider, smooth_slider, offset_slider, multi_choice,
-                    row(highpass_input, lowpass_input, notch_input))
+    inputs = column(file_input, compare_div, range_slider, start_slider, smooth_slider, offset_slider, multi_choice,
+                    row(smooth_select, highpass_input, lowpass_input, notch_input), busy_div)
 
     doc.add_root(row(inputs, p))
 
+    def release_recordings(session_context):
+        metrics.inc('eeg_active_sessions', -1, app='signal')
+        compare_loader.close()
+        recording_store.release(id(doc))
+
+    doc.on_session_destroyed(release_recordings)
+
 bp = Blueprint("signal checker", __name__, url_prefix='/signal')
 
 @bp.route("/", methods=['GET'])
@@ -160,7 +283,7 @@ def bkapp_page():
     with open("./config.yaml", 'r') as config_file:
         config = yaml.safe_load(config_file)
         config_file.close()
-    script = server_document("http://localhost:5006/signal_bkapp")
+    script = server_document(bokeh_app_url('signal_bkapp', config))
     return render_template("signal.html", script=script, template="Flask", port=config['PORT'])
 
 # if __name__ == "__main__":
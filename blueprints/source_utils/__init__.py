@@ -1,2 +1,10 @@
-from .frequency_analysis import FrequencyAnalysis
-from .source_df import RawDF, SpectrumDF
\ No newline at end of file
+from .metrics import MetricsRegistry, metrics
+from .spectral import SpectralBackend, spectral
+from .frequency_analysis import FrequencyAnalysis, BAND_PRESETS
+from .filter_design import FilterDesignCache, filter_cache
+from .cross_frequency_coupling import CrossFrequencyCoupling
+from .edf_cache import EdfCache
+from .source_df import RawDF, SpectrumDF
+from .recording_store import RecordingStore, recording_store
+from .welch_cache import WelchSegmentCache, get_welch_cache
+from .spectrogram_tiles import SpectrogramTileCache, tile_cache
@@ -0,0 +1,230 @@
+import atexit
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import numpy as np
+from .filter_design import filter_cache
+from .spectral import spectral
+
+
+class CrossFrequencyCoupling():
+    @classmethod
+    def phase_amplitude_distribution(cls, phase, amplitude, p_bins):
+        '''
+        Mean amplitude in every phase bin, in a single pass over the signal
+        :param phase: 1-channel phase, in radians
+        :param amplitude: 1-channel amplitude, or 2d-array (signals x samples) binned by the same phase
+        :param p_bins: edges of the phase bins, a sample falls in bin k if p_bins[k] <= phase < p_bins[k + 1]
+        :return: [p_mean: center of every bin, a_mean: mean amplitude in every bin, nan for an empty bin]
+        '''
+        n_bins = np.size(p_bins) - 1
+        bin_index = np.digitize(phase, p_bins) - 1
+        in_bins = (bin_index >= 0) & (bin_index < n_bins)
+        bin_index = bin_index[in_bins]
+
+        counts = np.bincount(bin_index, minlength=n_bins)[:n_bins]
+        single_signal = np.ndim(amplitude) == 1
+        amplitude = np.atleast_2d(amplitude)
+        a_mean = np.zeros((amplitude.shape[0], n_bins))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(amplitude.shape[0]):
+                sums = np.bincount(bin_index, weights=amplitude[i][in_bins], minlength=n_bins)[:n_bins]
+                a_mean[i] = sums / counts
+
+        p_mean = (np.asarray(p_bins[:-1]) + np.asarray(p_bins[1:])) / 2
+        if single_signal:
+            a_mean = a_mean[0]
+        return [p_mean, a_mean]
+
+    @classmethod
+    def modulation_index(cls, a_mean):
+        '''
+        Modulation index of Tort et al. (2010), the KL divergence between the phase-amplitude distribution
+        and the uniform distribution, normalized by log(number of bins)
+        :param a_mean: mean amplitude in every phase bin, empty (nan) bins are ignored
+        :return: modulation index, between 0 (no coupling) and 1
+        '''
+        a_mean = np.asarray(a_mean, dtype=np.float64)
+        a_mean = a_mean[np.isfinite(a_mean)]
+        if a_mean.size < 2 or np.sum(a_mean) <= 0:
+            return np.nan
+
+        p = a_mean / np.sum(a_mean)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy = -np.sum(np.where(p > 0, p * np.log(p), 0))
+        return (np.log(p.size) - entropy) / np.log(p.size)
+
+    @classmethod
+    def mean_vector_length(cls, phase, amplitude):
+        '''
+        Mean vector length of Canolty et al. (2006), |mean(amplitude * exp(i * phase))|
+        :param phase: 1-channel phase, in radians
+        :param amplitude: 1-channel amplitude, same length as phase
+        :return: mean vector length
+        '''
+        return np.abs(np.mean(amplitude * np.exp(1j * phase)))
+
+    @classmethod
+    def band_analytic_signals(cls, spectrum, nfft, n, bands, fs, numtaps=None):
+        '''
+        Filter bank working on one precomputed spectrum, each band costs one inverse FFT
+        The magnitude response of every band is squared, as a zero-phase FIR filtfilt would apply it,
+        and the negative frequencies are dropped so that the inverse FFT gives the analytic signal directly.
+        :param spectrum: rfft of the signal, zero padded to nfft
+        :param nfft: length of the FFT
+        :param n: length of the signal
+        :param bands: list of [low, high] band edges
+        :param fs: sampling frequency
+        :param numtaps: length of the FIR filters, None for 3 cycles of the lower edge of each band
+        :return: generator of the analytic signals of the bands, 1d complex arrays of length n
+        '''
+        one_sided = np.zeros(nfft, dtype=complex)
+        for band in bands:
+            taps = filter_cache.design('fir', numtaps or cls.band_numtaps(band, fs), band, fs, window='hamming')
+            response = np.abs(spectral.rfft(taps, nfft)) ** 2
+            filtered = spectrum * response
+            one_sided[:] = 0
+            one_sided[0] = filtered[0]
+            one_sided[1:(nfft + 1) // 2] = 2 * filtered[1:(nfft + 1) // 2]
+            if nfft % 2 == 0:
+                one_sided[nfft // 2] = filtered[nfft // 2]
+            yield spectral.ifft(one_sided)[:n]
+
+    @classmethod
+    def band_numtaps(cls, band, fs):
+        return int(3 * fs / max(band[0], 1e-3)) // 2 * 2 + 1
+
+    @classmethod
+    def comodulogram(cls, data, fs, phase_bands, amp_bands, p_bins=None, numtaps=None, workers=None,
+                     min_pool_size=2 ** 22):
+        '''
+        Modulation index over a grid of phase bands x amplitude bands
+        The signal is transformed once, every band is then one inverse FFT of the shared spectrum,
+        and the amplitude bands are spread over a process pool, created on the first call and kept afterwards.
+        The spectrum and the phase bins reach the processes through shared memory.
+        :param data: 1-channel signal
+        :param fs: sampling frequency
+        :param phase_bands: list of [low, high] bands giving the phase
+        :param amp_bands: list of [low, high] bands giving the amplitude
+        :param p_bins: edges of the phase bins, 18 bins over [-pi, pi] by default
+        :param numtaps: length of the FIR filters, None for 3 cycles of the lower edge of each band
+        :param workers: number of processes, None for all cores, 1 to compute in this process
+        :param min_pool_size: smaller grids (samples x amplitude bands x phase bands) are computed in this process,
+                              the pool costs more than it saves on them
+        :return: 2d-array of modulation indices, amplitude bands x phase bands
+        '''
+        if p_bins is None:
+            p_bins = np.linspace(-np.pi, np.pi, 19)
+        p_bins = np.asarray(p_bins, dtype=np.float64)
+        n_bins = np.size(p_bins) - 1
+        data = np.asarray(data, dtype=np.float64)
+        n = data.size
+
+        # zero padding longer than the filters keeps the circular convolution from wrapping around
+        longest = numtaps or max(cls.band_numtaps(band, fs) for band in list(phase_bands) + list(amp_bands))
+        nfft = spectral.fast_length(n + 2 * longest)
+        spectrum = spectral.rfft(data, nfft)
+
+        phase_index = np.empty((len(phase_bands), n), dtype=np.int16)
+        for i, analytic in enumerate(cls.band_analytic_signals(spectrum, nfft, n, phase_bands, fs, numtaps)):
+            bin_index = np.digitize(np.angle(analytic), p_bins) - 1
+            bin_index[(bin_index < 0) | (bin_index >= n_bins)] = n_bins
+            phase_index[i] = bin_index
+
+        phase_counts = np.array([np.bincount(bin_index, minlength=n_bins + 1) for bin_index in phase_index])
+        state = (spectrum, nfft, n, fs, numtaps, phase_index, phase_counts, n_bins)
+        if workers == 1 or len(amp_bands) == 1 or n * len(amp_bands) * len(phase_bands) < min_pool_size:
+            # the state stays local, concurrent sessions computing in this process do not share it
+            state_dict = _comodulogram_state_dict(*state)
+            rows = [_comodulogram_row(band, state_dict) for band in amp_bands]
+        else:
+            blocks = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                      for array in (spectrum, phase_index)]
+            try:
+                shared = []
+                for block, array in zip(blocks, (spectrum, phase_index)):
+                    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+                    shared.append((block.name, array.shape, array.dtype.str))
+                shared_state = (shared[0], nfft, n, fs, numtaps, shared[1], phase_counts, n_bins)
+                rows = list(_comodulogram_pool(workers).map(_comodulogram_shared_row, amp_bands,
+                                                             itertools.repeat(shared_state)))
+            except BrokenProcessPool:
+                # a process died, the next call starts a new pool
+                with _pools_lock:
+                    _pools.pop(workers, None)
+                raise
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+        return np.array(rows)
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def _comodulogram_pool(workers):
+    """
+    the process pool of this number of workers, created on the first call and shut down at exit
+    spawn: forking the threaded bokeh server process is unsafe
+    """
+    with _pools_lock:
+        if workers not in _pools:
+            if not _pools:
+                atexit.register(shutdown_comodulogram_pools)
+            _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=_init_comodulogram_worker)
+        return _pools[workers]
+
+
+def shutdown_comodulogram_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(cancel_futures=True)
+        _pools.clear()
+
+
+def _init_comodulogram_worker():
+    # in a pool, the processes already share the cores
+    spectral.set_workers(1)
+
+
+def _comodulogram_state_dict(spectrum, nfft, n, fs, numtaps, phase_index, phase_counts, n_bins):
+    return dict(spectrum=spectrum, nfft=nfft, n=n, fs=fs, numtaps=numtaps, phase_index=phase_index,
+                phase_counts=phase_counts, n_bins=n_bins)
+
+
+def _comodulogram_shared_row(amp_band, shared_state):
+    spectrum, nfft, n, fs, numtaps, phase_index, phase_counts, n_bins = shared_state
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in (spectrum, phase_index)]
+    try:
+        arrays = [np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+                  for block, (_, shape, dtype) in zip(blocks, (spectrum, phase_index))]
+        return _comodulogram_row(amp_band, _comodulogram_state_dict(arrays[0], nfft, n, fs, numtaps, arrays[1],
+                                                                    phase_counts, n_bins))
+    finally:
+        arrays = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # an error traceback still refers to the arrays, the mapping goes with the traceback
+                pass
+
+
+def _comodulogram_row(amp_band, state):
+    analytic = next(CrossFrequencyCoupling.band_analytic_signals(state['spectrum'], state['nfft'], state['n'],
+                                                                 [amp_band], state['fs'], state['numtaps']))
+    amplitude = np.abs(analytic)
+    n_bins = state['n_bins']
+    row = np.zeros(state['phase_index'].shape[0])
+    for i, bin_index in enumerate(state['phase_index']):
+        # samples outside the bins were given the index n_bins, dropped by the slice
+        sums = np.bincount(bin_index, weights=amplitude, minlength=n_bins + 1)[:n_bins]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            row[i] = CrossFrequencyCoupling.modulation_index(sums / state['phase_counts'][i, :n_bins])
+    return row
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+
+
+class EdfCache():
+    """
+    memory-mappable copy of the samples of an EDF recording, written next to it in <file>.eegcache/,
+    or in the cache directory when one is set (CACHE_DIR), caches next to the files are still read
+    meta.json: format version, source file and modification time, channel names, sampling frequency,
+               number of samples, sample dtype, brain regions and their channel indices
+    samples.bin: the scaled samples, channels x samples, mapped read-only so that every process opening
+                 the recording shares the same pages of the system cache
+    """
+    VERSION = 2
+    # directory of the caches written by this process, None for next to the EDF files
+    cache_dir = None
+
+    def __init__(self, path):
+        """
+        open an existing cache, only the metadata is read, the samples stay mapped
+        :param path: cache directory
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+            meta_file.close()
+
+        self.ch_names = self.meta['ch_names']
+        self.freq = self.meta['sfreq']
+        self.n_times = self.meta['n_times']
+        self.brain_regions = self.meta['brain_regions']
+        self.region_index = {region: np.array(index, dtype=int) for region, index in self.meta['region_index'].items()}
+        self.samples = np.memmap(os.path.join(path, 'samples.bin'), dtype=self.meta['dtype'], mode='r',
+                                 shape=(len(self.ch_names), self.n_times))
+
+    @classmethod
+    def set_cache_dir(cls, cache_dir):
+        """
+        :param cache_dir: directory of the caches written from now on, None for next to the EDF files
+        """
+        cls.cache_dir = cache_dir
+
+    @classmethod
+    def cache_path(cls, filename):
+        """
+        :param filename: path of the EDF file
+        :return: directory of the cache written for this file
+        """
+        path = os.path.abspath(filename)
+        if cls.cache_dir is None:
+            return path + '.eegcache'
+        # files of the same name in different directories get their own cache
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(os.path.abspath(cls.cache_dir), '{}-{}.eegcache'.format(os.path.basename(path), digest))
+
+    @classmethod
+    def cache_paths(cls, filename):
+        """
+        :return: directories where a cache of this file is looked for, the cache directory first
+        """
+        paths = [cls.cache_path(filename)]
+        if cls.cache_dir is not None:
+            paths.append(os.path.abspath(filename) + '.eegcache')
+        return paths
+
+    @classmethod
+    def fresh_path(cls, filename):
+        """
+        :param filename: path of the EDF file
+        :return: directory of a cache of the current format newer than the file, None if there is none
+        """
+        for path in cls.cache_paths(filename):
+            meta_path = os.path.join(path, 'meta.json')
+            if not os.path.exists(meta_path) or os.path.getmtime(meta_path) < os.path.getmtime(filename):
+                continue
+            try:
+                with open(meta_path, 'r') as meta_file:
+                    version = json.load(meta_file).get('version')
+                    meta_file.close()
+            except (OSError, ValueError):
+                continue
+            if version == cls.VERSION:
+                return path
+        return None
+
+    @classmethod
+    def is_fresh(cls, filename):
+        """
+        :param filename: path of the EDF file
+        :return: True if a cache of the current format exists and is newer than the file
+        """
+        return cls.fresh_path(filename) is not None
+
+    @classmethod
+    def open(cls, filename):
+        """
+        :param filename: path of the EDF file
+        :return: EdfCache object, None if there is no up-to-date cache
+        """
+        path = cls.fresh_path(filename)
+        if path is None:
+            return None
+        return cls(path)
+
+    @classmethod
+    def write(cls, recording, dtype='float32', chunk_size=2 ** 16, progress=None):
+        """
+        convert a recording, chunk by chunk, the cache appears atomically once complete
+        :param recording: RawDF object opened on the EDF file
+        :param dtype: 'float32' or 'float64'
+        :param chunk_size: number of samples converted at once
+        :param progress: optional callable receiving the fraction done
+        :return: path of the cache directory, OSError if it cannot be written (read-only media, disk full),
+                 nothing is left behind then
+        """
+        path = cls.cache_path(recording.filename)
+        # one temporary directory per writer, two sessions converting the same file do not mix their samples
+        tmp_path = '{}.tmp.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            cls._write(recording, path, tmp_path, dtype, chunk_size, progress)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return path
+
+    @classmethod
+    def _write(cls, recording, path, tmp_path, dtype, chunk_size, progress):
+        os.makedirs(tmp_path)
+        samples_path = os.path.join(tmp_path, 'samples.bin')
+        nbytes = recording.nchan * recording.n_times * np.dtype(dtype).itemsize
+        with open(samples_path, 'wb') as samples_file:
+            # the space is reserved first, a full disk raises OSError here instead of faulting in the mapping
+            if nbytes and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(samples_file.fileno(), 0, nbytes)
+            samples_file.close()
+        samples = np.memmap(samples_path, dtype=dtype, mode='r+',
+                            shape=(recording.nchan, recording.n_times))
+        for start in range(0, recording.n_times, chunk_size):
+            stop = min(start + chunk_size, recording.n_times)
+            samples[:, start:stop] = recording.read_window(np.arange(recording.nchan), start, stop)
+            if progress is not None:
+                progress(stop / recording.n_times)
+        samples.flush()
+        del samples
+
+        region_index = {str(region): recording.region_index[region].tolist() for region in recording.brain_regions}
+        meta = dict(version=cls.VERSION,
+                    source=os.path.abspath(recording.filename),
+                    source_mtime=os.path.getmtime(recording.filename),
+                    ch_names=list(recording.ch_names),
+                    sfreq=float(recording.freq),
+                    n_times=int(recording.n_times),
+                    dtype=dtype,
+                    brain_regions=[str(region) for region in recording.brain_regions],
+                    region_index=region_index)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+            meta_file.close()
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    def get_data(self, picks, start, stop):
+        """
+        read a window of some channels
+        :param picks: channel indices
+        :param start: first sample
+        :param stop: last sample (excluded)
+        :return: 2d-array, channels x samples, of the stored sample type
+        """
+        return np.array(self.samples[picks, start:stop])
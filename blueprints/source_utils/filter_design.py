@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import signal
+from .metrics import metrics
+
+
+class FilterDesignCache():
+    """
+    bounded LRU cache of filter coefficients, shared by every session
+    maxsize: maximum number of designs kept
+    hits/misses: number of designs served from the cache / computed
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._designs = OrderedDict()
+        self._paddings = dict()
+        self._lock = threading.Lock()
+
+    def design(self, filter_type, order, cutoff, fs, quality_factor=None, window=None):
+        """
+        return the coefficients of a filter, designing it only the first time
+        :param filter_type: 'low', 'high' or 'band' (butterworth), 'notch' (iirnotch) or 'fir' (firwin band pass)
+        :param order: order of the butterworth filter, number of taps of the FIR filter
+        :param cutoff: cutoff frequency, [low, high] for 'band' and 'fir', notch frequency for 'notch'
+        :param fs: sampling frequency
+        :param quality_factor: quality factor of the notch filter
+        :param window: window of the FIR filter
+        :return: copy of the second-order sections, or of the taps for 'fir' (scipy needs writable arrays)
+        """
+        cutoff = tuple(float(i) for i in np.atleast_1d(cutoff))
+        key = (filter_type, order, cutoff, float(fs), quality_factor, window)
+        with self._lock:
+            if key in self._designs:
+                self.hits += 1
+                self._designs.move_to_end(key)
+                return self._designs[key].copy()
+
+        if filter_type in ('low', 'high'):
+            coefficients = signal.butter(order, cutoff[0], fs=fs, btype=filter_type, output='sos')
+        elif filter_type == 'band':
+            coefficients = signal.butter(order, cutoff, fs=fs, btype='band', output='sos')
+        elif filter_type == 'notch':
+            coefficients = signal.tf2sos(*signal.iirnotch(cutoff[0], quality_factor, fs))
+        elif filter_type == 'fir':
+            coefficients = signal.firwin(order, cutoff, fs=fs, pass_zero=False, window=window)
+        else:
+            raise ValueError("filter type has to be 'low', 'high', 'band', 'notch' or 'fir'!")
+
+        with self._lock:
+            self.misses += 1
+            self._designs[key] = coefficients
+            while len(self._designs) > self.maxsize:
+                self._designs.popitem(last=False)
+        return coefficients.copy()
+
+    def padding(self, filter_type, order, cutoff, fs, quality_factor=None, window=None, tol=1e-6):
+        """
+        length of the impulse response of a filter: the samples after it hold less than tol of its total
+        absolute value, so a window filtered with this many extra samples on each side matches the
+        whole filtered signal up to about tol times the amplitude of the signal
+        :param tol: fraction of the impulse response left out
+        :return: number of samples, computed once per design
+        """
+        key = (filter_type, order, tuple(float(i) for i in np.atleast_1d(cutoff)), float(fs), quality_factor, window,
+               tol)
+        with self._lock:
+            if key in self._paddings:
+                return self._paddings[key]
+
+        coefficients = self.design(filter_type, order, cutoff, fs, quality_factor=quality_factor, window=window)
+        if filter_type == 'fir':
+            padding = len(coefficients)
+        else:
+            length = 1024
+            while True:
+                impulse = np.zeros(length)
+                impulse[0] = 1
+                mass = np.cumsum(np.abs(signal.sosfilt(coefficients, impulse)))
+                padding = int(np.searchsorted(mass, (1 - tol) * mass[-1])) + 1
+                # the response must have died out well before the end of the impulse
+                if padding < length // 2 or length >= 2 ** 24:
+                    break
+                length *= 2
+
+        with self._lock:
+            self._paddings[key] = padding
+        return padding
+
+    def info(self):
+        """
+        :return: dictionary with hits, misses, current size and maximum size
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._designs), maxsize=self.maxsize)
+
+    def clear(self):
+        with self._lock:
+            self._designs.clear()
+            self._paddings.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+filter_cache = FilterDesignCache()
+
+
+def collect_filter_metrics():
+    if not metrics.enabled:
+        return
+    info = filter_cache.info()
+    metrics.set('eeg_filter_designs_total', info['hits'], result='hit')
+    metrics.set('eeg_filter_designs_total', info['misses'], result='miss')
+
+
+metrics.counter('eeg_filter_designs_total', 'Filter designs served from the cache (hit) or computed (miss)')
+metrics.add_collector(collect_filter_metrics)
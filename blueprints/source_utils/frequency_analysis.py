@@ -2,127 +2,164 @@ import mne
 import numpy as np
 import pandas as pd
 import scipy
-from scipy import fft, signal, integrate
+from scipy import signal, integrate
+from .filter_design import filter_cache
+from .spectral import spectral
+
+BAND_PRESETS = {'classic': [[0, 4], [4, 8], [8, 16], [16, 32], [32, 64]],
+                'db4': [[32, 64], [16, 32], [8, 16], [4, 8], [0.5, 4]]}
 
 
 class FrequencyAnalysis():
+    @classmethod
+    def apply_filtfilt(cls, data, sos=None, taps=None):
+        '''
+        Zero-phase filtering of every channel in a single call
+        the filter runs in float64, the result is cast back to the sample type of float32 input
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
+        :param sos: second-order sections of an IIR filter
+        :param taps: coefficients of a FIR filter, used when sos is None
+        :return: filtered data, same type and layout as the input
+        '''
+        if isinstance(data, pd.DataFrame):
+            values, axis = data.to_numpy(), 0
+        else:
+            values, axis = np.asarray(data), -1
+
+        dtype = values.dtype if values.dtype == np.float32 else np.float64
+        if sos is not None:
+            y = signal.sosfiltfilt(sos, values.astype(np.float64, copy=False), axis=axis)
+        else:
+            y = signal.filtfilt(taps, 1.0, values.astype(np.float64, copy=False), axis=axis)
+        y = y.astype(dtype, copy=False)
+
+        if isinstance(data, pd.DataFrame):
+            y = pd.DataFrame(data=y, columns=data.columns, index=data.index)
+        return y
+
     @classmethod
     def butter_bandpass_filter(cls, data, lowcut, highcut, fs, order=5):
         '''
         Band pass filter based on scipy.signal.butter
-        :param data: 1-channel data
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
         :param lowcut: lower cutoff
         :param highcut: higher cutoff
         :param fs: signal frequency
         :param order: parameter in the butter function
         :return: filtered data
         '''
-        lowcut = 2 * lowcut / fs
-        highcut= 2 * highcut/fs
-        b, a = signal.butter(order, [lowcut, highcut], fs=fs, btype='band')
-        y = signal.filtfilt(b, a, data)
-        return y
+        sos = filter_cache.design('band', order, [lowcut, highcut], fs)
+        return cls.apply_filtfilt(data, sos=sos)
 
     @classmethod
     def butter_lowpass_filter(cls, data, cutoff, fs, order=5):
         '''
         Low pass filter based on scipy.signal.butter
-        :param data: 1-channel signal
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
         :param cutoff: cutoff frequency
         :param fs: signal frequency
         :param order: parameter for the butter function
         :return: filtered signal
         '''
-        normal_cutoff = 2 * cutoff / fs
-        b, a = signal.butter(order, normal_cutoff, btype='low', analog=False)
-
-        if isinstance(data, pd.DataFrame):
-            y = np.zeros((data.shape[0], data.shape[1]))
-            for i in range(data.shape[1]):
-                y[:, i] = signal.filtfilt(b, a, data.iloc[:, i])
-
-            y = pd.DataFrame(data=y, columns=data.columns)
-
-        elif isinstance(data, np.ndarray):
-            if len(data.shape)>1:
-                y = np.zeros((data.shape[0], data.shape[1]))
-                for i in range(data.shape[0]):
-                    y[i] = signal.filtfilt(b, a, data[i])
-            else:
-                y = signal.filtfilt(b, a, data)
-
-        return y
+        sos = filter_cache.design('low', order, cutoff, fs)
+        return cls.apply_filtfilt(data, sos=sos)
 
     @classmethod
     def butter_highpass_filter(cls, data, cutoff, fs, order=5):
         '''
         High pass filter based on scipy.signal.butter
-        :param data: 1-channel signal
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
         :param cutoff: cutoff frequency
         :param fs: signal sampling frequency
         :param order: order parameter for signal.signal.butter function
         :return: filtered signal
         '''
-        normal_cutoff = 2*cutoff/fs
-        b, a = signal.butter(order, normal_cutoff, btype='high', analog=False)
-
-        if isinstance(data, pd.DataFrame):
-            y = np.zeros((data.shape[0], data.shape[1]))
-            for i in range(data.shape[1]):
-                y[:, i] = signal.filtfilt(b, a, data.iloc[:, i])
-
-            y = pd.DataFrame(data=y, columns=data.columns)
-
-        elif isinstance(data, np.ndarray):
-            if len(data.shape) > 1:
-                y = np.zeros((data.shape[0], data.shape[1]))
-                for i in range(data.shape[0]):
-                    y[i] = signal.filtfilt(b, a, data[i])
-            else:
-                y = signal.filtfilt(b, a, data)
-
-        return y
+        sos = filter_cache.design('high', order, cutoff, fs)
+        return cls.apply_filtfilt(data, sos=sos)
 
     @classmethod
     def notch_filter(cls, data, notch_freq, smp_fs, quality_factor=30):
         '''
         Notch filter based on scipy.signal.iirnotch
-        :param data: 1-channel signal
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
         :param notch_freq: notch frequency
         :param fs: signal sampling frequency
         :param quality_factor: parameter for the scipy.signal.iirnotch function
         :return: filtered signal
         '''
-        # if isinstance(data, pd.DataFrame):
-        #     b_notch, a_notch = signal.iirnotch(notch_freq, quality_factor, smp_fs)
-        #     den = np.zeros((int(nperseg / 2 + 1), data.shape[1]))
-        #     for i in range(data.shape[1]):
-        #         y_notched = signal.filtfilt(b_notch, a_notch, data.iloc[:, i])
-        #         fs, den[:, i] = signal.welch(y_notched, smp_fs, nperseg=nperseg)
+        sos = filter_cache.design('notch', 2, notch_freq, smp_fs, quality_factor=quality_factor)
+        return cls.apply_filtfilt(data, sos=sos)
 
-        if isinstance(data, pd.DataFrame):
-            b_notch, a_notch = signal.iirnotch(notch_freq, quality_factor, smp_fs)
-            y_notched = np.zeros((data.shape[0], data.shape[1]))
-            for i in range(data.shape[1]):
-                y_notched[:, i] = signal.filtfilt(b_notch, a_notch, data.iloc[:, i])
-
-            y_notched = pd.DataFrame(data=y_notched, columns=data.columns)
+    @classmethod
+    def fir_bandpass_filter(cls, data, band, fs, numtaps=100, window='hamming'):
+        '''
+        Band pass filter based on scipy.signal.firwin
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
+        :param band: [low, high] cutoff frequencies
+        :param fs: signal sampling frequency
+        :param numtaps: length of the filter
+        :param window: window used to design the filter
+        :return: filtered signal
+        '''
+        taps = filter_cache.design('fir', numtaps, band, fs, window=window)
+        return cls.apply_filtfilt(data, taps=taps)
 
-        elif isinstance(data, np.ndarray):
-            b_notch, a_notch = signal.iirnotch(notch_freq, quality_factor, smp_fs)
-            if len(data.shape) > 1:
-                y_notched = np.zeros((data.shape[0], data.shape[1]))
-                for i in range(data.shape[0]):
-                    y_notched[i] = signal.filtfilt(b_notch, a_notch, data[i])
+    @classmethod
+    def padded_window(cls, read, start, stop, n_times, fs, filters, order=5, quality_factor=30, numtaps=100,
+                      tol=1e-6, padding=0):
+        '''
+        Filter the samples [start, stop) of a long signal, reading only this window and, on each side,
+        as many samples as the impulse responses of the filters last (see FilterDesignCache.padding),
+        the window then matches the whole filtered signal within about tol times the amplitude of the signal
+        :param read: function returning the samples in [begin, end), 1-channel or 2d-array (channels x samples)
+        :param start: first sample of the window
+        :param stop: last sample of the window (excluded)
+        :param n_times: number of samples of the whole signal
+        :param fs: sampling frequency
+        :param filters: tuple of (filter type, cutoff) applied in this order, type 'high', 'low', 'band' or
+                        'notch' (butterworth, iirnotch) or 'fir' (firwin band pass), cutoff [low, high] for bands
+        :param order: order of the butterworth filters
+        :param quality_factor: quality factor of the notch filters
+        :param numtaps: length of the FIR filters
+        :param tol: fraction of the impulse responses left out
+        :param padding: extra samples read on each side, for a transform applied to the result
+        :return: [filtered samples in [begin, end), begin], the window is [start - begin, stop - begin)
+        '''
+        designs = []
+        for filter_type, cutoff in filters:
+            if filter_type == 'fir':
+                designs.append((filter_type, numtaps, cutoff, fs, None, 'hamming'))
+            elif filter_type == 'notch':
+                designs.append((filter_type, 2, cutoff, fs, quality_factor, None))
+            else:
+                designs.append((filter_type, order, cutoff, fs, None, None))
+
+        padding += sum(filter_cache.padding(*design, tol=tol) for design in designs)
+        begin, end = max(start - padding, 0), min(stop + padding, n_times)
+        data = read(begin, end)
+        for design in designs:
+            if design[0] == 'fir':
+                data = cls.apply_filtfilt(data, taps=filter_cache.design(*design))
             else:
-                y_notched = signal.filtfilt(b_notch, a_notch, data)
+                data = cls.apply_filtfilt(data, sos=filter_cache.design(*design))
+        return [data, begin]
 
-        return y_notched
+    @classmethod
+    def filter_window(cls, read, start, stop, n_times, fs, filters, order=5, quality_factor=30, numtaps=100,
+                      tol=1e-6):
+        '''
+        Filter the samples [start, stop) of a long signal, the cost depends on the window and the filters,
+        not on the length of the signal, see padded_window
+        :return: filtered window, 1-channel or 2d-array (channels x samples)
+        '''
+        data, begin = cls.padded_window(read, start, stop, n_times, fs, filters, order=order,
+                                        quality_factor=quality_factor, numtaps=numtaps, tol=tol)
+        return data[..., start - begin:stop - begin]
 
     @classmethod
     def data_filted_to_den(cls, data, len, smp_freq, nperseg=5120, log=True):
         """
-        turn raw data to frequency domain
+        turn raw data to frequency domain, the segments are accumulated in float64 whatever the sample type
         :param data: input data, usually pd.DataFrame
         :param len: the length of the output data, nperseg/2+1
         :param smp_freq: sampling frequency of the raw data
@@ -132,9 +169,7 @@ class FrequencyAnalysis():
                   den: power density, pd.DataFrame]
         """
         if isinstance(data, pd.DataFrame):
-            den = np.zeros((len, data.shape[1]))
-            for i in range(data.shape[1]):
-                fseq, den[:, i] = signal.welch(data.iloc[:, i], smp_freq, nperseg=nperseg)
+            fseq, den = signal.welch(data.to_numpy(dtype=np.float64), smp_freq, nperseg=nperseg, axis=0)
 
             if log:
                 np.seterr(divide='ignore')
@@ -145,9 +180,7 @@ class FrequencyAnalysis():
             return [fseq, den]
 
         if isinstance(data, np.ndarray):
-            den = np.zeros((data.shape[0], len))
-            for i in range(data.shape[0]):
-                fseq, den[i] = signal.welch(data[i], smp_freq, nperseg=nperseg)
+            fseq, den = signal.welch(data.astype(np.float64, copy=False), smp_freq, nperseg=nperseg, axis=-1)
 
             if log:
                 np.seterr(divide='ignore')
@@ -171,100 +204,68 @@ class FrequencyAnalysis():
         '''
         if filter_type == 'low':
             y = cls.butter_lowpass_filter(data, cutoff, fs, order)
-            yf = fft.fft(y)
-            xf = fft.fftfreq(len(y), 1 / fs)
-
-            xf_ind = np.where(xf >= 0)
-            yf_half = yf[xf_ind]
-            xf_half = xf[xf_ind]
-            return [xf_half, yf_half]
-
         elif filter_type == 'high':
             y = cls.butter_highpass_filter(data, cutoff, fs, order)
-            yf = fft.fft(y)
-            xf = fft.fftfreq(len(y), 1 / fs)
-
-            xf_ind = np.where(xf >= 0)
-            yf_half = yf[xf_ind]
-            xf_half = xf[xf_ind]
-            return [xf_half, yf_half]
-
         elif filter_type == 'band':
             lowcut = cutoff[0]
             highcut = cutoff[1]
             y = cls.butter_bandpass_filter(data, lowcut, highcut, fs, order)
-            yf = fft.fft(y)
-            xf = fft.fftfreq(len(y), 1 / fs)
-
-            xf_ind = np.where(xf >= 0)
-            yf_half = yf[xf_ind]
-            xf_half = xf[xf_ind]
-            return [xf_half, yf_half]
-
         elif filter_type == 'notch':
             # Notice that the order here is the quality factor for notch
             y = cls.notch_filter(data, cutoff, fs, order)
-            yf = fft.fft(y)
-            xf = fft.fftfreq(len(y), 1 / fs)
+        else:
+            return None
 
-            xf_ind = np.where(xf >= 0)
-            yf_half = yf[xf_ind]
-            xf_half = xf[xf_ind]
-            return [xf_half, yf_half]
+        # the real FFT gives the positive half directly
+        return spectral.positive_spectrum(y, fs)
 
     @classmethod
-    def db4_filter(cls, data, freq):
+    def band_power(cls, data, fs, bands='classic', nperseg=1024, notch_freq=None, quality_factor=30):
         '''
-        Apply db4 filter on EEG data
-        :param data: 1-channel data, a time series
-        :param freq:
-        :return:
+        Power in a set of bands for every channel at once, integrated from a single Welch estimate
+        :param data: 1-channel signal, 2d-array (channels x samples) or pd.DataFrame (samples x channels)
+        :param fs: sampling frequency
+        :param bands: list of [low, high] bands, or the name of a preset in BAND_PRESETS
+        :param nperseg: nperseg in welch method
+        :param notch_freq: frequency removed by a notch filter before the estimate, None for no notch
+        :param quality_factor: parameter for the scipy.signal.iirnotch function
+        :return: powers, 1d-array (bands) for a 1-channel signal, 2d-array (channels x bands),
+                 or pd.DataFrame indexed by the channels with a column per band
         '''
+        bands = BAND_PRESETS[bands] if isinstance(bands, str) else bands
+        if notch_freq:
+            data = cls.notch_filter(data, notch_freq, fs, quality_factor)
 
-        xf_60, yf_60 = cls.signal_time_in_freq_out(data, 60, freq, 'notch', order=30)
-        data = cls.notch_filter(data, 60, freq, quality_factor=30)
-
-        xf_0_64, yf_0_64 = cls.signal_time_in_freq_out(data, 64, freq, 'low')
-        y_0_64 = cls.butter_lowpass_filter(data, 64, freq)
-
-        xf_0_32, yf_0_32 = cls.signal_time_in_freq_out(y_0_64, 32, freq, 'low')
-        y_0_32 = cls.butter_lowpass_filter(y_0_64, 32, freq)
-
-        xf_32_64, yf_32_64 = cls.signal_time_in_freq_out(y_0_64, 32, freq, 'high')
-        y_32_64 = cls.butter_highpass_filter(y_0_64, 32, freq)
-        f_32_64, power_den_32_64 = signal.welch(y_32_64, freq, nperseg=1024)
-        power_32_64 = integrate.trapz(power_den_32_64, f_32_64)
-
-        xf_32_64_tmp, yf_32_64_tmp = cls.signal_time_in_freq_out(data, [32, 64], freq, 'band')
-        y_32_64_tmp = cls.butter_bandpass_filter(data, 32, 64, freq)
-
-        xf_0_16, yf_0_16 = cls.signal_time_in_freq_out(y_0_32, 16, freq, 'low')
-        y_0_16 = cls.butter_lowpass_filter(y_0_32, 16, freq)
-
-        xf_16_32, yf_16_32 = cls.signal_time_in_freq_out(y_0_32, 16, freq, 'high')
-        y_16_32 = cls.butter_highpass_filter(y_0_32, 16, freq)
-        f_16_32, power_den_16_32 = signal.welch(y_16_32, freq, nperseg=1024)
-        power_16_32 = integrate.trapz(power_den_16_32, f_16_32)
-
-        xf_0_8, yf_0_8 = cls.signal_time_in_freq_out(y_0_16, 8, freq, 'low')
-        y_0_8 = cls.butter_lowpass_filter(y_0_16, 8, freq)
-
-        xf_8_16, yf_8_16 = cls.signal_time_in_freq_out(y_0_16, 8, freq, 'high')
-        y_8_16 = cls.butter_highpass_filter(y_0_16, 8, freq)
-        f_8_16, power_den_8_16 = signal.welch(y_8_16, freq, nperseg=1024)
-        power_8_16 = integrate.trapz(power_den_8_16, f_8_16)
-
-        xf_0_4, yf_0_4 = cls.signal_time_in_freq_out(y_0_8, 4, freq, 'low')
-        y_0_4 = cls.butter_lowpass_filter(y_0_8, 4, freq)
-
-        xf_4_8, yf_4_8 = cls.signal_time_in_freq_out(y_0_8, 4, freq, 'high')
-        y_4_8 = cls.butter_highpass_filter(y_0_8, 4, freq)
-        f_4_8, power_den_4_8 = signal.welch(y_4_8, freq, nperseg=1024)
-        power_4_8 = integrate.trapz(power_den_4_8, f_4_8)
+        if isinstance(data, pd.DataFrame):
+            fseq, den = cls.data_filted_to_den(data.to_numpy().T, 0, fs, nperseg=nperseg, log=False)
+            return pd.DataFrame(data=cls.band_power_from_psd(fseq, den, bands), index=data.columns,
+                                columns=['{}-{}Hz'.format(*band) for band in bands])
+        fseq, den = cls.data_filted_to_den(np.asarray(data), 0, fs, nperseg=nperseg, log=False)
+        return cls.band_power_from_psd(fseq, den, bands)
 
-        xf_0_4, yf_0_4 = cls.signal_time_in_freq_out(y_0_4, 0.5, freq, 'high')
-        y_0_4 = cls.butter_highpass_filter(y_0_8, 0.5, freq)
-        f_0_4, power_den_0_4 = signal.welch(y_0_4, freq, nperseg=1024)
-        power_0_4 = integrate.trapz(power_den_0_4, f_0_4)
+    @classmethod
+    def band_power_from_psd(cls, fseq, den, bands):
+        '''
+        Power in a set of bands, trapezoidal integral of a power density over the frequencies of each band
+        :param fseq: frequencies of the power density, 1d-array
+        :param den: power density (not log), frequencies on the last axis
+        :param bands: list of [low, high] bands
+        :return: powers, the band axis replaces the frequency axis
+        '''
+        den = np.asarray(den)
+        power = np.zeros(den.shape[:-1] + (len(bands),))
+        for i, band in enumerate(bands):
+            in_band = (fseq >= band[0]) & (fseq <= band[1])
+            power[..., i] = integrate.trapezoid(den[..., in_band], fseq[in_band], axis=-1)
+        return power
 
-        return [power_32_64, power_16_32, power_8_16, power_4_8, power_0_4]
+    @classmethod
+    def db4_filter(cls, data, freq):
+        '''
+        Power of the db4 bands (32-64, 16-32, 8-16, 4-8 and 0.5-4 Hz) after a 60 Hz notch filter,
+        integrated from one Welch estimate instead of a cascade of filters
+        :param data: 1-channel data, a time series
+        :param freq: sampling frequency
+        :return: [power_32_64, power_16_32, power_8_16, power_4_8, power_0_4]
+        '''
+        return list(cls.band_power(data, freq, bands='db4', nperseg=1024, notch_freq=60, quality_factor=30))
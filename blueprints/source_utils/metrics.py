@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+
+class MetricsRegistry():
+    """
+    process-wide counters, gauges and histograms, rendered in the Prometheus text format
+    every update returns immediately while enabled is False, so instrumented code costs a single test when off
+    enabled: record the observations
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._families = OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _declare(self, name, metric_type, description, buckets=None):
+        self._families[name] = dict(type=metric_type, help=description, buckets=buckets, series=OrderedDict())
+
+    def counter(self, name, description):
+        self._declare(name, 'counter', description)
+
+    def gauge(self, name, description):
+        self._declare(name, 'gauge', description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        self._declare(name, 'histogram', description, tuple(buckets))
+
+    def add_collector(self, collector):
+        """
+        :param collector: function called before rendering, usually setting gauges from some state
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        """
+        add to a counter or a gauge
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._families[name]['series']
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        set a gauge (or a counter maintained elsewhere)
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._families[name]['series'][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        add an observation to a histogram
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families[name]
+            if key not in family['series']:
+                family['series'][key] = dict(buckets=np.zeros(len(family['buckets']), dtype=np.int64),
+                                             sum=0.0, count=0)
+            series = family['series'][key]
+            series['buckets'][np.searchsorted(family['buckets'], value):] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def observe_payload(self, name, data, **labels):
+        """
+        observe the number of bytes of the arrays of a ColumnDataSource update
+        :param data: dictionary of columns, arrays or lists of arrays
+        """
+        if not self.enabled:
+            return
+        self.observe(name, payload_nbytes(data), **labels)
+
+    def timer(self, name, **labels):
+        """
+        :return: context manager observing its duration in a histogram
+        """
+        return _Timer(self, name, labels)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        for collector in self._collectors:
+            collector()
+
+        lines = []
+        with self._lock:
+            for name, family in self._families.items():
+                lines.append('# HELP {} {}'.format(name, family['help']))
+                lines.append('# TYPE {} {}'.format(name, family['type']))
+                for key, series in family['series'].items():
+                    if family['type'] != 'histogram':
+                        lines.append('{}{} {}'.format(name, _format_labels(key), _format_value(series)))
+                        continue
+                    for bound, count in zip(family['buckets'], series['buckets']):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(key + (('le', bound),)), count))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(key + (('le', '+Inf'),)),
+                                                         series['count']))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(key), _format_value(series['sum'])))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(key), series['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer():
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.perf_counter() - self.start_time, **self.labels)
+        return False
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for label, value in key) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def payload_nbytes(data):
+    """
+    :param data: dictionary of columns, arrays or lists of arrays
+    :return: number of bytes of the arrays
+    """
+    nbytes = 0
+    for column in data.values():
+        if isinstance(column, np.ndarray):
+            nbytes += column.nbytes
+        else:
+            nbytes += sum(np.asarray(i).nbytes for i in column)
+    return nbytes
+
+
+def resident_memory():
+    """
+    :return: resident set size of this process in bytes, the peak value where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+metrics = MetricsRegistry()
+metrics.histogram('eeg_callback_seconds', 'Time from a widget change to the update of the plot')
+metrics.counter('eeg_callback_dropped_total', 'Results dropped because a newer update was submitted')
+metrics.counter('eeg_callback_errors_total', 'Callbacks that raised an exception')
+metrics.histogram('eeg_payload_bytes', 'Bytes of arrays sent to a ColumnDataSource by an update', SIZE_BUCKETS)
+metrics.histogram('eeg_recording_load_seconds', 'Time to open a recording that was not in the store')
+metrics.gauge('eeg_active_sessions', 'Open bokeh sessions')
+metrics.gauge('eeg_process_resident_bytes', 'Resident memory of the process')
+metrics.add_collector(lambda: metrics.set('eeg_process_resident_bytes', resident_memory()))
@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from .source_df import RawDF, SpectrumDF
+from .metrics import metrics
+
+
+class RecordingStore():
+    """
+    process-wide store of the opened recordings, shared by every bokeh session
+    entries: recordings keyed by (file path, modification time, class, options), kept in LRU order
+    owners: the sessions holding each entry, an entry can only be evicted when no session holds it
+    budget: memory budget in bytes, least recently used entries are evicted above it
+    hits/misses: number of requests served from the store / loaded from disk
+    """
+
+    def __init__(self, budget_mb=2048):
+        """
+        initial method
+        :param budget_mb: memory budget of the store, in MB
+        """
+        self.budget = int(budget_mb * 1024 ** 2)
+        self.entries = OrderedDict()
+        self.owners = dict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._key_locks = dict()
+
+    def set_budget(self, budget_mb):
+        """
+        change the memory budget and evict entries if needed
+        :param budget_mb: memory budget of the store, in MB
+        """
+        with self._lock:
+            self.budget = int(budget_mb * 1024 ** 2)
+            self.evict()
+
+    @staticmethod
+    def make_key(cls, filename, **kwargs):
+        path = os.path.abspath(filename)
+        return (path, os.path.getmtime(path), cls.__name__, tuple(sorted(kwargs.items())))
+
+    def get(self, cls, filename, owner=None, progress=None, **kwargs):
+        """
+        return the recording of this file, loading it only if no session opened it yet
+        :param cls: RawDF or SpectrumDF
+        :param filename: path of the EDF file
+        :param owner: id of the session holding the recording, released by release(owner)
+        :param progress: optional callable receiving the fraction of the samples read, when the file is loaded
+        :param kwargs: passed to the constructor of cls
+        :return: the shared recording
+        """
+        key = self.make_key(cls, filename, **kwargs)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # loading happens outside the store lock, so that other files stay available meanwhile,
+        # the per-file lock makes concurrent sessions wait for a single parse of the same file
+        with key_lock:
+            with self._lock:
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    recording = self.entries[key]
+                else:
+                    recording = None
+
+            if recording is None:
+                start_time = time.perf_counter()
+                if progress is not None:
+                    recording = cls(filename=filename, progress=progress, **kwargs)
+                else:
+                    recording = cls(filename=filename, **kwargs)
+                metrics.observe('eeg_recording_load_seconds', time.perf_counter() - start_time, kind=cls.__name__)
+                with self._lock:
+                    self.misses += 1
+                    self.entries[key] = recording
+                    self.owners[key] = set()
+
+            with self._lock:
+                if owner is not None:
+                    self.owners[key].add(owner)
+                self.evict()
+
+        return recording
+
+    def get_raw(self, filename, owner=None, progress=None, **kwargs):
+        return self.get(RawDF, filename, owner, progress, **kwargs)
+
+    def get_spectrum(self, filename, owner=None, progress=None, **kwargs):
+        return self.get(SpectrumDF, filename, owner, progress, **kwargs)
+
+    def lookup(self, cls, filename, owner=None, **kwargs):
+        """
+        return the recording of this file only if it is already in the store, never loads it
+        :param cls: RawDF or SpectrumDF
+        :param filename: path of the EDF file, OSError if it does not exist
+        :param owner: id of the session holding the recording, released by release(owner)
+        :param kwargs: options of the recording
+        :return: the shared recording, or None
+        """
+        key = self.make_key(cls, filename, **kwargs)
+        with self._lock:
+            if key not in self.entries:
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if owner is not None:
+                self.owners[key].add(owner)
+            return self.entries[key]
+
+    def lookup_raw(self, filename, owner=None, **kwargs):
+        return self.lookup(RawDF, filename, owner, **kwargs)
+
+    def release(self, owner):
+        """
+        drop every reference held by a session, usually called when the session is destroyed
+        :param owner: id of the session
+        """
+        with self._lock:
+            for owners in self.owners.values():
+                owners.discard(owner)
+            self.evict()
+
+    def clear(self):
+        """
+        drop every recording, even the ones still held by sessions (they keep their own reference)
+        """
+        with self._lock:
+            self.entries.clear()
+            self.owners.clear()
+            self._key_locks.clear()
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(recording.memory_usage() for recording in self.entries.values())
+
+    def evict(self):
+        """
+        evict the least recently used recordings nobody holds until the store fits in the budget
+        """
+        with self._lock:
+            usage = self.memory_usage()
+            for key in list(self.entries.keys()):
+                if usage <= self.budget:
+                    break
+                if self.owners[key]:
+                    continue
+                usage -= self.entries.pop(key).memory_usage()
+                del self.owners[key]
+                self._key_locks.pop(key, None)
+
+
+recording_store = RecordingStore()
+
+
+def collect_store_metrics():
+    if not metrics.enabled:
+        return
+    metrics.set('eeg_store_recordings', len(recording_store.entries))
+    metrics.set('eeg_store_bytes', recording_store.memory_usage())
+    metrics.set('eeg_store_requests_total', recording_store.hits, result='hit')
+    metrics.set('eeg_store_requests_total', recording_store.misses, result='miss')
+
+
+metrics.gauge('eeg_store_recordings', 'Recordings held by the store')
+metrics.gauge('eeg_store_bytes', 'Bytes held by the recordings of the store and their derived structures')
+metrics.counter('eeg_store_requests_total', 'Recording requests served from the store (hit) or loaded (miss)')
+metrics.add_collector(collect_store_metrics)
@@ -4,20 +4,43 @@ import pandas as pd
 from scipy import signal
 from collections import OrderedDict
 from .frequency_analysis import FrequencyAnalysis
+from .edf_cache import EdfCache
+import os
 import re
+import threading
 
 """Need to implement notch_policy=False"""
 
 
+def contiguous(index):
+    """
+    turn sorted indices into a slice when they are contiguous, so that selecting them gives a view
+    :param index: 1d-array of increasing indices
+    :return: slice or the indices
+    """
+    if len(index) > 0 and index[-1] - index[0] == len(index) - 1:
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
 class RawDF():
     """
     read file and save in this object
-    raw: raw variable from mne
+    raw: raw variable from mne (opened on first access when the samples come from the cache)
+    source_mtime: modification time of the file when it was opened
+    cache: EdfCache object when an up-to-date cache of the file exists, written by ingest.py
     ch_names: channel names
     nchan: channel number
-    data: save the data into a Dataframe, each column is a channel
+    n_times: number of samples per channel
+    times: time of each sample, in seconds
+    data: save the data into a Dataframe, each column is a channel (built on first access in lazy mode)
     brain_regions: generated brain regions using channel names
-    dict_df_raw: a dictionary, save each brain region data in a key
+    region_index: a dictionary, positions of the channels of each brain region
+    dict_df_raw: a dictionary, save each brain region data in a key (built on first access in lazy mode)
+    derived: structures computed from the samples and shared by the sessions (min/max pyramid, Welch segment
+             caches), counted in memory_usage and dropped with the recording
+    data, dict_df_raw and get_window are views of one read-only buffer (channels x samples) once it is loaded,
+    the buffer is the mapped cache itself when its sample type matches, shared by every process of the server
     """
 
     def __init__(self, **kwargs):
@@ -26,27 +49,63 @@ class RawDF():
         :param kwargs:
             filename: must exist, generate object using this file
             channels_policy: all or part stating whether to use whole data set
+            lazy: if True, samples stay on disk and are read block by block through get_window,
+                  the full dataframe is only built when data/dict_df_raw is accessed
+            use_cache: if True (default), read the samples from the memory-mapped cache when it is up to date
+            dtype: sample type of every window and dataframe, 'float64' (default) or 'float32'
+            progress: optional callable receiving the fraction of the samples read, when they are loaded
         """
         if "filename" not in kwargs.keys():
             raise ValueError("Must declare the file path")
-        self.raw = mne.io.read_raw_edf(kwargs['filename'])
-        self.freq = self.raw.info['sfreq']
+        self.filename = kwargs['filename']
+        self.source_mtime = os.path.getmtime(self.filename)
+        self.lazy = kwargs['lazy'] if 'lazy' in kwargs.keys() else False
+        self.dtype = np.dtype(kwargs['dtype']) if 'dtype' in kwargs.keys() else np.dtype('float64')
+        use_cache = kwargs['use_cache'] if 'use_cache' in kwargs.keys() else True
+        self.cache = EdfCache.open(self.filename) if use_cache else None
+
+        if self.cache is not None:
+            self._raw = None
+            self.freq = self.cache.freq
+            self.n_times = self.cache.n_times
+            file_ch_names = self.cache.ch_names
+        else:
+            self._raw = mne.io.read_raw_edf(self.filename, preload=False)
+            self.freq = self._raw.info['sfreq']
+            self.n_times = self._raw.n_times
+            file_ch_names = self._raw.ch_names
+        self.times = np.arange(self.n_times) / self.freq
+        self.ch_index = {ch_name: i for i, ch_name in enumerate(file_ch_names)}
 
         if 'channels_policy' in kwargs.keys():
             self.channels_policy = kwargs['channels_policy']
             if self.channels_policy == 'all':
-                self.ch_names = self.raw.ch_names
-                self.nchan = self.raw.info['nchan']
+                self.ch_names = file_ch_names
+                self.nchan = len(file_ch_names)
             elif self.channels_policy == 'customize':
                 if "ch_names" in kwargs.keys():
                     self.ch_names = kwargs['ch_names']
+                    self.nchan = len(self.ch_names)
         else:
-            self.nchan = self.raw.info['nchan']
-            self.ch_names = self.raw.ch_names
+            self.nchan = len(file_ch_names)
+            self.ch_names = file_ch_names
+        self.ch_position = {ch_name: i for i, ch_name in enumerate(self.ch_names)}
 
-        self.data = pd.DataFrame(data=self.raw.get_data().T, columns=self.ch_names)
-        self.brain_regions = self.find_brain_region()
-        self.dict_df_raw = self.df_to_dict_raw()
+        if self.cache is not None and list(self.ch_names) == list(self.cache.ch_names):
+            self.brain_regions = np.array(self.cache.brain_regions)
+            self.region_index = self.cache.region_index
+        else:
+            self.brain_regions = self.find_brain_region()
+        self._samples = None
+        self._data = None
+        self._dict_df_raw = None
+        self._channel_stats = None
+        self._stats_lock = threading.Lock()
+        self.derived = dict()
+        if not self.lazy:
+            self.load(progress=kwargs['progress'] if 'progress' in kwargs.keys() else None)
+            self._data = self.data
+            self._dict_df_raw = self.dict_df_raw
 
         """
         ['acq_pars',
@@ -87,14 +146,163 @@ class RawDF():
          'nchan']
         """
 
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = mne.io.read_raw_edf(self.filename, preload=False)
+        return self._raw
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = pd.DataFrame(data=self.load().T, columns=self.ch_names, copy=False)
+        return self._data
+
+    @property
+    def dict_df_raw(self):
+        if self._dict_df_raw is None:
+            self._dict_df_raw = self.df_to_dict_raw()
+        return self._dict_df_raw
+
+    def memory_usage(self):
+        """
+        bytes held in memory by this object: sample data, times, statistics and derived structures,
+        a lazy recording still holds its times and what the sessions computed from it
+        :return: number of bytes
+        """
+        nbytes = self.times.nbytes
+        if self._channel_stats is not None:
+            nbytes += self._channel_stats.memory_usage(index=False).sum()
+        for structure in list(self.derived.values()):
+            nbytes += structure.memory_usage()
+        if self._samples is not None and not isinstance(self._samples, np.memmap):
+            nbytes += self._samples.nbytes
+        if self._dict_df_raw is not None:
+            for df_region in self._dict_df_raw.values():
+                if not np.shares_memory(df_region.to_numpy(), self._samples):
+                    nbytes += df_region.memory_usage(index=False).sum()
+        return int(nbytes)
+
+    def load(self, progress=None, chunk_size=2 ** 18):
+        """
+        read the whole recording once, get_window then slices this buffer instead of reading the file
+        :param progress: optional callable receiving the fraction read, the file is then read chunk by chunk
+        :param chunk_size: number of samples read at once when reporting the progress
+        :return: read-only 2d-array, channels x samples
+        """
+        if self._samples is None:
+            if self.cache is not None and self.cache.samples.dtype == self.dtype \
+                    and list(self.ch_names) == list(self.cache.ch_names):
+                # pages of the mapped cache are shared with the other processes opening this recording
+                self._samples = self.cache.samples
+            else:
+                if progress is None:
+                    samples = self.read_window(np.arange(self.nchan), 0, self.n_times)
+                else:
+                    samples = np.empty((self.nchan, self.n_times), dtype=self.dtype)
+                    for start in range(0, self.n_times, chunk_size):
+                        stop = min(start + chunk_size, self.n_times)
+                        samples[:, start:stop] = self.read_window(np.arange(self.nchan), start, stop)
+                        progress(stop / self.n_times)
+                samples.flags.writeable = False
+                self._samples = samples
+        return self._samples
+
+    def channel_stats(self, chunk_size=2 ** 18, compute=True):
+        """
+        mean, standard deviation, minimum and maximum of every channel over the whole recording,
+        computed once, chunk by chunk, and cached, the sessions sharing the recording wait for the first computation
+        :param chunk_size: number of samples read from the file at once
+        :param compute: if False, None is returned while the statistics are not computed
+        :return: pd.DataFrame indexed by channel names, columns mean, std, min, max
+        """
+        if self._channel_stats is not None or not compute:
+            return self._channel_stats
+        with self._stats_lock:
+            if self._channel_stats is None:
+                total = np.zeros(self.nchan)
+                total_square = np.zeros(self.nchan)
+                minimum = np.full(self.nchan, np.inf)
+                maximum = np.full(self.nchan, -np.inf)
+                for start in range(0, self.n_times, chunk_size):
+                    chunk = self.get_window(None, start, start + chunk_size).astype(np.float64)
+                    total += chunk.sum(axis=1)
+                    total_square += np.square(chunk).sum(axis=1)
+                    minimum = np.minimum(minimum, chunk.min(axis=1))
+                    maximum = np.maximum(maximum, chunk.max(axis=1))
+
+                mean = total / self.n_times
+                std = np.sqrt(np.maximum(total_square / self.n_times - np.square(mean), 0))
+                self._channel_stats = self.stats_frame(mean, std, minimum, maximum, self.ch_names)
+        return self._channel_stats
+
+    @staticmethod
+    def stats_frame(mean, std, minimum, maximum, ch_names):
+        return pd.DataFrame(data={'mean': mean, 'std': std, 'min': minimum, 'max': maximum}, index=ch_names)
+
+    def window_stats(self, start=0, stop=None):
+        """
+        statistics of every channel in [start, stop), an estimate of channel_stats reading only this window
+        :param start: first sample
+        :param stop: last sample (excluded), None for the end of the recording
+        :return: pd.DataFrame indexed by channel names, columns mean, std, min, max
+        """
+        data = self.get_window(None, start, stop).astype(np.float64)
+        return self.stats_frame(data.mean(axis=1), data.std(axis=1), data.min(axis=1), data.max(axis=1),
+                                self.ch_names)
+
+    def get_window(self, channels=None, start=0, stop=None):
+        """
+        read the samples of some channels in [start, stop), only this window is read from the file in lazy mode
+        :param channels: channel names or channel indices, None for all channels
+        :param start: first sample
+        :param stop: last sample (excluded), None for the end of the recording
+        :return: 2d-array, channels x samples, of the sample type of the recording,
+                 a read-only view when the recording is loaded and the channels are contiguous
+        """
+        if channels is None:
+            picks = np.arange(self.nchan)
+        else:
+            picks = np.array([i if isinstance(i, (int, np.integer)) else self.ch_position[i] for i in channels],
+                             dtype=int)
+        stop = self.n_times if stop is None else min(int(stop), self.n_times)
+        start = min(max(int(start), 0), stop)
+        if len(picks) == 0:
+            return np.zeros((0, stop - start), dtype=self.dtype)
+
+        if self._samples is not None:
+            if np.all(np.diff(picks) > 0):
+                picks = contiguous(picks)
+            return self._samples[picks, start:stop]
+        return self.read_window(picks, start, stop)
+
+    def read_window(self, picks, start, stop):
+        """
+        read a window from the cache, or from the file through mne
+        :param picks: channel positions
+        :param start: first sample
+        :param stop: last sample (excluded)
+        :return: 2d-array, channels x samples, of the sample type of the recording
+        """
+        ch_names = [self.ch_names[i] for i in picks]
+        if self.cache is not None:
+            data = self.cache.get_data([self.ch_index[ch_name] for ch_name in ch_names], start, stop)
+        else:
+            data = self.raw.get_data(picks=ch_names, start=start, stop=stop)
+        return data.astype(self.dtype, copy=False)
+
     def find_brain_region(self):
         """
         Split every channel names, extract the string at the beginning.
+        The positions of the channels starting with each region are saved in region_index.
         :return: channel kinds
         """
         splitted_ch_names = [re.split(r'(\d+)', i) for i in self.ch_names]
         channel_split_string_num = np.array([i[0] for i in splitted_ch_names])
         self.brain_regions = np.unique(channel_split_string_num)
+        ch_names = np.array(self.ch_names, dtype=str)
+        self.region_index = OrderedDict((region, np.flatnonzero(np.char.startswith(ch_names, region)))
+                                        for region in self.brain_regions)
         return self.brain_regions
 
     def df_to_dict_raw(self):
@@ -104,23 +312,44 @@ class RawDF():
         """
         dict_df_regions_signals = OrderedDict()
         for region in self.brain_regions:
-            den_mask = [ch_name.startswith(region) for ch_name in self.ch_names]
-            dict_df_regions_signals[region] = self.data.loc[:, den_mask]
+            dict_df_regions_signals[region] = self.data.iloc[:, contiguous(self.region_index[region])]
 
         return dict_df_regions_signals
 
-
-    def filter_data_from_region(self, region: list):
-        data = self.raw.get_data()
-        data_mask = np.zeros(self.nchan)
+    def region_picks(self, region: list):
+        """
+        positions of the channels belonging to some brain regions, in channel order
+        :param region: list of brain regions, a region missing from this recording selects the channels starting with it
+        :return: slice if the channels are contiguous, otherwise 1d-array of positions
+        """
+        index = [np.zeros(0, dtype=int)]
         for i in region:
-            for j in range(len(self.ch_names)):
-                if self.ch_names[j].startswith(i):
-                    data_mask[j] = 1
+            if i in self.region_index:
+                index.append(self.region_index[i])
+            else:
+                index.append(np.flatnonzero(np.char.startswith(np.array(self.ch_names, dtype=str), i)))
+        return contiguous(np.unique(np.concatenate(index)))
 
-        data_mask = data_mask.astype('bool')
-        data_masked = data[data_mask]
-        chan_masked = np.array(self.ch_names)[data_mask]
+
+    def channels_from_region(self, region: list):
+        """
+        select the channels belonging to some brain regions
+        :param region: list of brain regions
+        :return: channel names
+        """
+        return np.array(self.ch_names)[self.region_picks(region)]
+
+    def filter_data_from_region(self, region: list, start=0, stop=None):
+        """
+        read the samples of the channels belonging to some brain regions
+        :param region: list of brain regions
+        :param start: first sample of the window
+        :param stop: last sample of the window (excluded), None for the end of the recording
+        :return: [channel names, 2d-array channels x samples]
+        """
+        picks = self.region_picks(region)
+        chan_masked = np.array(self.ch_names)[picks]
+        data_masked = self.get_window(np.arange(self.nchan)[picks], start, stop)
         return [chan_masked, data_masked]
 
 
@@ -147,33 +376,37 @@ class SpectrumDF(RawDF):
         # self.fs, self.den, self.df = self.compute_spectrum()
         # self.dict_df_fft = self.df_to_dict_fft()
 
+    def memory_usage(self):
+        """
+        bytes of sample data and spectra currently held in memory by this object
+        :return: number of bytes
+        """
+        nbytes = super(SpectrumDF, self).memory_usage()
+        if self.data_filted is not self.data:
+            nbytes += self.data_filted.memory_usage(index=False).sum()
+        nbytes += self.den.memory_usage(index=False).sum()
+        return int(nbytes)
+
     def filt_signal(self):
+        """
+        filter every channel at once, each filter is a single call over the whole dataframe
+        :return: filtered pd.DataFrame
+        """
         data_filted = self.data
         if self.notch_freq:
             data_filted = FrequencyAnalysis.notch_filter(data_filted, self.notch_freq,
                                                          self.freq, self.quality_factor)
-        if isinstance(data_filted, np.ndarray):
-            data_filted = pd.DataFrame(data=data_filted, columns=self.ch_names)
-
         if self.highpass_freq:
             data_filted = FrequencyAnalysis.butter_highpass_filter(data_filted, self.highpass_freq,
                                                                    self.freq, self.order)
-        if isinstance(data_filted, np.ndarray):
-            data_filted = pd.DataFrame(data=data_filted, columns=self.ch_names)
+        if self.lowpass_freq:
+            data_filted = FrequencyAnalysis.butter_lowpass_filter(data_filted, self.lowpass_freq,
+                                                                  self.freq, self.order)
         return data_filted
 
     def data_filted_to_den(self):
-        den = np.zeros((int(self.nperseg / 2 + 1), self.data_filted.shape[1]))
-        for i in range(self.data_filted.shape[1]):
-            fseq, den[:, i] = signal.welch(self.data_filted.iloc[:, i], self.freq, nperseg=self.nperseg)
-
-        if self.log:
-            np.seterr(divide='ignore')
-            den = np.log10(den)
-            np.seterr(divide='warn')
-
-        den = pd.DataFrame(data=den, columns=self.ch_names)
-        return [fseq, den]
+        return FrequencyAnalysis.data_filted_to_den(self.data_filted, int(self.nperseg / 2 + 1), self.freq,
+                                                    nperseg=self.nperseg, log=self.log)
 
     def compute_spectrum(self, nperseg=5120, time_window_policy='all', time_window=None,
                          notch_policy=True, notch_freq=60):
@@ -237,8 +470,7 @@ class SpectrumDF(RawDF):
         """
         dict_df_regions_signals = {}
         for region in self.brain_regions:
-            den_mask = [ch_name.startswith(region) for ch_name in self.ch_names]
-            dict_df_regions_signals[region] = self.den.loc[:, den_mask]
+            dict_df_regions_signals[region] = self.den.iloc[:, contiguous(self.region_index[region])]
 
         return dict_df_regions_signals
 
@@ -0,0 +1,80 @@
+import numpy as np
+from scipy import fft
+
+
+class SpectralBackend():
+    """
+    FFT calls shared by the analyses: real-input transforms, lengths padded to fast FFT sizes where the padding
+    does not change the result, and several threads per transform
+    workers: threads of every transform, None for all cores
+    """
+
+    def __init__(self, workers=None):
+        """
+        initial method
+        :param workers: threads of every transform, None for all cores
+        """
+        self.workers = workers
+
+    def set_workers(self, workers):
+        """
+        :param workers: threads of every transform, None for all cores, 1 inside processes of a pool
+        """
+        self.workers = workers
+
+    def _workers(self):
+        return -1 if self.workers is None else self.workers
+
+    @staticmethod
+    def fast_length(n):
+        """
+        :return: smallest length >= n made of small prime factors, its real FFT is the fastest
+        """
+        return fft.next_fast_len(int(n), real=True)
+
+    def rfft(self, x, n=None, axis=-1):
+        return fft.rfft(x, n, axis=axis, workers=self._workers())
+
+    def irfft(self, x, n=None, axis=-1):
+        return fft.irfft(x, n, axis=axis, workers=self._workers())
+
+    def ifft(self, x, n=None, axis=-1):
+        return fft.ifft(x, n, axis=axis, workers=self._workers())
+
+    def positive_spectrum(self, data, fs):
+        """
+        spectrum of a real signal at its non-negative frequencies, the positive half of fft.fft from a real FFT
+        the length is kept (padding would change the frequencies)
+        :param data: 1-channel signal, or channels x samples
+        :param fs: sampling frequency
+        :return: [frequencies, complex spectrum], the frequencies of fft.fftfreq that are >= 0
+        """
+        n = np.shape(data)[-1]
+        half = (n + 1) // 2
+        return [fft.rfftfreq(n, 1 / fs)[:half], self.rfft(data)[..., :half]]
+
+    def analytic_signal(self, data, axis=-1):
+        """
+        analytic signal, as scipy.signal.hilbert of the signal followed by zeros up to a fast length
+        the real part is the signal itself, the imaginary part takes a real FFT and its inverse
+        :param data: real signal, 1-channel or channels x samples
+        :param axis: time axis
+        :return: complex array, same shape
+        """
+        data = np.asarray(data)
+        n = data.shape[axis]
+        nfft = self.fast_length(n)
+        spectrum = np.moveaxis(self.rfft(data, nfft, axis), axis, -1)
+        # -1j on the positive frequencies, 0 at 0 and at nfft / 2, gives the Hilbert transform
+        spectrum[..., 0] = 0
+        if nfft % 2 == 0:
+            spectrum[..., -1] = 0
+        spectrum *= -1j
+        hilbert = self.irfft(spectrum, nfft)[..., :n]
+        analytic = np.empty(data.shape, dtype=np.result_type(data.dtype, np.complex64))
+        analytic.real = data
+        analytic.imag = np.moveaxis(hilbert, -1, axis)
+        return analytic
+
+
+spectral = SpectralBackend()
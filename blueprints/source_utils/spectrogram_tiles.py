@@ -0,0 +1,219 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from .metrics import metrics
+from .welch_cache import get_welch_cache, filter_channel
+
+
+class SpectrogramTileCache():
+    """
+    short-time power spectra of single channels, cut in tiles of tile_columns columns and kept in a LRU cache
+    the columns of level 0 are the Welch segments of the channel (hann window, nperseg // 2 step),
+    a column of level z is the mean of 2 ** z consecutive segments, so a whole recording fits in a few tiles
+    of the top level and a zoomed view needs only the tiles of its interval
+    tiles are keyed by (file, modification time, sample type, channel, nperseg, filters, level, tile index),
+    a rewritten file never gets the tiles of its previous version
+    """
+
+    def __init__(self, budget_mb=256, tile_columns=256, chunk_segments=2048, channels_kept=4):
+        """
+        initial method
+        :param budget_mb: memory kept for the tiles, in MB, the least recently used tiles are dropped beyond it
+        :param tile_columns: number of columns of a tile
+        :param chunk_segments: number of segments transformed at once
+        :param channels_kept: number of filtered channels kept to compute their next tiles
+        """
+        self.budget = budget_mb * 2 ** 20
+        self.tile_columns = tile_columns
+        self.chunk_segments = chunk_segments
+        self.channels_kept = channels_kept
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget = budget_mb * 2 ** 20
+            self.evict()
+
+    @staticmethod
+    def recording_key(recording):
+        """
+        :return: (file path, modification time when opened, sample type), as the key of the recording store
+        """
+        return (os.path.abspath(recording.filename), recording.source_mtime, recording.dtype.str)
+
+    @staticmethod
+    def n_segments(recording, nperseg):
+        return max((recording.n_times - nperseg) // (nperseg - nperseg // 2) + 1, 0)
+
+    def n_levels(self, recording, nperseg):
+        """
+        :return: number of levels, the top level holds the whole recording in one tile
+        """
+        return max(math.ceil(math.log2(max(self.n_segments(recording, nperseg) / self.tile_columns, 1))), 0) + 1
+
+    def tile_samples(self, nperseg, level):
+        """
+        :return: number of samples between the starts of two tiles of a level
+        """
+        return self.tile_columns * 2 ** level * (nperseg - nperseg // 2)
+
+    def view(self, recording, nperseg, start, stop, max_columns):
+        """
+        tiles covering [start, stop) with at most about max_columns columns
+        :param recording: RawDF object
+        :param nperseg: length of each segment
+        :param start: first sample of the view
+        :param stop: last sample of the view (excluded)
+        :param max_columns: number of columns wanted in the view, usually the width of the plot
+        :return: [level, list of tile indices]
+        """
+        step = nperseg - nperseg // 2
+        segments = max((stop - start) / step, 1)
+        level = min(max(math.ceil(math.log2(max(segments / max_columns, 1))), 0),
+                    self.n_levels(recording, nperseg) - 1)
+        n_tiles = -(-self.n_segments(recording, nperseg) // (self.tile_columns * 2 ** level))
+        first = min(max(int(start) // self.tile_samples(nperseg, level), 0), max(n_tiles - 1, 0))
+        last = min(max(int(stop) - 1, 0) // self.tile_samples(nperseg, level), n_tiles - 1)
+        return [level, list(range(first, last + 1))]
+
+    def neighbours(self, recording, nperseg, level, indices):
+        """
+        tiles a user is likely to look at next: one tile on each side of the view, and the view one level finer
+        :return: list of (level, tile index)
+        """
+        n_tiles = -(-self.n_segments(recording, nperseg) // (self.tile_columns * 2 ** level))
+        tiles = [(level, i) for i in [indices[0] - 1, indices[-1] + 1] if 0 <= i < n_tiles]
+        if level > 0:
+            tiles += [(level - 1, i) for i in range(2 * indices[0], 2 * indices[-1] + 2)]
+        return tiles
+
+    def get_tile(self, recording, channel, nperseg, level, index, filters=()):
+        """
+        one tile, from the cache or computed
+        :param recording: RawDF object
+        :param channel: channel index
+        :param nperseg: length of each segment
+        :param level: zoom level, a column is the mean of 2 ** level segments
+        :param index: index of the tile in the level
+        :param filters: tuple of (filter type, frequency), type 'high', 'low' or 'notch', applied in this order
+        :return: dictionary, image: power density (float32, frequencies x columns), start: first sample,
+                 samples: number of samples covered by the columns
+        """
+        key = (self.recording_key(recording), channel, nperseg, filters, level, index)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+            self.misses += 1
+
+        tile = self.compute_tile(recording, channel, nperseg, level, index, filters)
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self.nbytes += tile['image'].nbytes
+                self.evict()
+        return tile
+
+    def prefetch(self, recording, channel, nperseg, tiles, filters=()):
+        """
+        compute the tiles missing from the cache, meant to run in the background
+        :param tiles: list of (level, tile index)
+        """
+        for level, index in tiles:
+            key = (self.recording_key(recording), channel, nperseg, filters, level, index)
+            with self._lock:
+                cached = key in self._tiles
+            if not cached:
+                self.get_tile(recording, channel, nperseg, level, index, filters)
+
+    def compute_tile(self, recording, channel, nperseg, level, index, filters=()):
+        welch = get_welch_cache(recording, nperseg)
+        step = nperseg - nperseg // 2
+        per_column = 2 ** level
+        n_segments = self.n_segments(recording, nperseg)
+        first_column = index * self.tile_columns
+        n_columns = max(min(self.tile_columns, -(-n_segments // per_column) - first_column), 0)
+        first_segment = first_column * per_column
+        last_segment = min((first_column + n_columns) * per_column, n_segments)
+        data = self.channel_data(recording, channel, filters)
+
+        total = np.zeros((n_columns, welch.freqs.size))
+        counts = np.zeros(n_columns)
+        for a in range(first_segment, last_segment, self.chunk_segments):
+            b = min(a + self.chunk_segments, last_segment)
+            if data is not None:
+                samples = data[a * step:(b - 1) * step + nperseg]
+            else:
+                samples = recording.get_window([channel], a * step, (b - 1) * step + nperseg)[0]
+            density = welch.periodograms(samples, np.arange(b - a) * step)
+            columns = np.arange(a, b) // per_column - first_column
+            edges = np.flatnonzero(np.r_[True, np.diff(columns) > 0])
+            total[columns[edges]] += np.add.reduceat(density, edges, axis=0)
+            counts[columns[edges]] += np.diff(np.r_[edges, b - a])
+
+        image = (total / np.maximum(counts, 1)[:, None]).T.astype(np.float32)
+        return dict(image=image, start=first_segment * step, samples=n_columns * per_column * step)
+
+    def channel_data(self, recording, channel, filters):
+        """
+        the filtered channel, filtered once over the whole recording and kept for its next tiles
+        :return: 1d-array, None without filters, the tiles then read only their own samples
+        """
+        if not filters:
+            return None
+        key = (self.recording_key(recording), channel, filters)
+        with self._lock:
+            if key in self._channels:
+                self._channels.move_to_end(key)
+                return self._channels[key]
+
+        data = filter_channel(recording.get_window([channel])[0], filters, recording.freq)
+        with self._lock:
+            self._channels[key] = data
+            while len(self._channels) > self.channels_kept:
+                self._channels.popitem(last=False)
+        return data
+
+    def evict(self):
+        while self.nbytes > self.budget and len(self._tiles) > 1:
+            self.nbytes -= self._tiles.popitem(last=False)[1]['image'].nbytes
+
+    def info(self):
+        """
+        :return: dictionary with hits, misses, number of tiles and their bytes
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._tiles), nbytes=self.nbytes)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._channels.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+tile_cache = SpectrogramTileCache()
+
+
+def collect_tile_metrics():
+    if not metrics.enabled:
+        return
+    info = tile_cache.info()
+    metrics.set('eeg_spectrogram_tile_bytes', info['nbytes'])
+    metrics.set('eeg_spectrogram_tiles_total', info['hits'], result='hit')
+    metrics.set('eeg_spectrogram_tiles_total', info['misses'], result='miss')
+
+
+metrics.gauge('eeg_spectrogram_tile_bytes', 'Bytes of the spectrogram tiles held by the cache')
+metrics.counter('eeg_spectrogram_tiles_total', 'Spectrogram tiles served from the cache (hit) or computed (miss)')
+metrics.add_collector(collect_tile_metrics)
@@ -0,0 +1,193 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import fft, signal
+from .frequency_analysis import FrequencyAnalysis
+from .spectral import spectral
+
+
+class WelchSegmentCache():
+    """
+    periodograms of every channel of a recording on a fixed grid of Welch segments
+    segments start every nperseg // 2 samples (hann window, 50% overlap, constant detrend, density scaling,
+    as scipy.signal.welch), and are summed in blocks of block_size segments with prefix sums over the blocks,
+    the PSD of any interval is then a difference of two prefix sums, only the segments of the partial blocks
+    at the edges are computed again
+    freqs: frequencies of the PSD
+    """
+
+    def __init__(self, recording, nperseg=5120, block_size=16, maxsize=8, order=5, quality_factor=30):
+        """
+        initial method
+        :param recording: RawDF object
+        :param nperseg: length of each segment
+        :param block_size: number of segments summed in a block
+        :param maxsize: number of (channel, filters) stores kept
+        :param order: order of the butterworth filters
+        :param quality_factor: quality factor of the notch filters
+        """
+        self.recording = recording
+        self.order = order
+        self.quality_factor = quality_factor
+        self.fs = recording.freq
+        self.nperseg = nperseg
+        self.step = nperseg - nperseg // 2
+        self.block_size = block_size
+        self.maxsize = maxsize
+        self.window = signal.get_window('hann', nperseg)
+        self.scale = 1.0 / (self.fs * np.sum(self.window ** 2))
+        self.freqs = fft.rfftfreq(nperseg, 1 / self.fs)
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def memory_usage(self):
+        """
+        :return: number of bytes of the prefix sums and of the filtered channels
+        """
+        with self._lock:
+            stores = list(self._stores.values())
+        return int(sum(store['prefix'].nbytes + (store['data'].nbytes if store['data'] is not None else 0)
+                       for store in stores))
+
+    def periodograms(self, data, starts):
+        """
+        one-sided periodograms of the segments of a signal starting at the given samples
+        :param data: 1-channel signal
+        :param starts: first sample of every segment
+        :return: 2d-array, segments x frequencies
+        """
+        segments = np.lib.stride_tricks.sliding_window_view(data, self.nperseg)[np.asarray(starts, dtype=int)]
+        segments = segments.astype(np.float64, copy=False)
+        segments = (segments - segments.mean(axis=1, keepdims=True)) * self.window
+        density = np.abs(spectral.rfft(segments, axis=1)) ** 2 * self.scale
+        if self.nperseg % 2:
+            density[:, 1:] *= 2
+        else:
+            density[:, 1:-1] *= 2
+        return density
+
+    def channel_store(self, channel, filters=()):
+        """
+        block prefix sums of a channel, computed on the first call
+        :param channel: channel index
+        :param filters: tuple of (filter type, frequency), type 'high', 'low' or 'notch', applied in this order
+        :return: dictionary with the prefix sums, and the filtered channel if there are filters
+        """
+        key = (channel, filters)
+        with self._lock:
+            if key in self._stores:
+                self._stores.move_to_end(key)
+                return self._stores[key]
+
+        data = filter_channel(self.recording.get_window([channel])[0], filters, self.fs, self.order,
+                              self.quality_factor)
+
+        n_segments = max((data.size - self.nperseg) // self.step + 1, 0)
+        n_blocks = n_segments // self.block_size
+        prefix = np.zeros((n_blocks + 1, self.freqs.size))
+        for b in range(n_blocks):
+            starts = np.arange(b * self.block_size, (b + 1) * self.block_size) * self.step
+            prefix[b + 1] = prefix[b] + self.periodograms(data, starts).sum(axis=0)
+
+        store = dict(prefix=prefix, n_segments=n_segments, data=data if filters else None)
+        with self._lock:
+            self._stores[key] = store
+            while len(self._stores) > self.maxsize:
+                self._stores.popitem(last=False)
+        return store
+
+    def psd(self, channel, start=0, stop=None, filters=()):
+        """
+        Welch power spectral density of a channel in [start, stop)
+        equal to scipy.signal.welch on the interval when start is a multiple of nperseg // 2,
+        otherwise the grid segments inside the interval are used, plus one exact segment at the start
+        :param channel: channel index
+        :param start: first sample
+        :param stop: last sample (excluded), None for the end of the recording
+        :param filters: tuple of (filter type, frequency), see channel_store
+        :return: [freqs, psd]
+        """
+        n_times = self.recording.n_times
+        stop = n_times if stop is None else min(int(stop), n_times)
+        start = min(max(int(start), 0), stop)
+        with self._lock:
+            stored = (channel, filters) in self._stores
+        if filters and not stored and stop - start < n_times // 2:
+            # a short interval of a channel not filtered yet: only the interval and the padding of the filters
+            # are filtered, the whole channel is filtered once an interval covers half of the recording
+            def read(begin, end):
+                return self.recording.get_window([channel], begin, end)[0]
+            data = FrequencyAnalysis.filter_window(read, start, stop, n_times, self.fs, filters, order=self.order,
+                                                   quality_factor=self.quality_factor)
+            return signal.welch(data.astype(np.float64), self.fs, nperseg=min(self.nperseg, max(stop - start, 1)))
+
+        store = self.channel_store(channel, filters)
+
+        def read(begin, end):
+            if store['data'] is not None:
+                return store['data'][begin:end]
+            return self.recording.get_window([channel], begin, end)[0]
+
+        if stop - start < self.nperseg:
+            return signal.welch(read(start, stop).astype(np.float64), self.fs, nperseg=min(self.nperseg, max(stop - start, 1)))
+
+        first = -(-start // self.step)
+        last = min((stop - self.nperseg) // self.step + 1, store['n_segments'])
+        first_block = min(-(-first // self.block_size), last // self.block_size)
+        last_block = max(last // self.block_size, first_block)
+
+        # exact segments: the partial blocks at both ends, plus one segment at the start if it is off the grid,
+        # like scipy.signal.welch the samples after the last segment are not used
+        head = [k * self.step for k in range(first, max(first_block * self.block_size, first))]
+        tail = [k * self.step for k in range(max(last_block * self.block_size, first), last)]
+        if start % self.step:
+            head.insert(0, start)
+
+        total = store['prefix'][last_block] - store['prefix'][first_block]
+        count = (last_block - first_block) * self.block_size
+        for starts in (head, tail):
+            if starts:
+                data = read(starts[0], starts[-1] + self.nperseg)
+                total = total + self.periodograms(data, np.array(starts) - starts[0]).sum(axis=0)
+                count += len(starts)
+        return [self.freqs, total / count]
+
+
+def filter_channel(data, filters, fs, order=5, quality_factor=30):
+    """
+    :param data: 1-channel signal
+    :param filters: tuple of (filter type, frequency), type 'high', 'low' or 'notch', applied in this order
+    :param fs: sampling frequency
+    :param order: order of the butterworth filters
+    :param quality_factor: quality factor of the notch filters
+    :return: filtered signal, data itself without filters
+    """
+    for filter_type, freq in filters:
+        if filter_type == 'high':
+            data = FrequencyAnalysis.butter_highpass_filter(data, freq, fs, order)
+        elif filter_type == 'low':
+            data = FrequencyAnalysis.butter_lowpass_filter(data, freq, fs, order)
+        elif filter_type == 'notch':
+            data = FrequencyAnalysis.notch_filter(data, freq, fs, quality_factor)
+    return data
+
+
+_caches_lock = threading.Lock()
+
+
+def get_welch_cache(recording, nperseg=5120, order=5, quality_factor=30):
+    """
+    the Welch segment cache of a recording, created on the first call and shared afterwards
+    it is kept in recording.derived, the recording store counts it in the memory of the recording
+    :param recording: RawDF object
+    :param nperseg: length of each segment
+    :param order: order of the butterworth filters
+    :param quality_factor: quality factor of the notch filters
+    :return: WelchSegmentCache object
+    """
+    with _caches_lock:
+        key = ('welch', nperseg, order, quality_factor)
+        if key not in recording.derived:
+            recording.derived[key] = WelchSegmentCache(recording, nperseg, order=order,
+                                                       quality_factor=quality_factor)
+        return recording.derived[key]
@@ -0,0 +1,127 @@
+from flask import render_template, Blueprint
+import numpy as np
+import yaml
+from .source_utils import recording_store, tile_cache, metrics
+from .bp_utils import LatestWinsRunner, callback_executor, bokeh_app_url
+from bokeh.embed import server_document
+from bokeh.layouts import column, row
+from bokeh.models import ColumnDataSource, Slider, Select, TextInput, Div, LinearColorMapper, ColorBar, Range1d
+from bokeh.palettes import Viridis256
+from bokeh.plotting import figure
+
+
+def spectrogram_bkapp(doc):
+    with open("./config.yaml", 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        config_file.close()
+
+    metrics.inc('eeg_active_sessions', app='spectrogram')
+    recording_store.set_budget(config['STORE_BUDGET'])
+    tile_cache.set_budget(config['SPECTROGRAM_BUDGET'])
+    raw_edf = recording_store.get_raw(config['FILENAME'], owner=id(doc), lazy=config['LAZY'],
+                                      dtype=config['PRECISION'])
+    fs = raw_edf.freq
+    ch_num = raw_edf.nchan
+    duration = raw_edf.n_times / fs
+    width = 900
+
+    color_mapper = LinearColorMapper(palette=Viridis256)
+    source = ColumnDataSource(data=dict(image=[], x=[], y=[], dw=[], dh=[]))
+    p = figure(height=500, width=width, title='Spectrogram (log10 power density)',
+               x_range=Range1d(0, duration, bounds=(0, duration)),
+               y_range=Range1d(0, min(fs / 2, 100), bounds=(0, fs / 2)),
+               x_axis_label='time (s)', y_axis_label='frequency (Hz)')
+    p.image(image='image', x='x', y='y', dw='dw', dh='dh', source=source, color_mapper=color_mapper)
+    p.add_layout(ColorBar(color_mapper=color_mapper), 'right')
+
+    channel_slider = Slider(value=0, start=0, end=ch_num - 1, step=1, width=width, title='Channel')
+    current_channel_name = TextInput(title='Current Channel:', value=raw_edf.ch_names[0])
+    nperseg_select = Select(title='Segment Length:', value=str(config['SPECTROGRAM_NPERSEG']),
+                            options=[str(2 ** i) for i in range(6, 14)])
+    highpass_input = TextInput(title='Highpass Filter:', value='None')
+    lowpass_input = TextInput(title='Lowpass Filter:', value='None')
+    notch_input = TextInput(title='Notch Filter:', value='None')
+    busy_div = Div(text='<i>Updating...</i>', visible=False)
+    runner = LatestWinsRunner(doc, busy=busy_div, name='spectrogram:update_data')
+    # tiles currently shown, panning inside them sends nothing
+    view = dict(key=None)
+
+    def update_data(attribute, old, new):
+        channel_update = channel_slider.value
+        nperseg_update = int(nperseg_select.value)
+        start = int(max(p.x_range.start, 0) * fs)
+        stop = int(min(p.x_range.end, duration) * fs)
+
+        current_channel_name.value = raw_edf.ch_names[channel_update]
+        filters = []
+        for filter_type, filter_update in [('high', highpass_input.value), ('low', lowpass_input.value),
+                                           ('notch', notch_input.value)]:
+            if filter_update.lower() != 'none':
+                try:
+                    filters.append((filter_type, float(filter_update)))
+                except ValueError:
+                    print("Could not convert this input to float!")
+        filters = tuple(filters)
+
+        # start and end of a pan arrive one at a time, the range can be empty in between
+        if nperseg_update > raw_edf.n_times or stop <= start:
+            return
+        level, indices = tile_cache.view(raw_edf, nperseg_update, start, stop, width)
+        key = (channel_update, nperseg_update, filters, level, tuple(indices))
+        if key == view['key']:
+            return
+
+        def compute():
+            tiles = [tile_cache.get_tile(raw_edf, channel_update, nperseg_update, level, i, filters) for i in indices]
+            images = []
+            for tile in tiles:
+                with np.errstate(divide='ignore'):
+                    images.append(np.log10(tile['image']))
+            finite = np.concatenate([image[np.isfinite(image)] for image in images])
+            low, high = np.percentile(finite, [1, 99]) if finite.size else (0, 1)
+            return [dict(image=images,
+                         x=[tile['start'] / fs for tile in tiles],
+                         y=[0] * len(tiles),
+                         dw=[tile['samples'] / fs for tile in tiles],
+                         dh=[fs / 2] * len(tiles)), low, high]
+
+        def apply(result):
+            data_update, low, high = result
+            metrics.observe_payload('eeg_payload_bytes', data_update, app='spectrogram')
+            view['key'] = key
+            source.data = data_update
+            color_mapper.update(low=low, high=high)
+            # the neighbouring tiles are computed in the background, so scrolling and zooming find them ready
+            callback_executor.submit(tile_cache.prefetch, raw_edf, channel_update, nperseg_update,
+                                     tile_cache.neighbours(raw_edf, nperseg_update, level, indices), filters)
+
+        runner.submit(compute, apply)
+
+    for w in [highpass_input, lowpass_input, notch_input, nperseg_select]:
+        w.on_change('value', update_data)
+    channel_slider.on_change('value_throttled', update_data)
+    p.x_range.on_change('start', update_data)
+    p.x_range.on_change('end', update_data)
+    update_data(None, None, None)
+
+    inputs = column(channel_slider, current_channel_name,
+                    row(nperseg_select, highpass_input, lowpass_input, notch_input), busy_div)
+
+    doc.add_root(column(inputs, p))
+
+    def release_recordings(session_context):
+        metrics.inc('eeg_active_sessions', -1, app='spectrogram')
+        recording_store.release(id(doc))
+
+    doc.on_session_destroyed(release_recordings)
+
+
+bp = Blueprint("spectrogram checker", __name__, url_prefix="/spectrogram")
+
+@bp.route("/", methods=["GET"])
+def bkapp_page():
+    with open("./config.yaml", 'r') as config_file:
+        config = yaml.safe_load(config_file)
+        config_file.close()
+    script = server_document(bokeh_app_url('spectrogram_bkapp', config))
+    return render_template("spectrogram.html", script=script, template="Flask", port=config['PORT'])
@@ -5,48 +5,75 @@ import yaml
 import numpy as np
 from scipy import signal
 from .source_utils import FrequencyAnalysis as fa
-from .source_utils import RawDF, SpectrumDF, FrequencyAnalysis
+from .source_utils import RawDF, FrequencyAnalysis, recording_store, get_welch_cache, metrics
+from .bp_utils import LatestWinsRunner, RecordingLoader, bokeh_app_url
 from bokeh.embed import server_document
 from bokeh.layouts import column, row
-from bokeh.models import ColumnDataSource, Slider, HoverTool, TextInput
+from bokeh.models import ColumnDataSource, Slider, HoverTool, TextInput, Div
 from bokeh.plotting import figure
 
 
+def spectrum_filters(highpass, lowpass, notch):
+    """
+    filter chain of the spectra, the same for the first curve (configuration) and the inputs of the page,
+    so equal settings give the same curve and share the stores of the segment cache
+    :param highpass: high pass cutoff, None or 'None' for no filter
+    :param lowpass: low pass cutoff, None or 'None' for no filter
+    :param notch: notch frequency, None or 'None' for no filter
+    :return: tuple of (filter type, frequency), applied in this order: high, low, notch
+    """
+    filters = []
+    for filter_type, cutoff in [('high', highpass), ('low', lowpass), ('notch', notch)]:
+        if cutoff is None or str(cutoff).lower() == 'none':
+            continue
+        try:
+            filters.append((filter_type, float(cutoff)))
+        except ValueError:
+            print("Could not convert this input to float!")
+    return tuple(filters)
+
+
+def filter_input_value(cutoff):
+    return 'None' if cutoff is None else str(cutoff)
+
+
 def spectrum_bkapp(doc):
     with open("./config.yaml", 'r') as config_file:
         config = yaml.safe_load(config_file)
         config_file.close()
 
     log_policy = config['LOG']
-    lowpass_freq = config['LOWPASS']
-    highpass_freq = config['HIGHPASS']
-    notch_freq = config['NOTCH']
     nperseg = config['NPERSEG']
-    quality_factor = config['QUALITY']
     order = config['ORDER']
+    quality_factor = config['QUALITY']
 
-    raw_edf = SpectrumDF(filename=config['FILENAME'],
-                         lowpass_freq=lowpass_freq,
-                         highpass_freq=highpass_freq,
-                         notch_freq=notch_freq,
-                         nperseg=nperseg,
-                         quality_factor=quality_factor,
-                         order=order,
-                         log=log_policy,)
+    metrics.inc('eeg_active_sessions', app='spectrum')
+    recording_store.set_budget(config['STORE_BUDGET'])
+    raw_edf = recording_store.get_raw(config['FILENAME'], owner=id(doc), lazy=config['LAZY'],
+                                      dtype=config['PRECISION'])
 
-    fs = raw_edf.raw.info['sfreq']
+    fs = raw_edf.freq
     ch_num = raw_edf.nchan
 
-    fseq = raw_edf.fseq
-    den = raw_edf.den
-    den_array = den.to_numpy().T
+    # first curve: the first channel through the segment cache, with the filters of the configuration,
+    # which are also the first values of the filter inputs, the other channels and intervals are computed
+    # when they are asked for
+    def spectrum_curve(recording, channel, start, stop, filters):
+        fseq, den = get_welch_cache(recording, nperseg, order, quality_factor).psd(channel, start, stop, filters)
+        if log_policy:
+            with np.errstate(divide='ignore'):
+                den = np.log10(den)
+        return [fseq, den]
+
+    init_filters = spectrum_filters(config['HIGHPASS'], config['LOWPASS'], config['NOTCH'])
+    fseq, den_init = spectrum_curve(raw_edf, 0, 0, None, init_filters)
 
     source = ColumnDataSource(
         data=dict(
             x_base=fseq,
-            y_base=den_array[0],
+            y_base=den_init,
             x_noba=fseq,
-            y_noba=den_array[0]
+            y_noba=den_init
         )
     )
     hover = HoverTool(
@@ -60,15 +87,20 @@ def spectrum_bkapp(doc):
     p.line('x_noba', 'y_noba', source=source, line_width=3, line_color='orange', legend_label='compare')
     p.legend.click_policy = 'hide'
 
-    highpass_input = TextInput(title='Highpass Filter:', value='None')
-    lowpass_input = TextInput(title='Lowpass Filter:', value='None')
-    notch_input = TextInput(title='Notch Filter:', value='None')
+    highpass_input = TextInput(title='Highpass Filter:', value=filter_input_value(config['HIGHPASS']))
+    lowpass_input = TextInput(title='Lowpass Filter:', value=filter_input_value(config['LOWPASS']))
+    notch_input = TextInput(title='Notch Filter:', value=filter_input_value(config['NOTCH']))
     interval_input = TextInput(title='Time Interval:', value='All')
     file_input = TextInput(title='Compare File:', value='None')
     channel_slider = Slider(value=0, start=0, end=ch_num, step=1, width=900, title='Channel')
     current_channel_name = TextInput(title='Current Channel:', value=raw_edf.ch_names[0])
-
-    file_bank = dict()
+    compare_div = Div(text='', visible=False)
+    busy_div = Div(text='<i>Updating...</i>', visible=False)
+    runner = LatestWinsRunner(doc, busy=busy_div, name='spectrum:update_data')
+    # the compare file is opened in the background, the plot is redrawn with it once it is open
+    compare_loader = RecordingLoader(doc, status=compare_div, on_ready=lambda: update_data(None, None, None),
+                                     write_cache=config['CACHE_COMPARE'], lazy=config['LAZY'],
+                                     dtype=config['PRECISION'])
 
     def update_data(attribute, old, new):
         file_update = file_input.value
@@ -78,93 +110,63 @@ def spectrum_bkapp(doc):
         interval_update = interval_input.value
         channel_update = channel_slider.value
 
+        current_channel_name.value = raw_edf.ch_names[channel_update]
         if file_update.lower() == "none":
-            raw_base = raw_edf.raw
-            data_base = raw_base.get_data()
-            raw_noba = raw_edf.raw
-            data_noba = raw_noba.get_data()
-
+            compare_loader.reset()
+            raw_compare = raw_edf
         else:
-            if file_update in file_bank.keys():
-                raw_base = raw_edf.raw
-                data_base = raw_base.get_data()
-                raw_noba, data_noba = file_bank[file_update]
-            else:
-                raw_noba_update = RawDF(filename=file_update)
-                raw_base = raw_edf.raw
-                data_base = raw_base.get_data()
-                raw_noba = raw_noba_update.raw
-                data_noba = raw_noba.get_data()
-                file_bank[file_update] = [raw_noba, data_noba]
-
-        current_channel_name.value = raw_edf.ch_names[channel_update]
+            raw_compare = compare_loader.get(file_update)
         if interval_update.lower() == 'all':
-            y_base_filted = data_base[channel_update]
-            y_noba_filted = data_noba[channel_update]
+            interval_start, interval_stop = 0, None
         else:
             interval_update = interval_update.split(',')
-            interval_update[0] = int(interval_update[0])
-            interval_update[1] = int(interval_update[1])
-            y_base_filted = data_base[channel_update, interval_update[0]:interval_update[1]+1]
-            y_noba_filted = data_noba[channel_update, interval_update[0]:interval_update[1]+1]
-
-        if highpass_update.lower() != 'none':
-            try:
-                cutoff = float(highpass_update)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_base_filted = fa.butter_highpass_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.butter_highpass_filter(y_noba_filted, cutoff, raw_edf.freq)
-
-        else:
-            pass
-
-        if lowpass_update.lower() != 'none':
-            try:
-                cutoff = float(lowpass_update)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_base_filted = fa.butter_lowpass_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.butter_lowpass_filter(y_noba_filted, cutoff, raw_edf.freq)
-        else:
-            pass
-
-        if notch_update.lower() != 'none':
-            try:
-                cutoff = float(notch_update)
-            except ValueError:
-                print("Could not convert this input to float!")
-
-            y_base_filted = fa.notch_filter(y_base_filted, cutoff, raw_edf.freq)
-            y_noba_filted = fa.notch_filter(y_noba_filted, cutoff, raw_edf.freq)
-        else:
-            pass
+            interval_start = int(interval_update[0])
+            interval_stop = int(interval_update[1]) + 1
+
+        # filters are applied once on the whole channel by the segment cache
+        filters = spectrum_filters(highpass_update, lowpass_update, notch_update)
+
+        def compute():
+            raw_base = raw_edf
+            # None while the compare file is loading, its spectrum stays empty
+            raw_noba = raw_compare
+
+            f_base, den_base = spectrum_curve(raw_base, channel_update, interval_start, interval_stop, filters)
+            if raw_noba is None:
+                f_noba, den_noba = f_base, np.full_like(den_base, np.nan)
+            elif raw_noba is raw_base:
+                f_noba, den_noba = f_base, den_base
+            else:
+                f_noba, den_noba = spectrum_curve(raw_noba, channel_update, interval_start, interval_stop, filters)
 
-        f_base, den_base = signal.welch(y_base_filted, fs, nperseg=nperseg)
-        f_noba, den_noba = signal.welch(y_noba_filted, fs, nperseg=nperseg)
+            return dict(
+                x_base=f_base,
+                y_base=den_base,
+                x_noba=f_noba,
+                y_noba=den_noba
+            )
 
-        np.seterr(divide='ignore')
-        den_base = np.log10(den_base)
-        den_noba = np.log10(den_noba)
-        np.seterr(divide='warn')
+        def apply(data_update):
+            metrics.observe_payload('eeg_payload_bytes', data_update, app='spectrum')
+            source.data = data_update
 
-        source.data = dict(
-            x_base=f_base,
-            y_base=den_base,
-            x_noba=f_noba,
-            y_noba=den_noba
-        )
+        runner.submit(compute, apply)
 
     for w in [file_input, interval_input, highpass_input, lowpass_input, notch_input]:
         w.on_change('value', update_data)
     channel_slider.on_change('value_throttled', update_data)
 
-    inputs = column(file_input, channel_slider, current_channel_name, row(interval_input, highpass_input, lowpass_input, notch_input, ))
+    inputs = column(file_input, compare_div, channel_slider, current_channel_name, row(interval_input, highpass_input, lowpass_input, notch_input, ), busy_div)
 
     doc.add_root(column(inputs, p))
 
+    def release_recordings(session_context):
+        metrics.inc('eeg_active_sessions', -1, app='spectrum')
+        compare_loader.close()
+        recording_store.release(id(doc))
+
+    doc.on_session_destroyed(release_recordings)
+
 
 bp = Blueprint("spectrum checker", __name__, url_prefix="/spectrum")
 
@@ -173,7 +175,7 @@ def bkapp_page():
     with open("./config.yaml", 'r') as config_file:
         config = yaml.safe_load(config_file)
         config_file.close()
-    script = server_document("http://localhost:5006/spectrum_bkapp")
+    script = server_document(bokeh_app_url('spectrum_bkapp', config))
     return render_template("spectrum.html", script=script, template="Flask", port=config['PORT'])
 
 
@@ -0,0 +1,29 @@
+from blueprints.source_utils import RawDF, EdfCache
+import argparse
+import time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert EDF recordings to the memory-mapped cache read by the apps')
+    parser.add_argument('files', nargs='+', type=str,
+                        help='EDF files to convert')
+    parser.add_argument('-d', '--dtype', default='float32', choices=['float32', 'float64'],
+                        help='Sample type stored in the cache')
+    parser.add_argument('-c', '--chunk-size', default=2 ** 16, type=int,
+                        help='Number of samples converted at once')
+    parser.add_argument('--cache-dir', default=None, type=str,
+                        help='Directory of the caches, CACHE_DIR of the apps, next to the files by default')
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild caches that are already up to date')
+
+    args = parser.parse_args()
+    EdfCache.set_cache_dir(args.cache_dir)
+
+    for filename in args.files:
+        if EdfCache.is_fresh(filename) and not args.force:
+            print(filename + ': up to date')
+            continue
+        start_time = time.time()
+        recording = RawDF(filename=filename, lazy=True, use_cache=False)
+        path = EdfCache.write(recording, dtype=args.dtype, chunk_size=args.chunk_size)
+        print(filename + ': ' + path + ' (%.1fs)' % (time.time() - start_time))
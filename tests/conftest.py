@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic_edf import make_synthetic_edf
+
+
+@pytest.fixture(scope='session')
+def synthetic_edf(tmp_path_factory):
+    """
+    a short synthetic SEEG recording: 8 channels, 60 s at 500 Hz
+    """
+    return make_synthetic_edf(str(tmp_path_factory.mktemp('recordings') / 'synthetic.edf'), n_channels=8,
+                              duration=60, sfreq=500, per_region=4)
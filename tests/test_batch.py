@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import yaml
+from batch import prepare_parts
+from conftest import ROOT
+
+PARAMS = dict(NOTCH=60, NPERSEG=1024, WIN1=[5, 10], WIN2=[35, 120], source='a.edf', source_mtime=1.5,
+              format='csv', channels_per_task=8)
+
+
+def write_block(parts_path):
+    with open(os.path.join(parts_path, '00000.psd.csv'), 'w') as block:
+        block.write('frequency\n0\n')
+
+
+def test_parts_kept_with_same_params(tmp_path):
+    parts_path = prepare_parts(str(tmp_path), PARAMS)
+    write_block(parts_path)
+    assert prepare_parts(str(tmp_path), dict(PARAMS)) == parts_path
+    assert os.path.exists(os.path.join(parts_path, '00000.psd.csv'))
+
+
+def test_parts_wiped_when_params_change(tmp_path):
+    parts_path = prepare_parts(str(tmp_path), PARAMS)
+    for change in [dict(NOTCH=50), dict(NPERSEG=2048), dict(WIN2=[30, 90]), dict(channels_per_task=4)]:
+        write_block(parts_path)
+        prepare_parts(str(tmp_path), dict(PARAMS, **change))
+        assert os.listdir(parts_path) == ['params.json']
+        prepare_parts(str(tmp_path), PARAMS)
+
+
+def test_parts_wiped_without_params(tmp_path):
+    # blocks left by a run that did not record its parameters
+    parts_path = os.path.join(str(tmp_path), 'parts')
+    os.makedirs(parts_path)
+    write_block(parts_path)
+    prepare_parts(str(tmp_path), PARAMS)
+    assert os.listdir(parts_path) == ['params.json']
+    with open(os.path.join(parts_path, 'params.json'), 'r') as marker:
+        assert json.load(marker) == PARAMS
+
+
+def test_unreadable_file_does_not_stop_the_batch(synthetic_edf, tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    shutil.copy(synthetic_edf, str(inputs / 'good.edf'))
+    with open(str(inputs / 'broken.edf'), 'wb') as edf_file:
+        edf_file.write(b'not an edf file')
+    config = dict(NOTCH=None, QUALITY=30, HIGHPASS=None, LOWPASS=None, ORDER=3, NPERSEG=1024, LOG=True,
+                  WIN1=[5, 10], WIN2=[35, 120], PRECISION='float32', CACHE_DIR=None)
+    with open(str(tmp_path / 'config.yaml'), 'w') as config_file:
+        yaml.dump(config, config_file)
+
+    output = tmp_path / 'output'
+    run = subprocess.run([sys.executable, os.path.join(ROOT, 'batch.py'), str(inputs), '-o', str(output),
+                          '--config', str(tmp_path / 'config.yaml'), '-j', '1'], cwd=ROOT, capture_output=True,
+                         text=True, timeout=300)
+    assert run.returncode == 1
+    assert os.path.exists(str(output / 'good' / '_SUCCESS'))
+    assert not os.path.exists(str(output / 'broken' / '_SUCCESS'))
+    with open(str(output / 'broken' / '_FAILED'), 'r') as marker:
+        failure = json.load(marker)
+    assert failure['source'] == str(inputs / 'broken.edf') and failure['error']
+    assert 'broken.edf' in run.stderr
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from blueprints.source_utils import CrossFrequencyCoupling, cross_frequency_coupling
+
+FS = 500
+PHASE_BANDS = [[4, 8], [8, 12]]
+AMP_BANDS = [[30, 50], [50, 80], [80, 120]]
+
+
+def coupled_signal(seed, phase_freq):
+    rng = np.random.default_rng(seed)
+    t = np.arange(20 * FS) / FS
+    phase = np.sin(2 * np.pi * phase_freq * t)
+    return phase + (1 + phase) * 0.3 * np.sin(2 * np.pi * 60 * t) + 0.5 * rng.standard_normal(t.size)
+
+
+def test_concurrent_comodulograms_in_process():
+    signals = [coupled_signal(seed, phase_freq) for seed, phase_freq in enumerate([6, 10, 6, 10])]
+
+    def run(data):
+        return CrossFrequencyCoupling.comodulogram(data, FS, PHASE_BANDS, AMP_BANDS, workers=1)
+
+    expected = [run(data) for data in signals]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(3):
+            for result, reference in zip(executor.map(run, signals), expected):
+                np.testing.assert_array_equal(result, reference)
+    # the coupled bands stand out, the signals are told apart
+    assert expected[0][1, 0] > expected[0][1, 1]
+    assert expected[1][1, 1] > expected[1][1, 0]
+
+
+def test_pool_matches_in_process_and_is_reused():
+    data = coupled_signal(0, 6)
+    expected = CrossFrequencyCoupling.comodulogram(data, FS, PHASE_BANDS, AMP_BANDS, workers=1)
+    for _ in range(2):
+        result = CrossFrequencyCoupling.comodulogram(data, FS, PHASE_BANDS, AMP_BANDS, workers=2, min_pool_size=0)
+        np.testing.assert_array_equal(result, expected)
+    assert list(cross_frequency_coupling._pools) == [2]
+    cross_frequency_coupling.shutdown_comodulogram_pools()
+    assert not cross_frequency_coupling._pools
+
+
+def test_small_grids_stay_in_process():
+    data = coupled_signal(1, 10)
+    CrossFrequencyCoupling.comodulogram(data, FS, PHASE_BANDS, AMP_BANDS, workers=2)
+    assert not cross_frequency_coupling._pools
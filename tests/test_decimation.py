@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+from blueprints.source_utils import RawDF, FrequencyAnalysis
+from blueprints.bp_utils import get_pyramid, envelope_window
+
+
+def test_envelope_of_raw_samples_matches_pyramid(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    channels = [0, 3, 5]
+    start, stop, n_points = 1000, recording.n_times - 1000, 1800
+    x, y = envelope_window(lambda begin, end: recording.get_window(channels, begin, end), start, stop, n_points,
+                           recording.freq, chunk_size=4096)
+    x_pyramid, y_pyramid = get_pyramid(recording).window(channels, start, stop, n_points)
+    np.testing.assert_array_equal(x, x_pyramid)
+    np.testing.assert_array_equal(y, y_pyramid)
+
+
+def test_envelope_of_filtered_window(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    channels = [1, 2]
+    filters = (('high', 1.0), ('notch', 50.0))
+    start, stop = 2000, recording.n_times - 2000
+
+    def read(begin, end):
+        return FrequencyAnalysis.filter_window(lambda b, e: recording.get_window(channels, b, e), begin, end,
+                                               recording.n_times, recording.freq, filters)
+
+    x, y = envelope_window(read, start, stop, 1000, recording.freq, chunk_size=4096)
+    filtered = read(start, stop)
+    bucket_size = int(np.ceil((stop - start) / 500))
+    edges = np.arange(0, stop - start, bucket_size)
+    np.testing.assert_allclose(y[:, 0::2], np.minimum.reduceat(filtered, edges, axis=1), rtol=0,
+                               atol=1e-4 * np.abs(filtered).max())
+    np.testing.assert_allclose(y[:, 1::2], np.maximum.reduceat(filtered, edges, axis=1), rtol=0,
+                               atol=1e-4 * np.abs(filtered).max())
+    assert len(x) == y.shape[1]
+
+
+def brute_force_envelope(data, edges):
+    """
+    min/max of data[:, edges[i]:edges[i + 1]] for every bucket
+    """
+    y = np.empty((data.shape[0], 2 * (len(edges) - 1)), dtype=data.dtype)
+    for i, (begin, end) in enumerate(zip(edges[:-1], edges[1:])):
+        y[:, 2 * i] = data[:, begin:end].min(axis=1)
+        y[:, 2 * i + 1] = data[:, begin:end].max(axis=1)
+    return y
+
+
+@pytest.mark.parametrize('n_points', [400, 100, 24, 8])
+def test_pyramid_levels_match_brute_force(synthetic_edf, n_points):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False, dtype='float32')
+    pyramid = get_pyramid(recording)
+    channels = [0, 2, 7]
+    start, stop = 1000, recording.n_times - 500
+    bucket_size = int(np.ceil((stop - start) / (n_points // 2)))
+    assert bucket_size >= pyramid.block_size
+
+    x, y = pyramid.window(channels, start, stop, n_points)
+    # buckets start on the blocks of the level the pyramid reads, the last one ends with its last block
+    level = min(int(np.log(bucket_size / pyramid.block_size) / np.log(pyramid.factor)), len(pyramid.levels) - 1)
+    level_block = pyramid.block_size * pyramid.factor ** level
+    starts = np.rint(x[0::2] * recording.freq).astype(int)
+    edges = np.append(starts, min(int(np.ceil(stop / level_block)) * level_block, recording.n_times))
+    assert starts[0] <= start and edges[-1] >= stop
+    np.testing.assert_array_equal(y, brute_force_envelope(recording.get_window(channels), edges))
+
+
+def test_envelope_window_large_buckets_match_brute_force(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    channels = [1, 4]
+    start, stop, n_points = 700, recording.n_times - 300, 60
+    x, y = envelope_window(lambda begin, end: recording.get_window(channels, begin, end), start, stop, n_points,
+                           recording.freq, chunk_size=4096)
+    bucket_size = int(np.ceil((stop - start) / (n_points // 2)))
+    assert bucket_size >= 64
+    edges = np.append(np.arange(start, stop, bucket_size), stop)
+    np.testing.assert_array_equal(x[0::2], edges[:-1] / recording.freq)
+    np.testing.assert_array_equal(y, brute_force_envelope(recording.get_window(channels, 0, stop), edges))
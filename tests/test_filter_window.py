@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from blueprints.source_utils import RawDF, FrequencyAnalysis as fa
+
+# padded_window leaves out a fraction tol=1e-6 of the impulse responses, the window may differ from the whole
+# filtered signal by about that fraction of the signal amplitude, checked with a margin of 10
+WINDOW_ATOL = 1e-5
+
+FILTERS = [(('high', 1.0),), (('low', 40.0),), (('notch', 50.0),), (('high', 0.5), ('low', 100.0), ('notch', 60.0))]
+
+
+def filter_whole(data, filters, fs):
+    for filter_type, cutoff in filters:
+        if filter_type == 'high':
+            data = fa.butter_highpass_filter(data, cutoff, fs)
+        elif filter_type == 'low':
+            data = fa.butter_lowpass_filter(data, cutoff, fs)
+        else:
+            data = fa.notch_filter(data, cutoff, fs)
+    return data
+
+
+@pytest.fixture(scope='module')
+def recording(synthetic_edf):
+    return RawDF(filename=synthetic_edf, lazy=True, use_cache=False, dtype='float64')
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+@pytest.mark.parametrize('start, stop', [(12000, 15000), (0, 2000), (27500, 30000), (9000, 9001)])
+def test_window_matches_whole_signal(recording, filters, start, stop):
+    channels = [0, 5]
+    whole = filter_whole(recording.get_window(channels), filters, recording.freq)
+    window = fa.filter_window(lambda begin, end: recording.get_window(channels, begin, end), start, stop,
+                              recording.n_times, recording.freq, filters)
+    assert window.shape == (len(channels), stop - start)
+    np.testing.assert_allclose(window, whole[:, start:stop], rtol=0,
+                               atol=WINDOW_ATOL * np.abs(recording.get_window(channels)).max())
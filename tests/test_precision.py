@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from blueprints.source_utils import RawDF, FrequencyAnalysis as fa, get_welch_cache
+from blueprints.bp_utils import stack_y_axis_signals
+
+# float32 keeps about 7 significant digits, filtering and Welch run in float64 on the float32 samples
+FILTER_RTOL = 1e-5
+PSD_RTOL = 1e-4
+
+
+@pytest.fixture(scope='module')
+def recordings(synthetic_edf):
+    """
+    the same recording read as float32 and as float64
+    """
+    return [RawDF(filename=synthetic_edf, lazy=True, use_cache=False, dtype=dtype) for dtype in ['float32', 'float64']]
+
+
+def assert_close(single, double, rtol):
+    """
+    float32 result within rtol of the float64 one, relative to the largest float64 value
+    """
+    single = np.asarray(single)
+    double = np.asarray(double)
+    assert single.shape == double.shape
+    scale = np.max(np.abs(double))
+    assert np.max(np.abs(single.astype(np.float64) - double)) <= rtol * scale
+
+
+def test_samples(recordings):
+    single, double = [recording.get_window(None, 0, 5000) for recording in recordings]
+    assert single.dtype == np.float32
+    assert double.dtype == np.float64
+    assert_close(single, double, 1e-6)
+
+
+@pytest.mark.parametrize('name, apply', [
+    ('butter_lowpass_filter', lambda data, fs: fa.butter_lowpass_filter(data, 40, fs, 5)),
+    ('butter_highpass_filter', lambda data, fs: fa.butter_highpass_filter(data, 1, fs, 5)),
+    ('butter_bandpass_filter', lambda data, fs: fa.butter_bandpass_filter(data, 4, 8, fs, 5)),
+    ('notch_filter', lambda data, fs: fa.notch_filter(data, 60, fs, 30)),
+    ('fir_bandpass_filter', lambda data, fs: fa.fir_bandpass_filter(data, [8, 16], fs)),
+])
+def test_filters(recordings, name, apply):
+    fs = recordings[0].freq
+    single, double = [apply(recording.get_window(None, 0, 10000), fs) for recording in recordings]
+    assert single.dtype == np.float32, name
+    assert double.dtype == np.float64, name
+    assert_close(single, double, FILTER_RTOL)
+
+
+@pytest.mark.parametrize('filters', [(('notch', 60),), (('high', 1), ('low', 40)), (('fir', [8, 16]),)])
+def test_filter_window(recordings, filters):
+    fs = recordings[0].freq
+    start, stop = 10000, 12500
+    single, double = [fa.filter_window(lambda begin, end, r=recording: r.get_window([0, 1], begin, end), start, stop,
+                                       recording.n_times, fs, filters) for recording in recordings]
+    assert single.dtype == np.float32
+    assert_close(single, double, FILTER_RTOL)
+
+
+def test_data_filted_to_den(recordings):
+    fs = recordings[0].freq
+    for data in [[recording.get_window(None) for recording in recordings],
+                 [recording.data for recording in recordings]]:
+        (f_single, den_single), (f_double, den_double) = [fa.data_filted_to_den(d, 513, fs, nperseg=1024, log=False)
+                                                          for d in data]
+        np.testing.assert_array_equal(f_single, f_double)
+        assert_close(den_single, den_double, PSD_RTOL)
+
+
+@pytest.mark.parametrize('filters', [(), (('notch', 60),)])
+def test_welch_segment_cache(recordings, filters):
+    (f_single, psd_single), (f_double, psd_double) = [get_welch_cache(recording, 1024).psd(2, 0, None, filters)
+                                                      for recording in recordings]
+    np.testing.assert_array_equal(f_single, f_double)
+    assert_close(psd_single, psd_double, PSD_RTOL)
+    # the relative error holds in every bin, not only at the peak of the spectrum
+    np.testing.assert_allclose(psd_single, psd_double, rtol=PSD_RTOL, atol=0)
+
+
+def test_stacked_payload(recordings):
+    offset = 2e-4
+    single, double = [np.array(stack_y_axis_signals(recording.get_window(None, 0, 3000), recording.nchan, offset))
+                      for recording in recordings]
+    assert single.dtype == np.float32
+    assert double.dtype == np.float64
+    # the offsets dominate the values of the lanes, float32 keeps the samples within its resolution at that scale
+    assert_close(single, double, 1e-6)
@@ -0,0 +1,91 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from bokeh.document import Document
+from bokeh.models import Div
+from blueprints.bp_utils import RecordingLoader
+from blueprints.source_utils import recording_store, RawDF, EdfCache
+
+
+# mne warns about the header of the broken file
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_failed_file_is_tried_again(synthetic_edf, tmp_path):
+    filename = str(tmp_path / 'compare.edf')
+    with open(filename, 'wb') as edf_file:
+        edf_file.write(b'not an edf file')
+    doc = Document()
+    status = Div()
+    loader = RecordingLoader(doc, status=status, lazy=True, use_cache=False)
+    try:
+        assert loader.get(filename) is None
+        assert status.text.startswith('Could not open')
+
+        shutil.copy(synthetic_edf, filename)
+        recording = loader.get(filename)
+        assert recording is not None and recording.nchan == 8
+        assert status.text.startswith('Compare file: compare.edf')
+        assert loader.get(filename) is recording
+    finally:
+        loader.close()
+        recording_store.release(id(doc))
+
+
+def open_compare(filename, **kwargs):
+    doc = Document()
+    loader = RecordingLoader(doc, status=Div(), lazy=True, **kwargs)
+    try:
+        return loader.get(filename)
+    finally:
+        loader.close()
+        recording_store.release(id(doc))
+
+
+def test_lazy_open_writes_no_cache_by_default(synthetic_edf, tmp_path):
+    filename = str(tmp_path / 'lazy.edf')
+    shutil.copy(synthetic_edf, filename)
+    recording = open_compare(filename)
+    assert recording is not None and recording.cache is None
+    assert os.listdir(str(tmp_path)) == ['lazy.edf']
+
+
+def test_cache_written_in_the_cache_dir(synthetic_edf, tmp_path):
+    filename = str(tmp_path / 'files' / 'lazy.edf')
+    os.makedirs(os.path.dirname(filename))
+    shutil.copy(synthetic_edf, filename)
+    EdfCache.set_cache_dir(str(tmp_path / 'caches'))
+    try:
+        recording = open_compare(filename, write_cache=True)
+        assert recording.cache is not None
+        assert os.path.dirname(recording.cache.path) == str(tmp_path / 'caches')
+        assert os.listdir(os.path.dirname(filename)) == ['lazy.edf']
+        np.testing.assert_array_equal(recording.get_window([0], 0, 1000),
+                                      RawDF(filename=filename, lazy=True, use_cache=False,
+                                            dtype='float32').get_window([0], 0, 1000))
+    finally:
+        EdfCache.set_cache_dir(None)
+
+
+def test_cache_write_failure_still_opens_the_file(synthetic_edf, tmp_path):
+    filename = str(tmp_path / 'lazy.edf')
+    shutil.copy(synthetic_edf, filename)
+    # the cache directory cannot be created, as on read-only media
+    blocked = str(tmp_path / 'blocked')
+    open(blocked, 'w').close()
+    EdfCache.set_cache_dir(os.path.join(blocked, 'caches'))
+    try:
+        recording = open_compare(filename, write_cache=True, dtype='float32')
+        assert recording is not None and recording.cache is None
+        assert sorted(os.listdir(str(tmp_path))) == ['blocked', 'lazy.edf']
+    finally:
+        EdfCache.set_cache_dir(None)
+
+
+def test_cache_write_reports_progress(synthetic_edf, tmp_path):
+    filename = str(tmp_path / 'lazy.edf')
+    shutil.copy(synthetic_edf, filename)
+    fractions = []
+    path = EdfCache.write(RawDF(filename=filename, lazy=True, use_cache=False), chunk_size=4096,
+                          progress=fractions.append)
+    assert fractions[-1] == 1 and len(fractions) > 1
+    assert EdfCache.fresh_path(filename) == path
@@ -0,0 +1,37 @@
+import shutil
+from blueprints.source_utils import RecordingStore, get_welch_cache
+from blueprints.bp_utils import get_pyramid
+
+
+def copies(synthetic_edf, tmp_path, n):
+    filenames = []
+    for i in range(n):
+        filenames.append(str(tmp_path / 'copy{}.edf'.format(i)))
+        shutil.copy(synthetic_edf, filenames[-1])
+    return filenames
+
+
+def test_lazy_recordings_count_their_derived_structures(synthetic_edf):
+    store = RecordingStore()
+    recording = store.get_raw(synthetic_edf, lazy=True, use_cache=False)
+    usage = recording.memory_usage()
+    assert usage >= recording.times.nbytes
+    pyramid = get_pyramid(recording)
+    assert recording.memory_usage() == usage + pyramid.memory_usage()
+    get_welch_cache(recording, 512).psd(0)
+    recording.channel_stats()
+    assert recording.memory_usage() > usage + pyramid.memory_usage()
+    assert store.memory_usage() == recording.memory_usage()
+
+
+def test_released_lazy_recordings_are_evicted(synthetic_edf, tmp_path):
+    store = RecordingStore(budget_mb=0.001)
+    for i, filename in enumerate(copies(synthetic_edf, tmp_path, 4)):
+        store.get_raw(filename, owner=i, lazy=True, use_cache=False)
+    assert len(store.entries) == 4
+    store.release(0)
+    store.release(1)
+    assert len(store.entries) == 2
+    store.release(2)
+    store.release(3)
+    assert len(store.entries) == 0
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from blueprints.bp_utils import convolve_multichannel, smooth_multichannel
+
+
+@pytest.fixture
+def multichannel():
+    return np.random.default_rng(0).standard_normal((4, 1000))
+
+
+@pytest.mark.parametrize('kernel', [None, [], [-1], [-1, -1], [1]])
+def test_kernels_leaving_the_signal_unchanged(multichannel, kernel):
+    np.testing.assert_array_equal(convolve_multichannel(multichannel, kernel, 0), multichannel)
+
+
+def test_constant_kernel_matches_np_convolve(multichannel):
+    kernel = np.ones(25) / 25
+    expected = np.array([np.convolve(channel, kernel, mode='same') for channel in multichannel])
+    np.testing.assert_allclose(convolve_multichannel(multichannel, kernel, 0), expected, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(smooth_multichannel(multichannel, 25), expected, rtol=0, atol=1e-12)
+
+
+def test_kernel_matches_np_convolve(multichannel):
+    kernel = np.hanning(31)
+    expected = np.array([np.convolve(channel, kernel, mode='same') for channel in multichannel])
+    np.testing.assert_allclose(convolve_multichannel(multichannel, kernel, 0), expected, rtol=0, atol=1e-10)
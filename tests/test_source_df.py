@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from blueprints.source_utils import RawDF
+
+
+def test_channel_stats_computed_once(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    assert recording.channel_stats(compute=False) is None
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        frames = list(executor.map(lambda _: recording.channel_stats(chunk_size=4096), range(4)))
+    assert all(frame is frames[0] for frame in frames)
+    assert recording.channel_stats(compute=False) is frames[0]
+
+    data = recording.get_window().astype(np.float64)
+    np.testing.assert_allclose(frames[0]['mean'], data.mean(axis=1), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(frames[0]['std'], data.std(axis=1), rtol=1e-6)
+    np.testing.assert_array_equal(frames[0]['max'], data.max(axis=1))
+
+
+def test_window_stats(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    data = recording.get_window(None, 100, 3100).astype(np.float64)
+    frame = recording.window_stats(100, 3100)
+    assert list(frame.index) == list(recording.ch_names)
+    np.testing.assert_allclose(frame['std'], data.std(axis=1))
+    np.testing.assert_array_equal(frame['min'], data.min(axis=1))
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+from scipy import signal
+from benchmarks.synthetic_edf import make_synthetic_edf
+from blueprints.source_utils import RawDF, SpectrogramTileCache
+
+
+def test_level_0_matches_spectrogram(synthetic_edf):
+    recording = RawDF(filename=synthetic_edf, lazy=True, use_cache=False)
+    cache = SpectrogramTileCache(tile_columns=32)
+    tile = cache.get_tile(recording, 1, 256, 0, 1)
+    freqs, times, expected = signal.spectrogram(recording.get_window([1])[0].astype(np.float64), recording.freq,
+                                                window='hann', nperseg=256, noverlap=128, mode='psd')
+    np.testing.assert_allclose(tile['image'], expected[:, 32:64], rtol=1e-4, atol=0)
+
+
+def test_rewritten_file_gets_new_tiles(tmp_path):
+    filename = make_synthetic_edf(str(tmp_path / 'rewritten.edf'), n_channels=4, duration=20, sfreq=500,
+                                  per_region=4, seed=0)
+    cache = SpectrogramTileCache(tile_columns=32)
+    old = cache.get_tile(RawDF(filename=filename, lazy=True, use_cache=False), 0, 256, 0, 0)
+
+    make_synthetic_edf(filename, n_channels=4, duration=20, sfreq=500, per_region=4, seed=1)
+    mtime = os.path.getmtime(filename) + 10
+    os.utime(filename, (mtime, mtime))
+    recording = RawDF(filename=filename, lazy=True, use_cache=False)
+    new = cache.get_tile(recording, 0, 256, 0, 0)
+    assert cache.info()['misses'] == 2
+    assert not np.allclose(old['image'], new['image'], rtol=1e-3, atol=0)
+    np.testing.assert_array_equal(new['image'], SpectrogramTileCache(tile_columns=32).compute_tile(
+        recording, 0, 256, 0, 0)['image'])
+
+
+def test_sample_types_get_their_own_tiles(synthetic_edf):
+    cache = SpectrogramTileCache(tile_columns=32)
+    for dtype in ['float32', 'float64']:
+        cache.get_tile(RawDF(filename=synthetic_edf, lazy=True, use_cache=False, dtype=dtype), 0, 256, 0, 0)
+    assert cache.info()['misses'] == 2
@@ -0,0 +1,9 @@
+from blueprints.spectrum_checker_bp import spectrum_filters, filter_input_value
+
+
+def test_configuration_and_inputs_give_the_same_chain():
+    configured = spectrum_filters(1, None, 60)
+    typed = spectrum_filters(filter_input_value(1), filter_input_value(None), filter_input_value(60))
+    assert configured == typed == (('high', 1.0), ('notch', 60.0))
+    assert spectrum_filters('None', 'none', None) == ()
+    assert spectrum_filters(0.5, 100.0, 50) == (('high', 0.5), ('low', 100.0), ('notch', 50.0))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from scipy import signal
+from blueprints.source_utils import RawDF, WelchSegmentCache
+from blueprints.source_utils.welch_cache import filter_channel
+
+NPERSEG = 512
+STEP = NPERSEG // 2
+# the prefix sums add the same periodograms as scipy.signal.welch in another order
+PSD_RTOL = 1e-9
+
+
+@pytest.fixture(scope='module')
+def recording(synthetic_edf):
+    return RawDF(filename=synthetic_edf, lazy=True, use_cache=False, dtype='float64')
+
+
+@pytest.mark.parametrize('filters', [(), (('high', 1.0), ('notch', 50.0))])
+@pytest.mark.parametrize('start, stop', [(0, None), (STEP * 10, STEP * 90), (STEP * 3, 29900), (STEP * 17, STEP * 19)])
+def test_grid_aligned_psd_matches_welch(recording, filters, start, stop):
+    cache = WelchSegmentCache(recording, NPERSEG, block_size=4)
+    # the whole channel is filtered and summed in blocks first, the interval is then read from the prefix sums
+    cache.channel_store(2, filters)
+    freqs, psd = cache.psd(2, start, stop, filters)
+
+    data = filter_channel(recording.get_window([2])[0], filters, recording.freq)[start:stop]
+    expected_freqs, expected = signal.welch(data, recording.freq, nperseg=NPERSEG)
+    np.testing.assert_array_equal(freqs, expected_freqs)
+    np.testing.assert_allclose(psd, expected, rtol=PSD_RTOL, atol=PSD_RTOL * expected.max())